@@ -147,17 +147,19 @@ class MongoPurePydantic(BaseModel):
         underscore_attrs_are_private = False
         arbitrary_types_allowed = True
 
-    def apply_metadata(self, *, user: str = "", add_created: bool = True):
+    def apply_metadata(self, *, user: str = "", add_created: bool = True, now: datetime | None = None):
         """
         Apply the metadata to the document. This will set the date_modified and modified_by fields. If the document
         has not been created yet, then it will set the date_created and created_by fields as well.
+
+        :param now: The timestamp to use, so that a batch of documents can share one. Defaults to the current time.
         """
         if not user:
             user = os.getenv("MONGODB_USERNAME", "")
 
         if add_created and self.date_created is None:
-            self.date_created = datetime.now(timezone.utc)
+            self.date_created = now or datetime.now(timezone.utc)
             self.created_by = user
 
-        self.date_modified = datetime.now(timezone.utc)
+        self.date_modified = now or datetime.now(timezone.utc)
         self.modified_by = user
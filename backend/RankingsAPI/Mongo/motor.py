@@ -1,9 +1,16 @@
+import time
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from typing import Any, Generic, Type, TypeVar
 
 from bson import ObjectId
 from loguru import logger
 from mongomock_motor import AsyncMongoMockClient
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pydantic import BaseModel
+from pymongo import IndexModel, InsertOne, UpdateOne
 
 from MongoBase import MongoConfig, MongoConfigMock, MongoConfigStandard, MongoConfigUrl
 
@@ -14,37 +21,155 @@ T = TypeVar("T", bound=MongoPurePydantic)
 __all__ = [
     "insert_one",
     "update_one",
+    "bulk_update",
+    "bulk_save",
+    "bulk_increment",
+    "bulk_append",
     "save",
     "get_from_id",
     "connect",
+    "disconnect",
+    "ping",
+    "get_collection",
+    "is_connected",
+    "use_database",
     "find",
     "insert_many",
     "delete_one",
     "delete_many",
     "DocumentNotFoundError",
+    "BulkWriteCounts",
+    "BULK_WRITE_BATCH_SIZE",
+    "declared_indexes",
+    "ensure_indexes",
+    "missing_indexes",
+    "add_operation_observer",
+    "remove_operation_observer",
 ]
 
+#: The number of operations sent to the database in each round-trip of a bulk write
+BULK_WRITE_BATCH_SIZE = 1000
+
 __connection: AsyncIOMotorClient | None = None
 __database: AsyncIOMotorDatabase | None = None
+#: The name of the database used instead of __database by the code running inside use_database
+__scoped_database: ContextVar[str | None] = ContextVar("scoped_database", default=None)
+
+#: Called after every database operation with its name, the collection, how long it took in seconds, and whether it
+#: raised
+OperationObserver = Callable[[str, str, float, bool], None]
+_operation_observers: list[OperationObserver] = []
 
 
 class DocumentNotFoundError(Exception):
     pass
 
 
+def add_operation_observer(observer: OperationObserver):
+    """
+    Have the observer told about every database operation, e.g. to time them. Nothing is timed while there are none.
+    """
+    _operation_observers.append(observer)
+
+
+def remove_operation_observer(observer: OperationObserver):
+    _operation_observers.remove(observer)
+
+
+@contextmanager
+def _observe(operation: str, collection_name: str) -> Iterator[None]:
+    if not _operation_observers:
+        yield
+        return
+
+    start = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _notify_observers(operation, collection_name, time.perf_counter() - start, failed)
+
+
+def _notify_observers(operation: str, collection_name: str, elapsed: float, failed: bool):
+    for observer in _operation_observers:
+        observer(operation, collection_name, elapsed, failed)
+
+
+class BulkWriteCounts(BaseModel):
+    """
+    The counts from every batch of a bulk write, added together
+    """
+
+    inserted_count: int = 0
+    matched_count: int = 0
+    modified_count: int = 0
+    upserted_count: int = 0
+
+
+def _raw_document(doc: dict[str, Any]) -> dict[str, Any]:
+    return doc
+
+
 class PydanticAsyncIOMotorCursor(Generic[T]):
     """
-    Wrapper for Override the motor cursor to return pydantic documents
+    Wrapper for Override the motor cursor to return pydantic documents.
+
+    By default every document is validated. For documents that we wrote ourselves, trusted() builds them without
+    validation, and as_dicts() (or raw()) skips pydantic altogether.
     """
 
     def __init__(self, cursor, type: Type[MongoPurePydantic]):
         self.cursor = cursor
         self.__type = type
+        self.__collection_name = type.__meta__["collection"]
+        self.__field_names = {field.alias: name for name, field in type.__fields__.items()}
+        self._convert: Callable[[dict[str, Any]], Any] = self._dict_to_pydantic
 
     async def __aiter__(self):
-        async for doc in self.cursor:
-            pydantic_doc = self.__type(**doc)
-            yield pydantic_doc
+        if not _operation_observers:
+            async for doc in self.cursor:
+                yield self._convert(doc)
+            return
+
+        # the whole iteration is one operation, but only the time spent waiting on the database counts, not the time
+        # the caller spends on each document
+        docs = aiter(self.cursor)
+        elapsed = 0.0
+        failed = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    doc = await anext(docs)
+                except StopAsyncIteration:
+                    return
+                except Exception:
+                    failed = True
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield self._convert(doc)
+        finally:
+            _notify_observers("find", self.__collection_name, elapsed, failed)
+
+    def as_dicts(self):
+        """
+        Return the raw mongo documents rather than pydantic ones, for read paths that only pass the data on
+        """
+        self._convert = _raw_document
+        return self
+
+    raw = as_dicts
+
+    def trusted(self):
+        """
+        Build the pydantic documents without validating them. Only use this for documents that we wrote, so we know
+        they are valid. Only the fields that are in the documents (i.e. those in the projection) are copied across,
+        the rest get their defaults.
+        """
+        self._convert = self._dict_to_trusted_pydantic
+        return self
 
     def sort(self, *args, **kwargs):
         self.cursor.sort(*args, **kwargs)
@@ -56,7 +181,7 @@ class PydanticAsyncIOMotorCursor(Generic[T]):
 
     def each(self, callback):
         def new_callback(doc):
-            return callback(self.__type(**doc))
+            return callback(self._convert(doc))
 
         self.cursor.each(new_callback)
         return self
@@ -73,22 +198,34 @@ class PydanticAsyncIOMotorCursor(Generic[T]):
         self.cursor.limit(limit)
         return self
 
+    def batch_size(self, batch_size: int):
+        self.cursor.batch_size(batch_size)
+        return self
+
     def _dict_to_pydantic(self, d: dict[str, Any]) -> T:
         return self.__type(**d)  # type: ignore
 
+    def _dict_to_trusted_pydantic(self, d: dict[str, Any]) -> T:
+        field_names = self.__field_names
+        values = {field_names[key]: value for key, value in d.items() if key in field_names}
+        return self.__type.construct(_fields_set=set(values), **values)  # type: ignore
+
     async def next(self) -> T:
         try:
-            d = await self.cursor.next()
+            with _observe("find", self.__collection_name):
+                d = await self.cursor.next()
         except StopAsyncIteration:
             raise DocumentNotFoundError("No more documents in cursor") from None
 
-        return self._dict_to_pydantic(d)
+        return self._convert(d)
 
     def __getattr__(self, attr):
         return getattr(self.cursor, attr)
 
     async def to_list(self, length: int | None = None):
-        return [self._dict_to_pydantic(doc) for doc in await self.cursor.to_list(length=length)]
+        with _observe("find", self.__collection_name):
+            docs = await self.cursor.to_list(length=length)
+        return [self._convert(doc) for doc in docs]
 
 
 def connect(config: MongoConfig, **kwargs) -> AsyncIOMotorClient:  # pyright: ignore[reportGeneralTypeIssues]
@@ -149,9 +286,99 @@ def _set_connection_and_database(connection, database):
     __database = connection[database]
 
 
-def _get_collection(doc: MongoPurePydantic | T):
+def disconnect():
+    """
+    Close the connection made by connect, along with every connection in its pool
+    """
+    global __database
+    global __connection
+    if __connection is not None:
+        __connection.close()
+    __connection = None
+    __database = None
+
+
+def is_connected() -> bool:
+    return __connection is not None
+
+
+@contextmanager
+def use_database(name: str | None) -> Iterator[None]:
+    """
+    Use another database on the same connection, and so the same pool, for everything done inside, including by the
+    tasks started inside. None means the database given to connect. It doesn't need to be connected yet.
+    """
+    token = __scoped_database.set(name)
+    try:
+        yield
+    finally:
+        __scoped_database.reset(token)
+
+
+def _database() -> AsyncIOMotorDatabase:
     assert __connection is not None and __database is not None, "Must call set_connection_and_database"
-    return __database[doc.__meta__["collection"]]  # type: ignore
+    name = __scoped_database.get()
+    return __connection[name] if name else __database
+
+
+async def ping():
+    """
+    A round-trip to the database that does nothing, e.g. to check it is up or to open a pooled connection
+    """
+    await _database().command("ping")
+
+
+def get_collection(name: str) -> AsyncIOMotorCollection:
+    """
+    A collection by name, for documents that aren't pydantic models, e.g. those used to coordinate processes
+    """
+    return _database()[name]
+
+
+def _get_collection(doc: MongoPurePydantic | T):
+    return _database()[doc.__meta__["collection"]]  # type: ignore
+
+
+def declared_indexes(doc_type: Type[MongoPurePydantic]) -> list[list[tuple[str, int]]]:
+    """
+    The indexes declared in a document type's __meta__["indexes"]. Each index is either a single field name, for an
+    ascending index on that field, or a list of (field, direction) pairs.
+    """
+    return [
+        [(index, 1)] if isinstance(index, str) else [(key, direction) for key, direction in index]
+        for index in doc_type.__meta__.get("indexes", [])
+    ]
+
+
+async def ensure_indexes(doc_types: Iterable[Type[MongoPurePydantic]]) -> list[str]:
+    """
+    Create every index declared by the document types. Mongo does nothing for an index that already exists, so this is
+    safe to call on every startup. Returns the names of the declared indexes.
+    """
+    names = []
+    for doc_type in doc_types:
+        indexes = declared_indexes(doc_type)
+        if indexes:
+            names += await _get_collection(doc_type).create_indexes([IndexModel(keys) for keys in indexes])
+    return names
+
+
+async def missing_indexes(doc_types: Iterable[Type[MongoPurePydantic]]) -> dict[str, list[list[tuple[str, int]]]]:
+    """
+    The declared indexes that don't exist in the database yet, by collection name
+    """
+    ret = {}
+    for doc_type in doc_types:
+        indexes = declared_indexes(doc_type)
+        if not indexes:
+            continue
+
+        information = await _get_collection(doc_type).index_information()
+        existing = [[tuple(key) for key in index["key"]] for index in information.values()]
+        missing = [keys for keys in indexes if keys not in existing]
+        if missing:
+            ret[doc_type.__meta__["collection"]] = missing
+    return ret
 
 
 async def insert_one(doc: MongoPurePydantic, *, user: str = "") -> ObjectId:
@@ -160,7 +387,8 @@ async def insert_one(doc: MongoPurePydantic, *, user: str = "") -> ObjectId:
     doc.apply_metadata(user=user)
     d = doc.to_mongo(exclude_none=True)
     try:
-        result = await collection.insert_one(d)
+        with _observe("insert_one", collection.name):
+            result = await collection.insert_one(d)
     except Exception as ex:
         logger.error("Document insert failed. {} : {}", ex, d)
         raise
@@ -179,12 +407,143 @@ async def update_one(doc: MongoPurePydantic, *, user: str = ""):
     update_dict = doc.to_mongo(exclude_none=True, exclude_unset=True)
 
     try:
-        await collection.update_one({"_id": doc.id}, {"$set": update_dict})
+        with _observe("update_one", collection.name):
+            await collection.update_one({"_id": doc.id}, {"$set": update_dict})
     except Exception:
         logger.error("Document update failed. {} : {}", doc.id, update_dict)
         raise
 
 
+def _update_operation(doc: MongoPurePydantic, *, user: str, now: datetime) -> UpdateOne:
+    doc.apply_metadata(user=user, add_created=False, now=now)
+    return UpdateOne({"_id": doc.id}, {"$set": doc.to_mongo(exclude_none=True, exclude_unset=True)})
+
+
+def _save_operation(doc: MongoPurePydantic, *, user: str, now: datetime) -> InsertOne | UpdateOne:
+    if doc.id is not None and doc.date_created is not None:
+        return _update_operation(doc, user=user, now=now)
+
+    doc.apply_metadata(user=user, now=now)
+    if doc.id is None:
+        doc.id = ObjectId()
+    return InsertOne(doc.to_mongo(exclude_none=True))
+
+
+async def _bulk_write(
+    docs: list[MongoPurePydantic],
+    operation: Callable[..., InsertOne | UpdateOne],
+    *,
+    user: str,
+    batch_size: int,
+    ordered: bool,
+) -> BulkWriteCounts:
+    counts = BulkWriteCounts()
+    if not docs:
+        return counts
+
+    assert all(type(doc) == type(docs[0]) for doc in docs), "All docs must be of the same type"  # noqa: E721
+
+    collection = _get_collection(docs[0])
+
+    for start in range(0, len(docs), batch_size):
+        now = datetime.now(timezone.utc)
+        operations = [operation(doc, user=user, now=now) for doc in docs[start : start + batch_size]]
+
+        try:
+            with _observe("bulk_write", collection.name):
+                result = await collection.bulk_write(operations, ordered=ordered)
+        except Exception:
+            logger.exception("Document bulk write failed")
+            raise
+
+        counts.inserted_count += result.inserted_count
+        counts.matched_count += result.matched_count
+        counts.modified_count += result.modified_count
+        counts.upserted_count += result.upserted_count
+
+    return counts
+
+
+async def bulk_update(
+    docs: list[MongoPurePydantic],
+    *,
+    user: str = "",
+    batch_size: int = BULK_WRITE_BATCH_SIZE,
+    ordered: bool = False,
+) -> BulkWriteCounts:
+    """
+    Update many documents of the same type with one round-trip per batch. Each document gets the same partial $set that
+    update_one would send, and every document in a batch shares one modified timestamp.
+    """
+    return await _bulk_write(docs, _update_operation, user=user, batch_size=batch_size, ordered=ordered)
+
+
+async def bulk_save(
+    docs: list[MongoPurePydantic],
+    *,
+    user: str = "",
+    batch_size: int = BULK_WRITE_BATCH_SIZE,
+    ordered: bool = False,
+) -> BulkWriteCounts:
+    """
+    The bulk version of save. Documents that have not been created yet are inserted (and given their id), the rest are
+    updated.
+    """
+    return await _bulk_write(docs, _save_operation, user=user, batch_size=batch_size, ordered=ordered)
+
+
+async def bulk_increment(
+    increments: list[tuple[MongoPurePydantic, dict[str, int | float]]],
+    *,
+    set_fields: Iterable[str] = (),
+    user: str = "",
+    batch_size: int = BULK_WRITE_BATCH_SIZE,
+    ordered: bool = False,
+) -> BulkWriteCounts:
+    """
+    Atomically add to the numeric fields of many documents with $inc, rather than overwriting them with values that
+    could have been read before somebody else's update. The fields named in set_fields are $set from the documents.
+    """
+    by_doc = {id(doc): increment for doc, increment in increments}
+    include = {"date_modified", "modified_by", *set_fields}
+
+    def operation(doc: MongoPurePydantic, *, user: str, now: datetime) -> UpdateOne:
+        doc.apply_metadata(user=user, add_created=False, now=now)
+        inc = {doc.__fields__[key].alias: value for key, value in by_doc[id(doc)].items()}
+        return UpdateOne({"_id": doc.id}, {"$inc": inc, "$set": doc.to_mongo(include=include)})
+
+    docs = [doc for doc, _ in increments]
+    return await _bulk_write(docs, operation, user=user, batch_size=batch_size, ordered=ordered)
+
+
+async def bulk_append(
+    docs: list[MongoPurePydantic],
+    *,
+    key_fields: Iterable[str],
+    append_fields: Iterable[str],
+    user: str = "",
+    batch_size: int = BULK_WRITE_BATCH_SIZE,
+    ordered: bool = False,
+) -> BulkWriteCounts:
+    """
+    Append the list fields named in append_fields onto the stored document with the same key_fields, with $push, so
+    documents that many writers add to (e.g. time series buckets) never need to be read first. The document is created
+    if it doesn't exist yet. The rest of the fields are $set from the documents.
+    """
+
+    def operation(doc: MongoPurePydantic, *, user: str, now: datetime) -> UpdateOne:
+        doc.apply_metadata(user=user, now=now)
+        d = doc.to_mongo(exclude_none=True)
+        d.pop("_id", None)
+        key = {doc.__fields__[field].alias: d.pop(doc.__fields__[field].alias) for field in key_fields}
+        push = {doc.__fields__[field].alias: {"$each": d.pop(doc.__fields__[field].alias)} for field in append_fields}
+        on_insert = {field: d.pop(field) for field in ("_date_created", "_created_by") if field in d}
+        update = {"$push": push, "$set": d, "$setOnInsert": on_insert}
+        return UpdateOne(key, {operator: values for operator, values in update.items() if values}, upsert=True)
+
+    return await _bulk_write(docs, operation, user=user, batch_size=batch_size, ordered=ordered)
+
+
 async def save(doc: MongoPurePydantic, *, user: str = ""):
     if doc.id is None or doc.date_created is None:
         await insert_one(doc, user=user)
@@ -201,10 +560,14 @@ async def insert_many(docs: list[MongoPurePydantic], *, user: str = "") -> list[
         doc.apply_metadata(user=user)
 
     try:
-        result = await collection.insert_many([doc.to_mongo(exclude_none=True) for doc in docs])
+        with _observe("insert_many", collection.name):
+            result = await collection.insert_many([doc.to_mongo(exclude_none=True) for doc in docs])
     except Exception:
         logger.exception("Document insert failed")
         raise
+
+    for doc, inserted_id in zip(docs, result.inserted_ids, strict=True):
+        doc.id = inserted_id
     return result.inserted_ids
 
 
@@ -248,7 +611,8 @@ def find(
 async def get_from_id(doc_type: Type[T], id: str | ObjectId) -> T:
     collection = _get_collection(doc_type)
     try:
-        returned_dict = await collection.find_one({"_id": id})
+        with _observe("get_from_id", collection.name):
+            returned_dict = await collection.find_one({"_id": id})
     except Exception:
         logger.exception("Document get failed")
         raise
@@ -261,7 +625,8 @@ async def delete_one(doc: MongoPurePydantic):
     collection = _get_collection(doc)
 
     try:
-        await collection.delete_one({"_id": doc.id})
+        with _observe("delete_one", collection.name):
+            await collection.delete_one({"_id": doc.id})
     except Exception:
         logger.exception("Document delete failed")
         raise
@@ -284,7 +649,8 @@ async def delete_many(doc_type: Type[T], query_filter: dict[str, dict[str, Any]]
     query_filter = {key_aliases.get(key, key): value for key, value in query_filter.items()}
 
     try:
-        await collection.delete_many(query_filter)
+        with _observe("delete_many", collection.name):
+            await collection.delete_many(query_filter)
     except Exception:
         logger.exception("Document delete failed")
         raise
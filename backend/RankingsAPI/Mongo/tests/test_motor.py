@@ -3,22 +3,27 @@ import unittest
 from datetime import datetime, timezone
 from enum import Enum
 
-from ShipSeatGui.Mongo.mongo_pure_pydantic import MongoPurePydantic
-from ShipSeatGui.Mongo.motor import (
+from MongoBase import MongoConfigMock, MongoConfigStandard, MongoConfigUrl
+from MongoBase.config import SingleInstanceConnection
+from RankingsAPI.Mongo.mongo_pure_pydantic import MongoPurePydantic
+from RankingsAPI.Mongo.motor import (
     DocumentNotFoundError,
+    _get_collection,
+    bulk_append,
+    bulk_save,
+    bulk_update,
     connect,
     delete_many,
     delete_one,
+    ensure_indexes,
     find,
     get_from_id,
     insert_many,
     insert_one,
+    missing_indexes,
     update_one,
 )
 
-from MongoBase import MongoConfigMock, MongoConfigStandard, MongoConfigUrl
-from MongoBase.config import SingleInstanceConnection
-
 
 class EDatabaseTestConnectionType(Enum):
     MOCK = "mock"
@@ -36,6 +41,20 @@ class DocumentForTest(MongoPurePydantic):
     number: int | None = None
 
 
+class IndexedDocumentForTest(MongoPurePydantic):
+    __meta__ = {"collection": "indexed_document_for_test", "indexes": ["name", [("number", -1), ("_id", 1)]]}
+
+    name: str
+    number: int | None = None
+
+
+class BucketForTest(MongoPurePydantic):
+    __meta__ = {"collection": "bucket_for_test"}
+
+    name: str
+    values: list[int] = []
+
+
 class TestMotor(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
         os.environ["MONGODB_USERNAME"] = "test_user"
@@ -128,3 +147,93 @@ class TestMotor(unittest.IsolatedAsyncioTestCase):
         # test getting all
         cursor = find(DocumentForTest, query_filter={"name": {"$regex": f"^test_save_load_bulk_{timestamp}"}})
         self.assertEqual(5, len(await cursor.to_list(length=100)))
+
+    async def test_bulk_update(self):
+        timestamp = round(datetime.now(timezone.utc).timestamp())
+        docs = [DocumentForTest(name=f"test_bulk_update_{timestamp}_{i}", number=i) for i in range(10)]
+        await insert_many(docs)  # type: ignore
+
+        docs = await find(
+            DocumentForTest, query_filter={"name": {"$regex": f"^test_bulk_update_{timestamp}"}}
+        ).to_list()
+        for doc in docs:
+            doc.number += 100 if doc.number < 5 else 0
+
+        counts = await bulk_update(docs, batch_size=3)  # type: ignore
+        self.assertEqual(10, counts.matched_count)
+        self.assertEqual(10, counts.modified_count)  # the modified date always changes
+        self.assertEqual(1, len({doc.date_modified for doc in docs[:3]}))
+
+        cursor = find(
+            DocumentForTest, number__gte=100, query_filter={"name": {"$regex": f"^test_bulk_update_{timestamp}"}}
+        )
+        self.assertEqual(5, len(await cursor.to_list(length=100)))
+
+    async def test_bulk_save(self):
+        timestamp = round(datetime.now(timezone.utc).timestamp())
+        existing = DocumentForTest(name=f"test_bulk_save_{timestamp}_existing", number=1)
+        await insert_one(existing)
+        existing.number = 2
+
+        new = [DocumentForTest(name=f"test_bulk_save_{timestamp}_{i}", number=i) for i in range(3)]
+        counts = await bulk_save([existing, *new])  # type: ignore
+        self.assertEqual(3, counts.inserted_count)
+        self.assertEqual(1, counts.matched_count)
+        self.assertTrue(all(doc.id is not None for doc in new))
+
+        self.assertEqual(2, (await get_from_id(DocumentForTest, existing.id)).number)
+        self.assertEqual(new[1], await get_from_id(DocumentForTest, new[1].id))
+
+    async def test_find_trusted_and_raw(self):
+        timestamp = round(datetime.now(timezone.utc).timestamp())
+        docs = [DocumentForTest(name=f"test_find_trusted_{timestamp}_{i}", number=i) for i in range(3)]
+        await insert_many(docs)  # type: ignore
+        query_filter = {"name": {"$regex": f"^test_find_trusted_{timestamp}"}}
+
+        validated = await find(DocumentForTest, query_filter).sort("number").to_list(None)
+        trusted = await find(DocumentForTest, query_filter).trusted().sort("number").to_list(None)
+        self.assertEqual(validated, trusted)
+        self.assertEqual(validated[0].__fields_set__, trusted[0].__fields_set__)
+
+        # only the projected fields are set, so an update doesn't write back defaults
+        projected = await find(DocumentForTest, query_filter, projection=["number"]).trusted().to_list(None)
+        self.assertEqual({"id", "number"}, projected[0].__fields_set__)
+        self.assertNotIn("_id", projected[0].__dict__)
+
+        raw = await find(DocumentForTest, query_filter).raw().sort("number").to_list(None)
+        self.assertEqual(docs[0].id, raw[0]["_id"])
+        self.assertEqual(0, raw[0]["number"])
+
+    async def test_ensure_indexes(self):
+        await _get_collection(IndexedDocumentForTest).drop_indexes()
+        self.assertEqual(
+            {"indexed_document_for_test": [[("name", 1)], [("number", -1), ("_id", 1)]]},
+            await missing_indexes([DocumentForTest, IndexedDocumentForTest]),
+        )
+
+        await ensure_indexes([DocumentForTest, IndexedDocumentForTest])
+        self.assertEqual({}, await missing_indexes([DocumentForTest, IndexedDocumentForTest]))
+
+        # creating them again does nothing
+        await ensure_indexes([IndexedDocumentForTest])
+        self.assertEqual({}, await missing_indexes([IndexedDocumentForTest]))
+
+    async def test_bulk_append(self):
+        timestamp = round(datetime.now(timezone.utc).timestamp())
+        names = [f"test_bulk_append_{timestamp}_{i}" for i in range(2)]
+
+        counts = await bulk_append(
+            [BucketForTest(name=names[0], values=[1, 2])], key_fields=["name"], append_fields=["values"]
+        )
+        self.assertEqual(1, counts.upserted_count)
+
+        counts = await bulk_append(
+            [BucketForTest(name=names[0], values=[3]), BucketForTest(name=names[1], values=[4])],
+            key_fields=["name"],
+            append_fields=["values"],
+        )
+        self.assertEqual((1, 1), (counts.matched_count, counts.upserted_count))
+
+        buckets = await find(BucketForTest, name__in=names).sort("name").to_list(None)
+        self.assertEqual([[1, 2, 3], [4]], [bucket.values for bucket in buckets])
+        self.assertTrue(all(bucket.date_created is not None for bucket in buckets))
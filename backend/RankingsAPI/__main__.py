@@ -1,7 +1,11 @@
+import asyncio
+import os
+import sys
 from datetime import datetime, timedelta, timezone
 
 import click
 import uvicorn
+from fastapi import FastAPI
 
 from RankingsAPI.api import build_api
 from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
@@ -9,35 +13,96 @@ from RankingsAPI.manager import Manager
 from RankingsAPI.settings import Settings
 
 
+def create_api() -> FastAPI:
+    """
+    Build the app from the settings in the environment. Each worker process calls this, so gets its own manager.
+    """
+    settings = Settings()
+    return build_api(manager=Manager(config=settings), settings=settings)
+
+
+async def report_missing_indexes(manager: Manager) -> dict[str, list[list[tuple[str, int]]]]:
+    manager.connect()
+    try:
+        return await manager.missing_indexes()
+    finally:
+        await manager.close()
+
+
+async def seed_debug_league(manager: Manager):
+    alice = await manager.add_player(PlayerAPI(name="Alice Smith"))
+    bob = await manager.add_player(PlayerAPI(name="Bob Jones"))
+    charlie = await manager.add_player(PlayerAPI(name="Charlie Brown"))
+    charlie_id = str(charlie.id)
+    bob_id = str(bob.id)
+    alice_id = str(alice.id)
+    await manager.add_match(
+        MatchAPISubmit(result=[alice_id, bob_id], draw=False, date=datetime.now(tz=timezone.utc) - timedelta(hours=1))
+    )
+    await manager.add_match(
+        MatchAPISubmit(result=[bob_id, charlie_id], draw=False, date=datetime.now(tz=timezone.utc) - timedelta(hours=2))
+    )
+
+
+async def serve(manager: Manager, settings: Settings, host: str, port: int, debug: bool):
+    """
+    Run the server. Everything, including the debug seeding, runs on the one event loop that the database client is
+    created on.
+    """
+    if debug:
+        await manager.start()
+        await seed_debug_league(manager)
+
+    api = build_api(manager=manager, settings=settings)
+    await uvicorn.Server(uvicorn.Config(api, host=host, port=port)).serve()
+
+
+async def seed_and_close(manager: Manager):
+    await manager.start()
+    try:
+        await seed_debug_league(manager)
+    finally:
+        await manager.close()
+
+
 @click.command()
 @click.option("--host", default="0.0.0.0")
 @click.option("--port", default=8080)
 @click.option("--debug", is_flag=True)
-def main(host: str, port: int, debug: bool):
-    settings = Settings()  # TODO: load these
+@click.option("--report-indexes", is_flag=True, help="List any indexes missing from the database, then exit")
+@click.option("--profile", is_flag=True, help="Log slow operations and keep their profiles at /debug/profiles")
+@click.option("--slow-threshold", type=float, default=None, help="The seconds an operation takes to count as slow")
+@click.option("--workers", default=1, help="The number of worker processes, which coordinate through the database")
+def main(
+    host: str, port: int, debug: bool, report_indexes: bool, profile: bool, slow_threshold: float | None, workers: int
+):
+    overrides: dict[str, bool | float] = {}
+    if profile:
+        overrides["profiling"] = True
+    if slow_threshold is not None:
+        overrides["slow_operation_threshold"] = slow_threshold
+    if workers > 1:
+        overrides["coordinate_workers"] = True
+    settings = Settings(**overrides)  # TODO: load these
     manager = Manager(config=settings)
 
-    if debug:
-        alice = manager.add_player(PlayerAPI(name="Alice Smith"))
-        bob = manager.add_player(PlayerAPI(name="Bob Jones"))
-        charlie = manager.add_player(PlayerAPI(name="Charlie Brown"))
-        charlie_id = str(charlie.id)
-        bob_id = str(bob.id)
-        alice_id = str(alice.id)
-        manager.add_match(
-            MatchAPISubmit(
-                result=[alice_id, bob_id], draw=False, date=datetime.now(tz=timezone.utc) - timedelta(hours=1)
-            )
-        )
-        manager.add_match(
-            MatchAPISubmit(
-                result=[bob_id, charlie_id], draw=False, date=datetime.now(tz=timezone.utc) - timedelta(hours=2)
-            )
-        )
-
-    api = build_api(manager=manager, settings=settings)
+    if report_indexes:
+        missing = asyncio.run(report_missing_indexes(manager))
+        for collection, indexes in missing.items():
+            for keys in indexes:
+                click.echo(f"{collection}: {', '.join(f'{key} {direction}' for key, direction in keys)}")
+        if not missing:
+            click.echo("No missing indexes")
+        sys.exit(1 if missing else 0)
 
-    uvicorn.run(api, host=host, port=port)
+    if workers > 1:
+        if debug:
+            asyncio.run(seed_and_close(manager))
+        # the workers build their own settings, so they are handed the overrides through the environment
+        os.environ.update({key.upper(): str(value) for key, value in overrides.items()})
+        uvicorn.run("RankingsAPI.__main__:create_api", factory=True, host=host, port=port, workers=workers)
+    else:
+        asyncio.run(serve(manager, settings, host, port, debug))
 
 
 if __name__ == "__main__":
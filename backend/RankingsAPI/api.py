@@ -1,40 +1,140 @@
+import json
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
 from bson import ObjectId
-from fastapi import FastAPI
+from bson.errors import InvalidId
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+import RankingsAPI.Mongo.motor as motor
 
-from .data_models import MatchAPIReturn, MatchAPIReturnResolved, MatchAPISubmit, PlayerAPI
+from .data_models import (
+    HeadToHead,
+    LeagueAPI,
+    MatchAPIPage,
+    MatchAPIReturn,
+    MatchAPIReturnResolved,
+    MatchAPISubmit,
+    MatchBatchResult,
+    Pairing,
+    PlayerAPI,
+    PlayerStats,
+    RatingHistoryAPI,
+    SimulationResult,
+    WinProbabilities,
+)
+from .engines import hidden_player_fields
+from .ingest import IngestStats
+from .leagues import Leagues
 from .manager import Manager
+from .metrics import CONTENT_TYPE, INGEST_QUEUE_DEPTH, REGISTRY, MetricsMiddleware
+from .profiling import PROFILE_FORMATS
 from .settings import Settings
 
 __all__ = ["build_api"]
 
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson"}
+PROFILE_EXTENSIONS = {"pstats": "prof", "collapsed": "folded"}
+
+
+def _export_response(docs: AsyncIterator[str], export_format: str) -> StreamingResponse:
+    """
+    Stream the serialised documents back one per line, so nothing is held in memory and the first line goes straight
+    out
+    """
+    if export_format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported export format {export_format}")
+
+    async def lines():
+        async for doc in docs:
+            yield doc + "\n"
+
+    return StreamingResponse(lines(), media_type=EXPORT_MEDIA_TYPES[export_format])
 
-def build_api(manager: Manager, settings: Settings) -> FastAPI:
-    api = FastAPI()
-    if settings.backend_cors_origins:
-        api.add_middleware(
-            CORSMiddleware,
-            allow_origins=settings.backend_cors_origins,
-            allow_credentials=True,
-            allow_methods=["*"],
-            allow_headers=["*"],
-        )
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """
+    Whether an If-None-Match header (a list of possibly weak etags, or *) matches our etag
+    """
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+class _DatabaseMiddleware:
+    """
+    Runs a league's app with the league's database in use, None being the one in the mongo config
+    """
+
+    def __init__(self, app, database: str | None):
+        self.app = app
+        self.database = database
+
+    async def __call__(self, scope, receive, send):
+        with motor.use_database(self.database):
+            await self.app(scope, receive, send)
+
+
+def _add_league_routes(api: FastAPI, manager: Manager, settings: Settings):
+    hidden = manager.hidden_player_fields
 
     @api.get("/players", response_model=list[PlayerAPI])
-    async def get_players():
-        player_dict = await manager.get_players()
-        players = sorted(player_dict.values(), key=lambda player: player.rating)
-        players = [x.to_api() for x in players]
-        return players
+    async def get_players(if_none_match: str | None = Header(default=None)):
+        leaderboard = await manager.get_leaderboard()
+        headers = {"ETag": leaderboard.etag, "X-Leaderboard-Version": str(leaderboard.version)}
+
+        if if_none_match and _etag_matches(if_none_match, leaderboard.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=leaderboard.body, media_type="application/json", headers=headers)
+
+    @api.get("/players/export")
+    async def export_players(format: str = "ndjson"):
+        players = (player.to_api().json(exclude=hidden) async for player in manager.iter_players())
+        return _export_response(players, format)
+
+    @api.get("/players/rescore", response_model=list[PlayerAPI])
+    async def rescore_players(engine: str):
+        """
+        What every player's rating would be if the whole history was rated with another engine. Nothing is saved.
+        """
+        try:
+            players = await manager.rescore(engine)
+        except ValueError as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+        # with the fields of the engine they were rated with, rather than the one in use
+        return JSONResponse(
+            jsonable_encoder([player.to_api() for player in players], exclude=hidden_player_fields(engine))
+        )
+
+    @api.get("/players/win_probabilities", response_model=WinProbabilities)
+    async def get_win_probabilities():
+        matrix = await manager.get_win_probabilities()
+        return Response(content=matrix.body, media_type="application/json")
+
+    @api.get("/players/pairings", response_model=list[Pairing])
+    async def suggest_pairings(player_id: list[str] | None = Query(default=None), avoid_days: float | None = None):
+        """
+        Balanced pairings for a session, between the given players or every active player. Pairs who have played each
+        other in the last avoid_days days are skipped.
+        """
+        not_since = datetime.now(timezone.utc) - timedelta(days=avoid_days) if avoid_days else None
+        try:
+            player_ids = [ObjectId(x) for x in player_id] if player_id else None
+        except InvalidId as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+        return await manager.suggest_pairings(player_ids, not_since=not_since)
 
-    @api.post("/players", response_model=PlayerAPI)
+    @api.post("/players", response_model=PlayerAPI, response_model_exclude=hidden)
     async def add_player(player: PlayerAPI):
         if player.id:
             raise ValueError("Player already exists")
         db_player = await manager.add_player(player=player)
         return db_player.to_api()
 
-    @api.put("/players", response_model=PlayerAPI)
+    @api.put("/players", response_model=PlayerAPI, response_model_exclude=hidden)
     async def update_player(player: PlayerAPI):
         if not player.id:
             raise ValueError("This is for updating players")
@@ -46,7 +146,7 @@ def build_api(manager: Manager, settings: Settings) -> FastAPI:
         player_id = ObjectId(player_id)
         await manager.delete_player(player_id)
 
-    @api.get("/players/{player_id}", response_model=PlayerAPI)
+    @api.get("/players/{player_id}", response_model=PlayerAPI, response_model_exclude=hidden)
     async def get_player(player_id: str):
         player_id = ObjectId(player_id)
         player = await manager.get_player(player_id)
@@ -55,36 +155,92 @@ def build_api(manager: Manager, settings: Settings) -> FastAPI:
     @api.get("/players/{player_id}/matches", response_model=list[MatchAPIReturnResolved])
     async def get_player_matches(player_id: str):
         player_id = ObjectId(player_id)
-        matches = await manager.get_matches_by_player(player_id)
-        ret = []
-        for match in matches:
-            d = match.to_api().dict()
-            d["winner_name"] = (await manager.get_player(match.result[0])).name
-            d["loser_name"] = (await manager.get_player(match.result[1])).name
-            ret.append(d)
-        return ret
-
-    @api.get("/matches", response_model=list[MatchAPIReturn])
-    async def get_matches():
-        matches = await manager.get_matches()
-        ret = [x.to_api() for x in matches]
-        return ret
+        return JSONResponse(await manager.get_matches_resolved(player_id))
+
+    @api.get("/players/{player_id}/stats", response_model=PlayerStats)
+    async def get_player_stats(player_id: str):
+        try:
+            return await manager.get_player_stats(ObjectId(player_id))
+        except (ValueError, InvalidId) as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+
+    @api.get("/players/{player_id}/vs/{opponent_id}", response_model=HeadToHead)
+    async def get_head_to_head(player_id: str, opponent_id: str):
+        try:
+            return await manager.get_head_to_head(ObjectId(player_id), ObjectId(opponent_id))
+        except (ValueError, InvalidId) as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+
+    @api.get("/players/{player_id}/history", response_model=RatingHistoryAPI)
+    async def get_rating_history(player_id: str, since: datetime | None = None, resolution: str = "match"):
+        """
+        The player's rating after each match, or at the end of each day, week or month
+        """
+        try:
+            return await manager.get_rating_history(ObjectId(player_id), since=since, resolution=resolution)
+        except ValueError as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+
+    @api.get("/matches", response_model=MatchAPIPage)
+    async def get_matches(
+        limit: int = Query(default=settings.default_page_size, ge=1, le=settings.max_page_size),
+        cursor: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        player_id: str | None = None,
+    ):
+        try:
+            matches, next_cursor = await manager.get_matches_page(
+                limit=limit,
+                cursor=cursor,
+                since=since,
+                until=until,
+                player_id=ObjectId(player_id) if player_id else None,
+            )
+        except (ValueError, InvalidId) as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+        return JSONResponse({"matches": matches, "next_cursor": next_cursor})
+
+    @api.get("/matches/export")
+    async def export_matches(format: str = "ndjson"):
+        matches = (json.dumps(match) async for match in manager.iter_matches())
+        return _export_response(matches, format)
 
     @api.post("/matches", response_model=MatchAPIReturn)
-    async def add_match(match: MatchAPISubmit) -> MatchAPIReturn:
-        db_match = await manager.add_match(match)
+    async def add_match(match: MatchAPISubmit, response: Response, wait: bool = True) -> MatchAPIReturn:
+        """
+        Queue the match to be committed. Unless wait is false we only respond once it has been, otherwise it is
+        accepted with a 202 and only the id is filled in.
+        """
+        try:
+            db_match = await manager.submit_match(match, wait=wait)
+        except ValueError as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+        if not wait:
+            response.status_code = 202
         return db_match.to_api()
 
+    @api.post("/matches/batch", response_model=list[MatchBatchResult])
+    async def add_match_batch(matches: list[MatchAPISubmit]):
+        return await manager.add_match_batch(matches)
+
+    @api.post("/matches/simulate", response_model=SimulationResult)
+    async def simulate_matches(matches: list[MatchAPISubmit]):
+        """
+        How the matches would change the ratings if they were added. Nothing is saved.
+        """
+        try:
+            return await manager.simulate(matches)
+        except ValueError as ex:
+            raise HTTPException(status_code=400, detail=str(ex)) from ex
+
+    @api.get("/matches/queue", response_model=IngestStats)
+    async def get_match_queue():
+        return manager.ingest_stats
+
     @api.get("/matches/resolved", response_model=list[MatchAPIReturnResolved])
     async def get_matches_resolved():
-        matches = await manager.get_matches()
-        ret = []
-        for match in matches:
-            d = match.to_api().dict()
-            d["winner_name"] = (await manager.get_player(match.result[0])).name
-            d["loser_name"] = (await manager.get_player(match.result[1])).name
-            ret.append(d)
-        return ret
+        return JSONResponse(await manager.get_matches_resolved())
 
     @api.delete("/matches/{match_id}")
     async def delete_match(match_id: str):
@@ -95,4 +251,98 @@ def build_api(manager: Manager, settings: Settings) -> FastAPI:
     async def recalculate_last():
         await manager.recalculate_last_matches()
 
+    if manager.profiler:
+        profiler = manager.profiler
+
+        @api.get("/debug/profiles", include_in_schema=False)
+        async def get_profiles():
+            """
+            The slow operations that have been profiled, latest first
+            """
+            return [profile.summary() for profile in reversed(profiler.profiles)]
+
+        @api.get("/debug/profiles/{index}", include_in_schema=False)
+        async def download_profile(index: int, format: str = "pstats"):
+            """
+            Download a profile, by its position in /debug/profiles, as a pstats file or as collapsed stacks
+            """
+            profiles = list(reversed(profiler.profiles))
+            if not 0 <= index < len(profiles):
+                raise HTTPException(status_code=404, detail=f"There is no profile {index}")
+            if format not in PROFILE_FORMATS:
+                raise HTTPException(status_code=400, detail=f"Unsupported profile format {format}")
+            profile = profiles[index]
+            try:
+                content = profile.dump(format)
+            except ValueError as ex:
+                raise HTTPException(status_code=404, detail=str(ex)) from ex
+            filename = f"{profile.name}-{profile.started:%Y%m%dT%H%M%S}.{PROFILE_EXTENSIONS[format]}"
+            return Response(
+                content=content,
+                media_type="application/octet-stream",
+                headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+            )
+
+
+def build_api(manager: Manager, settings: Settings, leagues: Leagues | None = None) -> FastAPI:
+    """
+    The app for the league in the settings, with the other leagues in the settings mounted at /leagues/{name}
+    """
+    if leagues is None:
+        leagues = Leagues(settings)
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+        # connected here, so the database client belongs to the server's event loop. The other leagues share it.
+        await manager.start()
+        await leagues.start()
+        yield
+        await leagues.close()
+        await manager.close()
+
+    api = FastAPI(lifespan=lifespan)
+    if settings.backend_cors_origins:
+        api.add_middleware(
+            CORSMiddleware,
+            allow_origins=settings.backend_cors_origins,
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+            expose_headers=["ETag", "X-Leaderboard-Version"],
+        )
+    api.add_middleware(MetricsMiddleware)
+    api.add_middleware(_DatabaseMiddleware, database=settings.database)
+    INGEST_QUEUE_DEPTH.set_function(
+        lambda: manager.ingest_stats.queue_depth + sum(league.manager.ingest_stats.queue_depth for league in leagues)
+    )
+
+    @api.get("/healthz", include_in_schema=False)
+    async def healthz():
+        """
+        Whether the server has connected and warmed up, for load balancers to wait for before sending it requests
+        """
+        if not (manager.ready and leagues.ready):
+            return JSONResponse({"status": "not ready"}, status_code=503)
+        return {"status": "ready"}
+
+    @api.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        """
+        Request latencies, database operation timings and counts, and replay durations, for Prometheus to scrape
+        """
+        return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+    @api.get("/leagues", response_model=list[LeagueAPI])
+    async def get_leagues():
+        return [
+            LeagueAPI(name=None, sport=settings.sport, path="/"),
+            *(LeagueAPI(name=league.name, sport=league.settings.sport, path=league.path) for league in leagues),
+        ]
+
+    _add_league_routes(api, manager, settings)
+    for league in leagues:
+        league_api = FastAPI(title=f"{league.settings.sport} league")
+        _add_league_routes(league_api, league.manager, league.settings)
+        api.mount(league.path, _DatabaseMiddleware(league_api, league.settings.database))
+
     return api
@@ -0,0 +1,121 @@
+"""
+coordination.py: Keeping several worker processes that share a database in step. Rating updates are serialised with a
+lease document, and every write bumps a shared version document, which the workers poll to know when their caches are
+stale.
+"""
+
+import asyncio
+import time
+import uuid
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from loguru import logger
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import RankingsAPI.Mongo.motor as motor
+
+__all__ = ["Coordinator", "SharedVersions", "COORDINATION_COLLECTION"]
+
+COORDINATION_COLLECTION = "coordination"
+VERSIONS_ID = "versions"
+LEASE_ID = "ratings_lease"
+
+#: In seconds, the longest wait between attempts to take a held lease
+MAX_LEASE_RETRY_DELAY = 0.1
+
+
+@dataclass
+class SharedVersions:
+    #: Goes up every time any worker changes a player
+    players: int = 0
+    #: Goes up every time any worker adds, changes or deletes a match
+    matches: int = 0
+
+
+class Coordinator:
+    """
+    Shared state for the workers serving one database. Only one worker at a time can hold the lease, and so update
+    ratings. Each holder renews it while it works, so it only expires if the holder has died.
+    """
+
+    def __init__(self, *, lease_duration: float, poll_interval: float):
+        """
+        :param lease_duration: In seconds, how long a lease lasts without being renewed
+        :param poll_interval: In seconds, how long the shared versions are trusted for before being read again
+        """
+        self._lease_duration = timedelta(seconds=lease_duration)
+        self._poll_interval = poll_interval
+        self._versions = SharedVersions()
+        self._fetched = float("-inf")
+
+    @staticmethod
+    def _collection():
+        return motor.get_collection(COORDINATION_COLLECTION)
+
+    async def versions(self, force: bool = False) -> SharedVersions:
+        """
+        The shared versions, read again if they are older than the poll interval or if forced
+        """
+        if force or time.monotonic() - self._fetched >= self._poll_interval:
+            fetched = time.monotonic()
+            doc = await self._collection().find_one({"_id": VERSIONS_ID})
+            self._versions = SharedVersions(**{key: value for key, value in (doc or {}).items() if key != "_id"})
+            self._fetched = fetched
+        return self._versions
+
+    async def publish(self, *, players: bool, matches: bool) -> SharedVersions:
+        """
+        Tell the other workers that the players and/or the matches have changed, returning the new versions
+        """
+        increments = {key: 1 for key, changed in (("players", players), ("matches", matches)) if changed}
+        doc = await self._collection().find_one_and_update(
+            {"_id": VERSIONS_ID}, {"$inc": increments}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        self._versions = SharedVersions(**{key: value for key, value in doc.items() if key != "_id"})
+        self._fetched = time.monotonic()
+        return self._versions
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[None]:
+        """
+        Hold the rating lease, waiting for whoever has it to finish (or for their lease to expire)
+        """
+        collection = self._collection()
+        owner = uuid.uuid4().hex
+        delay = 0.005
+        while True:
+            now = datetime.now(timezone.utc)
+            try:
+                # if somebody else holds the lease, then nothing matches and the upsert clashes with their document
+                await collection.update_one(
+                    {"_id": LEASE_ID, "expires": {"$lt": now}},
+                    {"$set": {"owner": owner, "expires": now + self._lease_duration}},
+                    upsert=True,
+                )
+                break
+            except DuplicateKeyError:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_LEASE_RETRY_DELAY)
+
+        renewal = asyncio.get_running_loop().create_task(self._renew(owner))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await collection.delete_one({"_id": LEASE_ID, "owner": owner})
+
+    async def _renew(self, owner: str):
+        interval = self._lease_duration.total_seconds() / 3
+        while True:
+            await asyncio.sleep(interval)
+            now = datetime.now(timezone.utc)
+            result = await self._collection().update_one(
+                {"_id": LEASE_ID, "owner": owner}, {"$set": {"expires": now + self._lease_duration}}
+            )
+            if not result.matched_count:
+                logger.error("The rating lease expired before it was renewed, another worker may now hold it")
+                return
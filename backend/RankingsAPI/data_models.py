@@ -10,9 +10,31 @@ from enum import Enum
 from bson import ObjectId
 from pydantic import BaseModel, Field, validator
 
-from RankingsAPI.Mongo import MongoPurePydantic
+from RankingsAPI.Mongo import MongoPurePydantic, datetime_encoder
 
-__all__ = ["EResult", "MatchAPISubmit", "Match", "MatchAPIReturn", "MatchAPIReturnResolved", "Player", "PlayerAPI"]
+__all__ = [
+    "EResult",
+    "MATCH_API_FIELDS",
+    "MatchAPISubmit",
+    "Match",
+    "MatchAPIReturn",
+    "MatchAPIReturnResolved",
+    "MatchAPIPage",
+    "MatchBatchResult",
+    "SimulatedPlayer",
+    "SimulationResult",
+    "Player",
+    "PlayerAPI",
+    "PlayerBase",
+    "PlayerStats",
+    "HeadToHead",
+    "RatingHistory",
+    "RatingHistoryPoint",
+    "RatingHistoryAPI",
+    "WinProbabilities",
+    "Pairing",
+    "LeagueAPI",
+]
 
 
 class EResult(Enum):
@@ -43,19 +65,86 @@ class MatchAPIReturnResolved(MatchAPIReturn):
     loser_name: str
 
 
+class MatchAPIPage(BaseModel):
+    matches: list[MatchAPIReturn]
+    next_cursor: str | None = Field(
+        default=None, description="Pass this as the cursor to get the next page. None when there are no more matches."
+    )
+
+
+class MatchBatchResult(BaseModel):
+    #: The position of the match in the submitted batch
+    index: int
+    match: MatchAPIReturn | None = None
+    error: str | None = None
+
+
+class SimulatedPlayer(BaseModel):
+    id: str
+    name: str
+    rating_before: float
+    rating_after: float
+    rating_change: float
+    #: Leaderboard positions, starting from 1
+    rank_before: int
+    rank_after: int
+
+
+class SimulationResult(BaseModel):
+    #: The simulated matches, with the ratings they would be played at
+    matches: list[MatchAPIReturn]
+    #: The players whose rating or leaderboard position would change, in their new leaderboard order
+    players: list[SimulatedPlayer]
+    #: How many of the matches already played had to be replayed, because the simulated ones went before them
+    replayed_matches: int
+
+
+#: The fields of a match document that end up in a MatchAPIReturn, to use as a projection
+MATCH_API_FIELDS = ["result", "draw", "date", "winner_rating", "loser_rating", "probability"]
+
+
 class Match(MatchBase, MongoPurePydantic):
-    __meta__ = {"collection": "matches"}
+    __meta__ = {
+        "collection": "matches",
+        "indexes": [
+            # every match a player played
+            "result",
+            # the match listings and the rankings replay
+            [("date", 1), ("_id", 1)],
+        ],
+    }
     result: list[ObjectId]
     winner_rating: float | None = None
     loser_rating: float | None = None
     probability: float | None = None
 
+    @validator("date", always=True)
+    def truncate_date(cls, v: datetime):
+        # mongo only keeps milliseconds, so this keeps the match in memory the same as the one in the database
+        return v.replace(microsecond=v.microsecond // 1000 * 1000)
+
     def to_api(self) -> MatchAPIReturn:
         d = self.dict()
         d["id"] = str(self.id)
         d["result"] = [str(x) for x in self.result]
         return MatchAPIReturn(**d)
 
+    @staticmethod
+    def mongo_to_api(doc: dict) -> dict:
+        """
+        Build the json ready MatchAPIReturn dictionary straight from a raw mongo document (fetched with the
+        MATCH_API_FIELDS projection), without building and validating the pydantic models in between.
+        """
+        return {
+            "result": [str(x) for x in doc["result"]],
+            "draw": doc["draw"],
+            "date": datetime_encoder(doc["date"]),
+            "id": str(doc["_id"]),
+            "winner_rating": doc.get("winner_rating"),
+            "loser_rating": doc.get("loser_rating"),
+            "probability": doc.get("probability"),
+        }
+
     @classmethod
     def from_api(cls, match: MatchAPISubmit):
         d = match.dict()
@@ -69,6 +158,9 @@ class PlayerBase(BaseModel):
     name: str
     active: bool = True
     rating: float = 1000
+    #: Only used by the glicko2 rating engine, and left out of what the API returns under the others
+    rating_deviation: float = 350
+    volatility: float = 0.06
     match_count: int = 0
     wins: int = 0
     losses: int = 0
@@ -77,9 +169,12 @@ class PlayerBase(BaseModel):
 
     def reset(self):
         self.rating = 1000
+        self.rating_deviation = 350
+        self.volatility = 0.06
         self.wins = 0
         self.losses = 0
         self.draws = 0
+        self.last_match_date = None
 
     @validator("name")
     def validate_name(cls, v: str):
@@ -93,9 +188,83 @@ class PlayerAPI(PlayerBase):
 
 
 class Player(MongoPurePydantic, PlayerBase):
-    __meta__ = {"collection": "players"}
+    __meta__ = {"collection": "players", "indexes": [[("rating", -1)]]}
 
     def to_api(self) -> PlayerAPI:
         d = self.dict()
         d["id"] = str(self.id)
         return PlayerAPI(**d)
+
+
+class PlayerStats(BaseModel):
+    player_id: str
+    matches: int = 0
+    wins: int = 0
+    losses: int = 0
+    draws: int = 0
+    win_percentage: float = 0
+    current_streak: int = Field(
+        default=0, description="Positive for wins in a row, negative for losses in a row. A draw ends a streak."
+    )
+    longest_win_streak: int = 0
+    longest_loss_streak: int = 0
+    last_match_date: datetime | None = None
+
+
+class HeadToHead(BaseModel):
+    player_a: str
+    player_b: str
+    matches: int = 0
+    player_a_wins: int = 0
+    player_b_wins: int = 0
+    draws: int = 0
+
+
+class RatingHistory(MongoPurePydantic):
+    """
+    A player's rating after each of the matches they played in one month. The points are held as parallel lists, so a
+    month of history is a single document.
+    """
+
+    __meta__ = {"collection": "rating_history", "indexes": [[("player", 1), ("month", 1)], "month"]}
+    player: ObjectId
+    #: Midnight (UTC) on the first of the month
+    month: datetime
+    dates: list[datetime] = []
+    ratings: list[float] = []
+    match_ids: list[ObjectId] = []
+
+
+class RatingHistoryPoint(BaseModel):
+    date: datetime
+    rating: float
+
+
+class RatingHistoryAPI(BaseModel):
+    player_id: str
+    resolution: str
+    points: list[RatingHistoryPoint]
+
+
+class WinProbabilities(BaseModel):
+    #: The active players, in leaderboard order
+    player_ids: list[str]
+    names: list[str]
+    #: probabilities[i][j] is the chance of player i beating player j
+    probabilities: list[list[float]]
+
+
+class Pairing(BaseModel):
+    player_a: str
+    player_b: str
+    #: The chance of player a beating player b
+    probability: float
+    last_met: datetime | None = None
+
+
+class LeagueAPI(BaseModel):
+    #: None for the league served at the root
+    name: str | None
+    sport: str
+    #: Where the league's players and matches are served from
+    path: str
@@ -0,0 +1,377 @@
+"""
+engines.py: The rating systems that turn match results into ratings. Each one replays matches in batches against a
+RatingState, so the same code rates live matches, recalculations and comparisons.
+"""
+
+import math
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator, Sequence
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from loguru import logger
+
+from .data_models import Match
+from .history import HistoryPoint
+from .Mongo import ensure_timezone_aware
+from .replay import RatingState, expected_score, k_factor
+from .settings import Settings
+
+__all__ = [
+    "RatingEngine",
+    "EloEngine",
+    "Glicko2Engine",
+    "ENGINES",
+    "build_engine",
+    "hidden_player_fields",
+    "rated_player_fields",
+]
+
+
+class RatingEngine(ABC):
+    """
+    A rating system. Engines only change the rating fields of a RatingState; the wins, losses and draws are counted the
+    same way whichever engine is used.
+    """
+
+    name: str
+    #: Whether a match can be rated on its own as soon as it is played. If not, the matches around it have to be
+    #: replayed from replay_from().
+    incremental: bool = True
+    #: The Player fields the engine rates besides the rating, which mean nothing under the other engines
+    player_fields: tuple[str, ...] = ()
+
+    @abstractmethod
+    def expected_score(self, state: RatingState, player_a: int, player_b: int) -> float:
+        """
+        The probability of the player at index a beating the player at index b
+        """
+
+    @abstractmethod
+    def update(
+        self, state: RatingState, matches: Sequence[Match], *, history: list[HistoryPoint] | None = None
+    ) -> list[Match]:
+        """
+        Rate a batch of matches, in the order given, against the state. The winner_rating, loser_rating and probability
+        of each match are set in place, and the matches whose values changed are returned so only they get written.
+
+        :param history: If given, (player id, date, rating, match id) is appended for both players of every match
+        """
+
+    def expected_matrix(self, state: RatingState) -> list[list[float]]:
+        """
+        The probability of every player beating every other player, [i][j] being player i beating player j
+        """
+        players = range(len(state.ids))
+        return [[self.expected_score(state, i, j) for j in players] for i in players]
+
+    def chunks(self, matches: Sequence[Match], size: int) -> Iterator[Sequence[Match]]:
+        """
+        Split the matches into batches of about size matches that can each be passed to update() on their own. A
+        checkpoint can be taken between any two batches.
+        """
+        for start in range(0, len(matches), size):
+            yield matches[start : start + size]
+
+    def replay_from(self, key: tuple[datetime, ObjectId]) -> tuple[datetime, ObjectId]:
+        """
+        Where a replay has to start from for a change to the match at the given position to be rated correctly
+        """
+        return key
+
+    @staticmethod
+    def _players(state: RatingState, match: Match) -> tuple[int, int] | None:
+        try:
+            return state.index[match.result[0]], state.index[match.result[1]]
+        except KeyError:
+            logger.warning("Skipping match {} as it refers to a player that does not exist", match.id)
+            return None
+
+    @staticmethod
+    def _set_match_ratings(
+        match: Match, winner_rating: float, loser_rating: float, probability: float, changed: list[Match]
+    ):
+        if (
+            match.winner_rating != winner_rating
+            or match.loser_rating != loser_rating
+            or match.probability != probability
+        ):
+            match.winner_rating = winner_rating
+            match.loser_rating = loser_rating
+            match.probability = probability
+            changed.append(match)
+
+
+class EloEngine(RatingEngine):
+    """
+    Chess style Elo. Every match moves both ratings by K times how far the result was from the expected score, where K
+    starts at initial_k for new players and comes down to standard_k.
+    """
+
+    name = "elo"
+
+    def __init__(self, initial_k: float, standard_k: float):
+        self.initial_k = initial_k
+        self.standard_k = standard_k
+
+    def expected_score(self, state: RatingState, player_a: int, player_b: int) -> float:
+        return expected_score(state.rating[player_a], state.rating[player_b])
+
+    def expected_matrix(self, state: RatingState) -> list[list[float]]:
+        # 1 / (1 + 10 ** ((b - a) / 400)) is q_a / (q_a + q_b), so each power is only worked out once per player
+        strength = [10 ** (rating / 400.0) for rating in state.rating]
+        return [[q_a / (q_a + q_b) for q_b in strength] for q_a in strength]
+
+    def update(
+        self, state: RatingState, matches: Sequence[Match], *, history: list[HistoryPoint] | None = None
+    ) -> list[Match]:
+        rating = state.rating
+        match_count = state.match_count
+        initial_k = self.initial_k
+        standard_k = self.standard_k
+        changed: list[Match] = []
+
+        for match in matches:
+            players = self._players(state, match)
+            if players is None:
+                continue
+            winner, loser = players
+
+            winner_rating = rating[winner]
+            loser_rating = rating[loser]
+            expected_result = expected_score(winner_rating, loser_rating)
+            self._set_match_ratings(match, winner_rating, loser_rating, expected_result, changed)
+
+            if match.draw:
+                score_change = 0.5 - expected_result
+                rating[winner] += k_factor(match_count[winner], initial_k, standard_k) * score_change
+                rating[loser] += k_factor(match_count[loser], initial_k, standard_k) * score_change
+            else:
+                score_change = 1 - expected_result
+                rating[winner] += k_factor(match_count[winner], initial_k, standard_k) * score_change
+                rating[loser] -= k_factor(match_count[loser], initial_k, standard_k) * score_change
+            state.record_result(winner, loser, match)
+
+            if history is not None:
+                history.append((state.ids[winner], match.date, rating[winner], match.id))  # type: ignore
+                history.append((state.ids[loser], match.date, rating[loser], match.id))  # type: ignore
+
+        return changed
+
+
+#: The conversion between the glicko and glicko2 scales
+GLICKO2_SCALE = 173.7178
+#: The rating that sits at 0 on the glicko2 scale. Glicko uses 1500, but only differences matter, and new players here
+#: start on 1000.
+GLICKO2_CENTRE = 1000
+#: The deviation new players start with, which nobody's grows beyond however long they go without playing
+GLICKO2_MAX_DEVIATION = 350
+#: Rating periods are counted from a Monday, so weekly periods run Monday to Sunday
+GLICKO2_EPOCH = datetime(1970, 1, 5, tzinfo=timezone.utc)
+
+
+class Glicko2Engine(RatingEngine):
+    """
+    Glickman's Glicko-2. Matches are grouped into rating periods; every match in a period is rated against the
+    ratings from the start of it, and the ratings only move once the period is over. Each player also has a rating
+    deviation, how unsure we are of their rating, which grows while they don't play, and a volatility.
+
+    The latest period is rated as it stands, so a new match replays the period it was played in.
+    """
+
+    name = "glicko2"
+    incremental = False
+    player_fields = ("rating_deviation", "volatility")
+
+    def __init__(self, rating_period: timedelta, tau: float, tolerance: float = 0.000001):
+        """
+        :param rating_period: How long each rating period lasts
+        :param tau: Limits how much the volatility can change, smaller values are more conservative
+        """
+        self.rating_period = rating_period
+        self.tau = tau
+        self.tolerance = tolerance
+
+    def period(self, date: datetime) -> int:
+        return (ensure_timezone_aware(date) - GLICKO2_EPOCH) // self.rating_period
+
+    def replay_from(self, key: tuple[datetime, ObjectId]) -> tuple[datetime, ObjectId]:
+        # before every match of the period
+        return GLICKO2_EPOCH + self.period(key[0]) * self.rating_period, ObjectId("0" * 24)
+
+    def chunks(self, matches: Sequence[Match], size: int) -> Iterator[Sequence[Match]]:
+        # a period can't be split, as its ratings only change once it is over
+        start = 0
+        while start < len(matches):
+            end = min(start + size, len(matches))
+            last_period = self.period(matches[end - 1].date)
+            while end < len(matches) and self.period(matches[end].date) == last_period:
+                end += 1
+            yield matches[start:end]
+            start = end
+
+    @staticmethod
+    def _g(phi: float) -> float:
+        return 1 / math.sqrt(1 + 3 * phi**2 / math.pi**2)
+
+    def expected_score(self, state: RatingState, player_a: int, player_b: int) -> float:
+        mu_a = (state.rating[player_a] - GLICKO2_CENTRE) / GLICKO2_SCALE
+        mu_b = (state.rating[player_b] - GLICKO2_CENTRE) / GLICKO2_SCALE
+        return 1 / (1 + math.exp(-self._g(state.deviation[player_b] / GLICKO2_SCALE) * (mu_a - mu_b)))
+
+    def update(
+        self, state: RatingState, matches: Sequence[Match], *, history: list[HistoryPoint] | None = None
+    ) -> list[Match]:
+        changed: list[Match] = []
+        start = 0
+        while start < len(matches):
+            end = start + 1
+            period = self.period(matches[start].date)
+            while end < len(matches) and self.period(matches[end].date) == period:
+                end += 1
+            if state.period is not None and period > state.period + 1:
+                # nobody played in the periods in between, but they still count
+                self._age(state, period - state.period - 1)
+            self._rate_period(state, matches[start:end], changed, history)
+            state.period = period
+            start = end
+        return changed
+
+    @staticmethod
+    def _age(state: RatingState, periods: int, skip: Iterable[int] = ()):
+        """
+        Grow the deviations of the players who went the given number of periods without playing, as we become less sure
+        of their ratings. Players who haven't played yet stay where they started.
+        """
+        skip = set(skip)
+        for player in range(len(state.ids)):
+            if player in skip or state.last_match_date[player] is None:
+                continue
+            phi = state.deviation[player] / GLICKO2_SCALE
+            deviation = math.sqrt(phi**2 + periods * state.volatility[player] ** 2) * GLICKO2_SCALE
+            state.deviation[player] = min(deviation, GLICKO2_MAX_DEVIATION)
+
+    def _rate_period(
+        self, state: RatingState, matches: Sequence[Match], changed: list[Match], history: list[HistoryPoint] | None
+    ):
+        #: player index -> [(opponent index, score)]
+        results: dict[int, list[tuple[int, float]]] = {}
+        rated = []
+        for match in matches:
+            players = self._players(state, match)
+            if players is None:
+                continue
+            winner, loser = players
+
+            probability = self.expected_score(state, winner, loser)
+            self._set_match_ratings(match, state.rating[winner], state.rating[loser], probability, changed)
+
+            winner_score = 0.5 if match.draw else 1.0
+            results.setdefault(winner, []).append((loser, winner_score))
+            results.setdefault(loser, []).append((winner, 1 - winner_score))
+            state.record_result(winner, loser, match)
+            rated.append((match, winner, loser))
+
+        # everybody is rated against the ratings from the start of the period
+        updates = {player: self._rate_player(state, player, opponents) for player, opponents in results.items()}
+        self._age(state, 1, skip=updates)
+        for player, update in updates.items():
+            state.rating[player], state.deviation[player], state.volatility[player] = update
+
+        if history is not None:
+            for match, winner, loser in rated:
+                history.append((state.ids[winner], match.date, state.rating[winner], match.id))  # type: ignore
+                history.append((state.ids[loser], match.date, state.rating[loser], match.id))  # type: ignore
+
+    def _rate_player(
+        self, state: RatingState, player: int, opponents: list[tuple[int, float]]
+    ) -> tuple[float, float, float]:
+        """
+        The new rating, deviation and volatility of a player who played in the period
+        """
+        mu = (state.rating[player] - GLICKO2_CENTRE) / GLICKO2_SCALE
+        phi = state.deviation[player] / GLICKO2_SCALE
+        sigma = state.volatility[player]
+
+        v_inverse = 0.0
+        improvement = 0.0
+        for opponent, score in opponents:
+            mu_j = (state.rating[opponent] - GLICKO2_CENTRE) / GLICKO2_SCALE
+            g = self._g(state.deviation[opponent] / GLICKO2_SCALE)
+            expected = 1 / (1 + math.exp(-g * (mu - mu_j)))
+            v_inverse += g**2 * expected * (1 - expected)
+            improvement += g * (score - expected)
+        v = 1 / v_inverse
+        delta = v * improvement
+
+        sigma = self._volatility(phi, sigma, v, delta)
+        phi_star = min(math.sqrt(phi**2 + sigma**2), GLICKO2_MAX_DEVIATION / GLICKO2_SCALE)
+        phi = 1 / math.sqrt(1 / phi_star**2 + 1 / v)
+        mu = mu + phi**2 * improvement
+        return mu * GLICKO2_SCALE + GLICKO2_CENTRE, phi * GLICKO2_SCALE, sigma
+
+    def _volatility(self, phi: float, sigma: float, v: float, delta: float) -> float:
+        """
+        Solve for the new volatility with the Illinois algorithm, step 5 of Glickman's paper
+        """
+        a = math.log(sigma**2)
+        tau = self.tau
+
+        def f(x: float) -> float:
+            ex = math.exp(x)
+            return ex * (delta**2 - phi**2 - v - ex) / (2 * (phi**2 + v + ex) ** 2) - (x - a) / tau**2
+
+        bound_a = a
+        if delta**2 > phi**2 + v:
+            bound_b = math.log(delta**2 - phi**2 - v)
+        else:
+            k = 1
+            while f(a - k * tau) < 0:
+                k += 1
+            bound_b = a - k * tau
+
+        f_a, f_b = f(bound_a), f(bound_b)
+        while abs(bound_b - bound_a) > self.tolerance:
+            c = bound_a + (bound_a - bound_b) * f_a / (f_b - f_a)
+            f_c = f(c)
+            if f_c * f_b <= 0:
+                bound_a, f_a = bound_b, f_b
+            else:
+                f_a /= 2
+            bound_b, f_b = c, f_c
+        return math.exp(bound_a / 2)
+
+
+#: The rating engines that can be chosen with Settings.rating_engine
+ENGINES = {EloEngine.name: EloEngine, Glicko2Engine.name: Glicko2Engine}
+
+
+def build_engine(config: Settings, name: str | None = None) -> RatingEngine:
+    """
+    Build the rating engine configured in the settings, or the named one. Raises ValueError for an unknown engine.
+    """
+    name = name or config.rating_engine
+    match name:
+        case EloEngine.name:
+            return EloEngine(initial_k=config.initial_k, standard_k=config.standard_k)
+        case Glicko2Engine.name:
+            return Glicko2Engine(
+                rating_period=timedelta(days=config.glicko2_rating_period_days), tau=config.glicko2_tau
+            )
+        case _:
+            raise ValueError(f"Unknown rating engine {name}, it should be one of {', '.join(ENGINES)}")
+
+
+def rated_player_fields() -> set[str]:
+    """
+    The Player fields that belong to the rating engines, so are only ever changed by rating matches
+    """
+    return {field for engine in ENGINES.values() for field in engine.player_fields}
+
+
+def hidden_player_fields(name: str) -> set[str]:
+    """
+    The Player fields that only the other engines rate, so are left out of the players the API returns when the named
+    engine is used
+    """
+    return rated_player_fields() - set(ENGINES[name].player_fields)
@@ -0,0 +1,86 @@
+"""
+history.py: Every player's rating over time, bucketed into one document per player per month
+"""
+
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+from .data_models import RatingHistory, RatingHistoryPoint
+from .Mongo import ensure_timezone_aware
+
+__all__ = ["HistoryPoint", "RESOLUTIONS", "month_start", "build_buckets", "bucket_points", "downsample"]
+
+#: (player id, date, rating after the match, match id)
+HistoryPoint = tuple[ObjectId, datetime, float, ObjectId]
+
+#: The resolutions a history can be downsampled to. A match resolution keeps every point.
+RESOLUTIONS = ("match", "day", "week", "month")
+
+
+def month_start(date: datetime) -> datetime:
+    """
+    The start of the month that the date is in, which is the key of its history bucket
+    """
+    date = ensure_timezone_aware(date).astimezone(timezone.utc)
+    return datetime(date.year, date.month, 1, tzinfo=timezone.utc)
+
+
+def build_buckets(points: Iterable[HistoryPoint]) -> list[RatingHistory]:
+    """
+    Group the points into history buckets, each sorted by date
+    """
+    grouped: dict[tuple[ObjectId, datetime], list[HistoryPoint]] = {}
+    for point in points:
+        grouped.setdefault((point[0], month_start(point[1])), []).append(point)
+
+    buckets = []
+    for (player_id, month), members in grouped.items():
+        members.sort(key=lambda point: (ensure_timezone_aware(point[1]), point[3]))
+        buckets.append(
+            RatingHistory(
+                player=player_id,
+                month=month,
+                dates=[point[1] for point in members],
+                ratings=[point[2] for point in members],
+                match_ids=[point[3] for point in members],
+            )
+        )
+    return buckets
+
+
+def bucket_points(bucket: RatingHistory) -> list[HistoryPoint]:
+    return [
+        (bucket.player, date, rating, match_id)
+        for date, rating, match_id in zip(bucket.dates, bucket.ratings, bucket.match_ids, strict=True)
+    ]
+
+
+def _period(date: datetime, resolution: str) -> tuple[int, ...]:
+    match resolution:
+        case "day":
+            return date.year, date.month, date.day
+        case "week":
+            monday = date.date() - timedelta(days=date.weekday())
+            return monday.year, monday.month, monday.day
+        case "month":
+            return date.year, date.month
+        case _:
+            raise ValueError(f"Unknown resolution {resolution}")
+
+
+def downsample(points: list[tuple[datetime, float]], resolution: str) -> list[RatingHistoryPoint]:
+    """
+    Reduce the (date, rating) points, in date order, to the last one in each day, week or month, i.e. the rating the
+    player finished that period on. Raises ValueError for an unknown resolution.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution {resolution}, it should be one of {', '.join(RESOLUTIONS)}")
+    if resolution == "match":
+        return [RatingHistoryPoint(date=date, rating=rating) for date, rating in points]
+
+    last: dict[tuple[int, ...], tuple[datetime, float]] = {}
+    for date, rating in points:
+        last[_period(ensure_timezone_aware(date).astimezone(timezone.utc), resolution)] = (date, rating)
+    return [RatingHistoryPoint(date=date, rating=rating) for date, rating in last.values()]
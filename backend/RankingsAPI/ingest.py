@@ -0,0 +1,169 @@
+"""
+ingest.py: A single writer that takes submitted matches off a queue and commits them in batches
+"""
+
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+from loguru import logger
+from pydantic import BaseModel
+
+import RankingsAPI.Mongo.motor as motor
+
+from .data_models import Match
+from .metrics import INGEST_BATCH_DURATION, INGEST_FAILED_BATCHES, INGEST_MATCHES
+
+if TYPE_CHECKING:
+    from .manager import Manager
+
+__all__ = ["MatchIngestQueue", "IngestStats"]
+
+
+class IngestStats(BaseModel):
+    queue_depth: int
+    batches_committed: int
+    matches_committed: int
+    failed_batches: int
+    last_batch_size: int
+    #: How long the last batch took to commit, in seconds
+    last_batch_latency: float
+    #: The mean time a batch took to commit, in seconds
+    mean_batch_latency: float
+
+
+class MatchIngestQueue:
+    """
+    Matches are queued as they are submitted, and one background task drains the queue, committing whatever has built
+    up as a single batch. A burst of submissions then costs a couple of round-trips per batch rather than per match.
+    """
+
+    def __init__(self, manager: "Manager", *, batch_size: int, batch_wait: float):
+        """
+        :param batch_size: The most matches committed in one batch
+        :param batch_wait: How long, in seconds, to wait for more matches to arrive once the first one has
+        """
+        self._manager = manager
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._queue: asyncio.Queue[tuple[Match, asyncio.Future[Match]]] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+        self.batches_committed = 0
+        self.matches_committed = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.last_batch_latency = 0.0
+        self._total_batch_latency = 0.0
+
+    def submit(self, match: Match) -> "asyncio.Future[Match]":
+        """
+        Queue a match to be committed. The returned future completes with the match once it has been written.
+        """
+        self.start()
+        future: asyncio.Future[Match] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((match, future))
+        return future
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """
+        Commit everything that is already queued, then stop the writer
+        """
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    @property
+    def stats(self) -> IngestStats:
+        return IngestStats(
+            queue_depth=self._queue.qsize(),
+            batches_committed=self.batches_committed,
+            matches_committed=self.matches_committed,
+            failed_batches=self.failed_batches,
+            last_batch_size=self.last_batch_size,
+            last_batch_latency=self.last_batch_latency,
+            mean_batch_latency=self._total_batch_latency / self.batches_committed if self.batches_committed else 0.0,
+        )
+
+    async def _next_batch(self) -> list[tuple[Match, "asyncio.Future[Match]"]]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self._batch_wait
+        while len(batch) < self._batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        # the writer can be started outside of a request, e.g. by a script, so it doesn't rely on one for its database
+        with motor.use_database(self._manager.database):
+            while True:
+                batch = await self._next_batch()
+                try:
+                    valid = await self._check(batch)
+                    if valid:
+                        await self._commit(valid)
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+
+    async def _check(
+        self, batch: list[tuple[Match, "asyncio.Future[Match]"]]
+    ) -> list[tuple[Match, "asyncio.Future[Match]"]]:
+        """
+        Turn away the matches that can no longer be committed, e.g. as a player was deleted since they were submitted,
+        so they don't fail the rest of the batch. Returns the others.
+        """
+        valid = []
+        for match, future in batch:
+            try:
+                await self._manager.check_match(match)
+            except Exception as ex:
+                logger.warning("Turned away submitted match {}: {}", match.id, ex)
+                if not future.done():
+                    future.set_exception(ex)
+            else:
+                valid.append((match, future))
+        return valid
+
+    async def _commit(self, batch: list[tuple[Match, "asyncio.Future[Match]"]]):
+        start = time.perf_counter()
+        try:
+            await self._manager.add_matches([match for match, _ in batch])
+        except Exception as ex:
+            logger.exception("Committing a batch of {} matches failed", len(batch))
+            self.failed_batches += 1
+            INGEST_FAILED_BATCHES.inc()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+
+        latency = time.perf_counter() - start
+        self.batches_committed += 1
+        self.matches_committed += len(batch)
+        self.last_batch_size = len(batch)
+        self.last_batch_latency = latency
+        self._total_batch_latency += latency
+        INGEST_BATCH_DURATION.observe(latency)
+        INGEST_MATCHES.inc(len(batch))
+        for match, future in batch:
+            if not future.done():
+                future.set_result(match)
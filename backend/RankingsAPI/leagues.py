@@ -0,0 +1,78 @@
+"""
+leagues.py: Serving other leagues (e.g. darts alongside pool) from the same process. Each league has its own settings,
+manager, caches and locks, and is kept in its own database, but they all share the one connection pool.
+"""
+
+import asyncio
+import re
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import RankingsAPI.Mongo.motor as motor
+
+from .manager import Manager
+from .settings import Settings
+
+__all__ = ["League", "Leagues"]
+
+#: League names are used in paths, so are kept to what doesn't need escaping
+LEAGUE_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+
+@dataclass
+class League:
+    name: str
+    settings: Settings
+    manager: Manager
+
+    @property
+    def path(self) -> str:
+        return f"/leagues/{self.name}"
+
+    @contextmanager
+    def database(self) -> Iterator[None]:
+        """
+        Use the league's database for everything done inside, which is needed around any call to its manager
+        """
+        with motor.use_database(self.settings.database):
+            yield
+
+
+class Leagues:
+    """
+    The leagues in the settings' leagues, each with its own manager. They are connected through the manager of the
+    league that the settings are for, which has to be started first and closed last.
+    """
+
+    def __init__(self, config: Settings):
+        self._leagues: dict[str, League] = {}
+        for name in config.leagues:
+            if not LEAGUE_NAME.fullmatch(name):
+                raise ValueError(f"League names can only have letters, digits, _ and -, not {name}")
+            shared = sorted(key for key in config.leagues[name] if key == "mongo" or key.startswith("mongo_"))
+            if shared:
+                raise ValueError(
+                    f"League {name} can't set {', '.join(shared)}, as every league shares the one connection"
+                )
+            settings = config.for_league(name)
+            self._leagues[name] = League(name=name, settings=settings, manager=Manager(config=settings))
+
+    def __iter__(self) -> Iterator[League]:
+        return iter(self._leagues.values())
+
+    def __len__(self) -> int:
+        return len(self._leagues)
+
+    def __getitem__(self, name: str) -> League:
+        return self._leagues[name]
+
+    @property
+    def ready(self) -> bool:
+        return all(league.manager.ready for league in self)
+
+    async def start(self):
+        await asyncio.gather(*(league.manager.start() for league in self))
+
+    async def close(self):
+        await asyncio.gather(*(league.manager.close() for league in self))
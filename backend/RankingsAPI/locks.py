@@ -0,0 +1,68 @@
+"""
+locks.py: Locking so that concurrent match submissions and recalculations can't lose each other's rating updates
+"""
+
+import asyncio
+from collections import defaultdict
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from bson import ObjectId
+
+__all__ = ["RatingLocks"]
+
+
+class RatingLocks:
+    """
+    Serialises rating updates. A match locks the players it involves, so matches between different players still run
+    side by side, while a recalculation locks every player. Waiting recalculations stop new matches from starting so
+    they can't be starved.
+    """
+
+    def __init__(self):
+        self._player_locks: dict[ObjectId, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._condition = asyncio.Condition()
+        #: The number of holders of player locks
+        self._active = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @asynccontextmanager
+    async def players(self, *player_ids: ObjectId) -> AsyncIterator[None]:
+        """
+        Hold the locks for the given players. They are always taken in the same order so two matches can't deadlock.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and not self._exclusive_waiting)
+            self._active += 1
+
+        try:
+            async with AsyncExitStack() as stack:
+                for player_id in sorted(set(player_ids)):
+                    await stack.enter_async_context(self._player_locks[player_id])
+                yield
+        finally:
+            async with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def everything(self) -> AsyncIterator[None]:
+        """
+        Wait for every match in progress to finish, then hold off everything else until we are done
+        """
+        async with self._condition:
+            self._exclusive_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._exclusive and not self._active)
+            finally:
+                self._exclusive_waiting -= 1
+                self._condition.notify_all()
+            self._exclusive = True
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
@@ -1,13 +1,115 @@
-import copy
+import asyncio
+import base64
+import bisect
+import hashlib
+import time
+from collections.abc import AsyncIterator, Iterable
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any
 
 from bson import ObjectId
+from loguru import logger
 
 import RankingsAPI.Mongo.motor as motor
-
-from .data_models import EResult, Match, MatchAPISubmit, Player, PlayerAPI
+from RankingsAPI.Mongo import ensure_timezone_aware
+
+from .coordination import Coordinator, SharedVersions
+from .data_models import (
+    MATCH_API_FIELDS,
+    HeadToHead,
+    Match,
+    MatchAPISubmit,
+    MatchBatchResult,
+    Pairing,
+    Player,
+    PlayerAPI,
+    PlayerBase,
+    PlayerStats,
+    RatingHistory,
+    RatingHistoryAPI,
+    SimulatedPlayer,
+    SimulationResult,
+)
+from .engines import RatingEngine, build_engine, hidden_player_fields, rated_player_fields
+from .history import HistoryPoint, bucket_points, build_buckets, downsample, month_start
+from .ingest import IngestStats, MatchIngestQueue
+from .locks import RatingLocks
+from .matchmaking import WinProbabilityMatrix, suggest_pairings
+from .metrics import MATCHES_RATED, RECALCULATION_DURATION
+from .profiling import OperationProfiler
+from .replay import RatingCheckpoint, RatingState, expected_score, match_key
 from .settings import Settings
+from .stats import MatchStatistics
+
+__all__ = ["Manager", "Leaderboard", "encode_cursor", "decode_cursor", "sort_players", "mongo_client_kwargs"]
+
+#: The player fields that playing a match adds to
+RATING_FIELDS = ("rating", "wins", "losses", "draws")
+
+#: Every document type the manager stores, and so every collection that needs its indexes
+DOCUMENT_TYPES = (Player, Match, RatingHistory)
+
+
+def mongo_client_kwargs(config: Settings) -> dict[str, Any]:
+    """
+    The connection pool, timeout and compression options for the database client
+    """
+    kwargs: dict[str, Any] = {
+        "minPoolSize": config.mongo_min_pool_size,
+        "maxPoolSize": config.mongo_max_pool_size,
+        "maxIdleTimeMS": round(config.mongo_max_idle_time * 1000),
+        "serverSelectionTimeoutMS": round(config.mongo_server_selection_timeout * 1000),
+        "connectTimeoutMS": round(config.mongo_connect_timeout * 1000),
+        "socketTimeoutMS": round(config.mongo_socket_timeout * 1000) if config.mongo_socket_timeout else None,
+    }
+    if config.mongo_compressors:
+        kwargs["compressors"] = ",".join(config.mongo_compressors)
+    return kwargs
+
+
+def encode_cursor(date: datetime, match_id: ObjectId) -> str:
+    """
+    An opaque token for the position of a match in the (date, id) order of a match listing
+    """
+    date = ensure_timezone_aware(date)
+    return base64.urlsafe_b64encode(f"{date.isoformat()}|{match_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    """
+    Turn a cursor back into the (date, id) of the last match on the previous page. Raises ValueError if it is invalid.
+    """
+    try:
+        date, match_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(date), ObjectId(match_id)
+    except Exception as ex:
+        raise ValueError(f"Invalid cursor {cursor}") from ex
+
+
+def sort_players(players: Iterable[Player], sort_by: str) -> list[Player]:
+    """
+    Sort the players by one of their fields. Prefixing the field with an n (e.g. nrating) sorts it in descending order.
+    """
+    if sort_by in PlayerBase.__fields__:
+        return sorted(players, key=lambda player: getattr(player, sort_by))
+    if sort_by.startswith("n") and sort_by[1:] in PlayerBase.__fields__:
+        return sorted(players, key=lambda player: getattr(player, sort_by[1:]), reverse=True)
+    raise ValueError(f"Unknown sort_by {sort_by}")
 
-__all__ = ["Manager"]
+
+@dataclass
+class Leaderboard:
+    """
+    The already serialised response for GET /players
+    """
+
+    #: Goes up every time a player changes
+    version: int
+    #: Derived from the body, so it is stable across restarts and workers
+    etag: str
+    body: bytes
 
 
 class Manager:
@@ -17,86 +119,804 @@ class Manager:
 
     def __init__(self, config: Settings):
         self._config = config
-        self._motor_client = motor.connect(config.mongo)
+        #: Created by connect, rather than here, so it belongs to the event loop that the manager is used from
+        self._motor_client = None
+        #: Set when another league's manager opened the connection that this one uses
+        self._shares_connection = False
+        #: Whether the manager has connected and warmed up, so is ready to serve requests quickly
+        self.ready = False
+        self._engine: RatingEngine = build_engine(config)
+        #: Left out of the players the API returns, as the engine doesn't use them
+        self.hidden_player_fields = hidden_player_fields(config.rating_engine)
+        #: Snapshots of the rating state taken every checkpoint_interval matches during a replay, oldest first
+        self._checkpoints: list[RatingCheckpoint] = []
+        #: Every player, loaded on first use and kept up to date by every write that goes through the manager
+        self._players: dict[ObjectId, Player] | None = None
+        self.player_cache_hits = 0
+        self.player_cache_misses = 0
+        self.leaderboard_version = 0
+        self._leaderboard: Leaderboard | None = None
+        self._win_probabilities: WinProbabilityMatrix | None = None
+        #: Built from the match history on first use, then added to as matches are played
+        self._stats: MatchStatistics | None = None
+        #: Goes up every time a match is added, changed or deleted
+        self.match_version = 0
+        self._locks = RatingLocks()
+        #: Set when other workers share the database, and the shared versions that the caches are up to date with
+        self._coordinator: Coordinator | None = None
+        if config.coordinate_workers:
+            self._coordinator = Coordinator(
+                lease_duration=config.coordination_lease_duration, poll_interval=config.coordination_poll_interval
+            )
+        self._shared = SharedVersions()
+        self._ingest = MatchIngestQueue(self, batch_size=config.ingest_batch_size, batch_wait=config.ingest_batch_wait)
+        self.profiler: OperationProfiler | None = None
+        if config.profiling:
+            self.profiler = OperationProfiler(slow_threshold=config.slow_operation_threshold, keep=config.profiles_kept)
+            self.profiler.instrument(self)
+
+    @property
+    def database(self) -> str | None:
+        """
+        The database the manager's league is kept in, None for the one in the mongo config
+        """
+        return self._config.database
+
+    def connect(self):
+        """
+        Create the database client, with its pool configured from the settings. Does nothing if already connected. A
+        league kept in its own database uses the connection that is already open, so every league shares one pool.
+        """
+        if self._motor_client is not None or self._shares_connection:
+            return
+        if self._config.database and motor.is_connected():
+            self._shares_connection = True
+        else:
+            self._motor_client = motor.connect(self._config.mongo, **mongo_client_kwargs(self._config))
+
+    async def start(self):
+        """
+        Connect, open the pool's connections, create any missing indexes and fill the caches, so that the first requests
+        are as quick as the rest
+        """
+        if self.ready:
+            return
+        self.connect()
+        # the pool is warmed up by whoever opened it
+        connections = 1 if self._shares_connection else max(self._config.mongo_min_pool_size, 1)
+        with motor.use_database(self.database):
+            await asyncio.gather(*(motor.ping() for _ in range(connections)))
+            await self.ensure_indexes()
+            await self.get_leaderboard()
+            await self._match_statistics()
+            if not self._engine.incremental:
+                await self._take_checkpoints()
+        self.ready = True
+
+    async def close(self):
+        """
+        Commit any queued matches, then close every database connection, unless they are shared with other leagues
+        """
+        self.ready = False
+        await self._ingest.stop()
+        if self._motor_client is not None:
+            motor.disconnect()
+            self._motor_client = None
+        self._shares_connection = False
+
+    async def ensure_indexes(self) -> list[str]:
+        """
+        Create the indexes that the queries rely on. Indexes that already exist are left alone.
+        """
+        return await motor.ensure_indexes(DOCUMENT_TYPES)
+
+    async def missing_indexes(self) -> dict[str, list[list[tuple[str, int]]]]:
+        """
+        The indexes that the queries rely on that haven't been created yet, by collection
+        """
+        return await motor.missing_indexes(DOCUMENT_TYPES)
+
+    async def _sync(self, force: bool = False):
+        """
+        When other workers share the database, drop whatever the caches hold that they have since changed. The shared
+        versions are only read again once they are older than the poll interval, unless forced.
+        """
+        if self._coordinator is not None:
+            self._catch_up(await self._coordinator.versions(force=force))
+
+    def _catch_up(self, versions: SharedVersions):
+        if versions.players > self._shared.players:
+            self._shared.players = versions.players
+            self._players = None
+            self._players_changed()
+        if versions.matches > self._shared.matches:
+            self._shared.matches = versions.matches
+            self._stats = None
+            # we can't tell where the other worker's changes were, so none of the checkpoints can be trusted
+            self._checkpoints = []
+            self.match_version += 1
+
+    @asynccontextmanager
+    async def _writing(self, lock: AbstractAsyncContextManager) -> AsyncIterator[None]:
+        """
+        Hold one of the rating locks and, when other workers share the database, the rating lease too. The caches are
+        brought up to date before writing, and the other workers are told about whatever was changed.
+        """
+        async with lock:
+            if self._coordinator is None:
+                yield
+                return
+
+            async with self._coordinator.lease():
+                await self._sync(force=True)
+                leaderboard_version, match_version = self.leaderboard_version, self.match_version
+                try:
+                    yield
+                finally:
+                    players = self.leaderboard_version != leaderboard_version
+                    matches = self.match_version != match_version
+                    if players or matches:
+                        versions = await self._coordinator.publish(players=players, matches=matches)
+                        self._shared.players += players
+                        self._shared.matches += matches
+                        # anything beyond our own changes was written by something not holding the lease
+                        self._catch_up(versions)
+
+    async def _player_cache(self) -> dict[ObjectId, Player]:
+        await self._sync()
+        if self._players is not None:
+            self.player_cache_hits += 1
+            return self._players
+
+        while self._players is None:
+            self.player_cache_misses += 1
+            version = self.leaderboard_version
+            players = {player.id: player for player in await motor.find(Player).trusted().to_list(None)}
+            # if a player was written while we were reading, then what we read may already be out of date
+            if version == self.leaderboard_version:
+                self._players = players
+        return self._players
+
+    def _cache_players(self, players: list[Player]):
+        """
+        Update the cache with players that have just been written. Copies are stored so callers can't change the cache.
+        """
+        if self._players is not None:
+            for player in players:
+                self._players[player.id] = player.copy()  # type: ignore
+        self._players_changed()
+
+    def _players_changed(self):
+        self.leaderboard_version += 1
+        self._leaderboard = None
+
+    async def _match_statistics(self) -> MatchStatistics:
+        await self._sync()
+        while self._stats is None:
+            version = self.match_version
+            stats = MatchStatistics.build(await self.get_matches_in_order())
+            # if a match was played while we were reading, then it may be missing
+            if version == self.match_version:
+                self._stats = stats
+        return self._stats
+
+    def _matches_changed(self, added: list[Match] | None = None, history: list[Match] | None = None):
+        """
+        Keep the match statistics up to date. Newly played matches are added to them, while anything else that changed
+        the history means they are rebuilt; from the whole history if it is given, otherwise on next use.
+        """
+        self.match_version += 1
+        if history is not None:
+            self._stats = MatchStatistics.build(history)
+        elif added is None or (self._stats is not None and not self._stats.add(added)):
+            self._stats = None
+
+    def invalidate_player_cache(self):
+        """
+        Forget the cached players, so they are reloaded from the database the next time they are needed
+        """
+        self._players = None
+        self._players_changed()
 
     async def get_players(self) -> dict[ObjectId, Player]:
-        player_list = await motor.find(Player).to_list(None)
-        players = {player.id: player for player in player_list}
-        return players
+        players = await self._player_cache()
+        return {player_id: player.copy() for player_id, player in players.items()}
+
+    async def get_leaderboard(self) -> Leaderboard:
+        """
+        Every player, sorted by Settings.sort_by and serialised ready to send. Only rebuilt after a player changes.
+        """
+        await self._sync()
+        if self._leaderboard is None:
+            version = self.leaderboard_version
+            players = sort_players((await self._player_cache()).values(), self._config.sort_by)
+            body = (
+                "[" + ",".join(player.to_api().json(exclude=self.hidden_player_fields) for player in players) + "]"
+            ).encode()
+            # the shared version is the same on every worker
+            shared_version = self._shared.players if self._coordinator else version
+            leaderboard = Leaderboard(version=shared_version, etag=f'"{hashlib.sha1(body).hexdigest()}"', body=body)
+            # don't keep it if a player changed while it was being built
+            if version != self.leaderboard_version:
+                return leaderboard
+            self._leaderboard = leaderboard
+        return self._leaderboard
+
+    async def get_win_probabilities(self) -> WinProbabilityMatrix:
+        """
+        The chance of every active player beating every other one. Only worked out again after a player changes.
+        """
+        await self._sync()
+        matrix = self._win_probabilities
+        if matrix is None or matrix.version != self.leaderboard_version:
+            version = self.leaderboard_version
+            players = sort_players((await self._player_cache()).values(), self._config.sort_by)
+            matrix = WinProbabilityMatrix.build([player for player in players if player.active], self._engine, version)
+            # don't keep it if a player changed while it was being built
+            if version == self.leaderboard_version:
+                self._win_probabilities = matrix
+        return matrix
+
+    async def suggest_pairings(
+        self, player_ids: list[ObjectId] | None = None, not_since: datetime | None = None
+    ) -> list[Pairing]:
+        """
+        Pair up the active players (or only those given) so that the matches are as even as possible
+
+        :param not_since: Don't pair players who have played each other since then
+        """
+        matrix = await self.get_win_probabilities()
+        stats = await self._match_statistics()
+        return suggest_pairings(
+            matrix,
+            stats.last_met,
+            present=player_ids,
+            not_since=ensure_timezone_aware(not_since) if not_since else None,
+        )
+
+    async def get_player_names(self, player_ids: set[ObjectId]) -> dict[ObjectId, str]:
+        """
+        Look up the names of many players from the cache, any that aren't in it are fetched with a single query
+        """
+        players = await self._player_cache()
+        names = {player_id: players[player_id].name for player_id in player_ids if player_id in players}
+
+        missing = player_ids - names.keys()
+        if missing:
+            self.player_cache_misses += 1
+            fetched = await motor.find(Player, id__in=list(missing)).to_list(None)
+            self._cache_players(fetched)
+            names.update({player.id: player.name for player in fetched})
+        return names
+
+    async def get_matches_resolved(self, player_id: ObjectId | None = None) -> list[dict[str, Any]]:
+        """
+        Every match (or every match a player played) as json ready MatchAPIReturnResolved dictionaries, built straight
+        from the mongo documents. The names of all the players involved are looked up in one go.
+        """
+        query_filter = {"result": player_id} if player_id else None
+        docs = await motor.find(Match, query_filter, projection=MATCH_API_FIELDS).as_dicts().to_list(None)
+        names = await self.get_player_names({player_id for doc in docs for player_id in doc["result"]})
+
+        ret = []
+        for doc in docs:
+            missing = [player_id for player_id in doc["result"] if player_id not in names]
+            if missing:
+                raise ValueError(f"Could not find {Player} with id {missing[0]}")
+
+            d = Match.mongo_to_api(doc)
+            d["winner_name"] = names[doc["result"][0]]
+            d["loser_name"] = names[doc["result"][1]]
+            ret.append(d)
+        return ret
+
+    def iter_players(self) -> AsyncIterator[Player]:
+        """
+        Stream every player from the database, export_batch_size at a time
+        """
+        return aiter(motor.find(Player).trusted().batch_size(self._config.export_batch_size))
+
+    async def iter_matches(self) -> AsyncIterator[dict[str, Any]]:
+        """
+        Stream every match from the database as json ready MatchAPIReturn dictionaries, oldest first,
+        export_batch_size at a time
+        """
+        cursor = (
+            motor.find(Match, projection=MATCH_API_FIELDS)
+            .as_dicts()
+            .sort([("date", 1), ("_id", 1)])
+            .batch_size(self._config.export_batch_size)
+        )
+        async for doc in cursor:
+            yield Match.mongo_to_api(doc)
 
     async def get_matches(self) -> list[Match]:
-        matches = await motor.find(Match).to_list(None)
-        return copy.deepcopy(matches)
+        return await motor.find(Match).to_list(None)
+
+    async def get_matches_page(
+        self,
+        limit: int,
+        cursor: str | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+        player_id: ObjectId | None = None,
+    ) -> tuple[list[dict[str, Any]], str | None]:
+        """
+        Get one page of matches, newest first, as json ready MatchAPIReturn dictionaries, along with the cursor for the
+        next page (None if this is the last one). The filters and the paging are done by the database, so only the rows
+        on the page are read.
+
+        :param since: Only matches on or after this date
+        :param until: Only matches before this date
+        """
+        query_filter: dict = {}
+        if since or until:
+            query_filter["date"] = {}
+            if since:
+                query_filter["date"]["$gte"] = since
+            if until:
+                query_filter["date"]["$lt"] = until
+        if player_id:
+            query_filter["result"] = player_id
+        if cursor:
+            date, match_id = decode_cursor(cursor)
+            query_filter["$or"] = [{"date": {"$lt": date}}, {"date": date, "_id": {"$lt": match_id}}]
+
+        docs = await (
+            motor.find(Match, query_filter, projection=MATCH_API_FIELDS)
+            .as_dicts()
+            .sort([("date", -1), ("_id", -1)])
+            .limit(limit + 1)
+            .to_list(None)
+        )
 
-    async def get_matches_by_player(self, player_id: ObjectId) -> list[Match]:
-        matches = await motor.find(Match, {"result": player_id}).to_list(None)
-        return copy.deepcopy(matches)
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = encode_cursor(docs[-1]["date"], docs[-1]["_id"])
+        return [Match.mongo_to_api(doc) for doc in docs], next_cursor
 
-    async def recalculate_rankings(self):
+    async def get_matches_by_player(self, player_id: ObjectId) -> list[Match]:
+        return await motor.find(Match, {"result": player_id}).to_list(None)
+
+    async def get_matches_in_order(self, after: RatingCheckpoint | None = None) -> list[Match]:
+        """
+        Get every match, oldest first, with only the fields needed to replay the rankings. If a checkpoint is given then
+        only the matches after it are returned.
+        """
+        query_filter = {"date": {"$gte": after.date}} if after else None
+        cursor = (
+            motor.find(
+                Match,
+                query_filter,
+                projection=["result", "draw", "date", "winner_rating", "loser_rating", "probability"],
+            )
+            .trusted()
+            .sort([("date", 1), ("_id", 1)])
+        )
+        matches = await cursor.to_list(None)
+
+        if after:
+            matches = [match for match in matches if match_key(match) > after.key]
+        return matches
+
+    async def recalculate_rankings(self, since: Match | None = None):
+        """
+        Rebuild the ratings by replaying the match history in memory, then write back only what changed. If the
+        earliest affected match is given, then the replay starts from the latest checkpoint before it rather than from
+        the first match ever played.
+        """
+        async with self._writing(self._locks.everything()):
+            await self._recalculate_rankings(since)
+
+    async def _recalculate_rankings(self, since: Match | None):
+        start = time.perf_counter()
         players = await self.get_players()
-        for player in players.values():
-            player.reset()
-            await motor.update_one(player)
 
-        matches = await self.get_matches()
+        checkpoint = self._checkpoint_before(self._engine.replay_from(match_key(since))) if since else None
+        if checkpoint:
+            state = checkpoint.restore(players.values())
+            match_index = checkpoint.match_index
+            self._checkpoints = self._checkpoints[: self._checkpoints.index(checkpoint) + 1]
+        else:
+            state = RatingState(players.values())
+            match_index = 0
+            self._checkpoints = []
+
+        matches = await self.get_matches_in_order(after=checkpoint)
+
+        history: list[HistoryPoint] = []
+        changed_matches = self._replay(state, matches, match_index, history=history)
+
+        changed_players = state.apply_to(players)
+
+        await motor.bulk_update(changed_players)
+        self._cache_players(changed_players)
+        await motor.bulk_update(changed_matches)
+        self._matches_changed(history=None if checkpoint else matches)
+        await self._rewrite_history(history, after=checkpoint)
+
+        RECALCULATION_DURATION.observe(time.perf_counter() - start, kind="partial" if checkpoint else "full")
+        MATCHES_RATED.inc(len(matches), source="replay")
+
+    def _replay(
+        self, state: RatingState, matches: list[Match], match_index: int, history: list[HistoryPoint] | None = None
+    ) -> list[Match]:
+        """
+        Rate the matches against the state, taking a checkpoint every checkpoint_interval matches. Returns the matches
+        whose ratings changed.
+
+        :param match_index: How many matches were rated before the first of these
+        """
+        interval = self._config.checkpoint_interval
+        changed_matches = []
+        for chunk in self._engine.chunks(matches, interval):
+            changed_matches += self._engine.update(state, chunk, history=history)
+            match_index += len(chunk)
+            if len(chunk) >= interval:
+                self._checkpoints.append(RatingCheckpoint.take(state, chunk[-1], match_index))
+        return changed_matches
+
+    async def _take_checkpoints(self):
+        """
+        Replay the history in memory, writing nothing, just to take the checkpoints. Otherwise an engine that isn't
+        incremental replays the whole history for every match added until the first recalculation.
+        """
+        async with self._locks.everything():
+            players = await self.get_players()
+            self._checkpoints = []
+            self._replay(RatingState(players.values()), await self.get_matches_in_order(), 0)
+
+    async def _rewrite_history(self, points: list[HistoryPoint], after: RatingCheckpoint | None):
+        """
+        Replace the rating history from the checkpoint onwards (or all of it) with the points from a replay. The
+        buckets for the months the replay covers are rewritten whole, keeping the points from before the checkpoint.
+        """
+        if after:
+            first_month = month_start(after.date)
+            kept = [
+                point
+                for bucket in await motor.find(RatingHistory, month__gte=first_month).trusted().to_list(None)
+                for point in bucket_points(bucket)
+                if (ensure_timezone_aware(point[1]), point[3]) <= after.key
+            ]
+            await motor.delete_many(RatingHistory, month__gte=first_month)
+        else:
+            kept = []
+            await motor.delete_many(RatingHistory)
+
+        buckets = build_buckets(kept + points)
+        if buckets:
+            await motor.insert_many(buckets)  # type: ignore
+
+    async def _record_history(self, points: list[HistoryPoint]):
+        """
+        Add the points for newly played matches onto the end of their history buckets
+        """
+        await motor.bulk_append(
+            build_buckets(points), key_fields=["player", "month"], append_fields=["dates", "ratings", "match_ids"]
+        )
 
-        for match in matches:
-            await self.add_match(match, insert=False)
+    async def get_rating_history(
+        self, player_id: ObjectId, since: datetime | None = None, resolution: str = "match"
+    ) -> RatingHistoryAPI:
+        """
+        A player's rating after each match, oldest first, reduced to one point per day, week or month by the
+        resolution. Raises ValueError for an unknown resolution.
+        """
+        await self.get_player(player_id)
+
+        query_filter = {"month": {"$gte": month_start(since)}} if since else None
+        buckets = await motor.find(RatingHistory, query_filter, player=player_id).trusted().to_list(None)
+        points = sorted(
+            (
+                (ensure_timezone_aware(date), match_id, rating)
+                for bucket in buckets
+                for date, rating, match_id in zip(bucket.dates, bucket.ratings, bucket.match_ids, strict=True)
+            ),
+            key=lambda point: point[:2],
+        )
+        if since:
+            since = ensure_timezone_aware(since)
+            points = [point for point in points if point[0] >= since]
+
+        return RatingHistoryAPI(
+            player_id=str(player_id),
+            resolution=resolution,
+            points=downsample([(date, rating) for date, _, rating in points], resolution),
+        )
+
+    async def rescore(self, engine: str) -> list[Player]:
+        """
+        Replay the whole match history under another rating engine, e.g. to compare it with the one in use. Nothing is
+        written, the players are returned with the ratings they would have, sorted by Settings.sort_by. Raises
+        ValueError for an unknown engine.
+        """
+        rating_engine = build_engine(self._config, engine)
+        players = await self.get_players()
+        state = RatingState(players.values())
+        rating_engine.update(state, await self.get_matches_in_order())
+        state.apply_to(players)
+        return sort_players(players.values(), self._config.sort_by)
+
+    def _checkpoint_before(self, key: tuple[datetime, ObjectId]) -> RatingCheckpoint | None:
+        """
+        The latest checkpoint that was taken strictly before the given match position
+        """
+        i = bisect.bisect_left([checkpoint.key for checkpoint in self._checkpoints], key)
+        return self._checkpoints[i - 1] if i else None
+
+    def _invalidate_checkpoints(self, key: tuple[datetime, ObjectId]):
+        """
+        Drop the checkpoints that a change at the given match position makes stale
+        """
+        checkpoint = self._checkpoint_before(key)
+        self._checkpoints = self._checkpoints[: self._checkpoints.index(checkpoint) + 1] if checkpoint else []
 
     async def recalculate_last_matches(self):
+        async with self._writing(self._locks.everything()):
+            with RECALCULATION_DURATION.time(kind="last_matches"):
+                await self._recalculate_last_matches()
+
+    async def _recalculate_last_matches(self):
         players = await self.get_players()
-        matches = await self.get_matches()
-
-        for player in players.values():
-            player.last_match_date = None
-            for match in matches:
-                if player.id in match.result:
-                    if player.last_match_date is None or match.date > player.last_match_date:
-                        player.last_match_date = match.date
-            await motor.update_one(player)
+        matches = await motor.find(Match, projection=["result", "draw", "date"]).to_list(None)
+
+        last_match_dates = {}
+        for match in matches:
+            for player_id in match.result:
+                if player_id not in last_match_dates or match.date > last_match_dates[player_id]:
+                    last_match_dates[player_id] = match.date
+
+        for player_id, player in players.items():
+            player.last_match_date = last_match_dates.get(player_id)
+
+        await motor.bulk_update(list(players.values()))
+        self._cache_players(list(players.values()))
 
     async def delete_player(self, player_id: ObjectId):
-        player = await self.get_player(player_id)
+        async with self._writing(self._locks.everything()):
+            await self._delete_player(player_id)
 
-        matches = await self.get_matches()
-        for match in matches:
-            if player.id in match.result:
-                await motor.delete_one(match)
+    async def _delete_player(self, player_id: ObjectId):
+        player = await self.get_player(player_id)
 
+        first_match = await (
+            motor.find(Match, {"result": player.id}, projection=["result", "draw", "date"])
+            .sort([("date", 1), ("_id", 1)])
+            .limit(1)
+            .to_list(None)
+        )
+        await motor.delete_many(Match, result=player.id)
+        await motor.delete_many(RatingHistory, player=player.id)
         await motor.delete_one(player)
-        await self.recalculate_rankings()
+        if self._players is not None:
+            self._players.pop(player.id, None)
+        self._players_changed()
+
+        if first_match:
+            await self._recalculate_rankings(since=first_match[0])
 
     async def add_player(self, player: PlayerAPI) -> Player:
         db_player = Player(**player.dict())
-        await motor.insert_one(db_player)
+        async with self._writing(self._locks.players()):
+            await motor.insert_one(db_player)
+            self._cache_players([db_player])
         return db_player
 
     async def update_player(self, player: PlayerAPI) -> Player:
         _id = ObjectId(player.id)
-        existing_player = await self.get_player(_id)
+        async with self._writing(self._locks.players(_id)):
+            existing_player = await self.get_player(_id)
 
-        for key, value in player.dict().items():
-            if key != "id":
+            # the engine's own fields are left to it, as the API doesn't always return them to be sent back
+            for key, value in player.dict(exclude={"id", *rated_player_fields()}).items():
                 setattr(existing_player, key, value)
 
-        await motor.update_one(existing_player)
+            await motor.update_one(existing_player)
+            self._cache_players([existing_player])
         return existing_player
 
     async def get_player(self, player_id: ObjectId) -> Player:
-        return await motor.get_from_id(Player, id=player_id)
+        players = await self._player_cache()
+        if player_id not in players:
+            # it may have been added by something other than this manager
+            self.player_cache_misses += 1
+            self._cache_players([await motor.get_from_id(Player, id=player_id)])
+        return players[player_id].copy()
+
+    async def get_player_stats(self, player_id: ObjectId) -> PlayerStats:
+        await self.get_player(player_id)
+        return (await self._match_statistics()).player_stats(player_id)
+
+    async def get_head_to_head(self, player_a: ObjectId, player_b: ObjectId) -> HeadToHead:
+        """
+        The record of every match the two players have played against each other. Raises ValueError if they are the
+        same player.
+        """
+        if player_a == player_b:
+            raise ValueError("A player can't play against themselves")
+        await self.get_player(player_a)
+        await self.get_player(player_b)
+        return (await self._match_statistics()).head_to_head(player_a, player_b)
 
     async def get_match(self, match_id: ObjectId) -> Match:
         return await motor.get_from_id(Match, id=match_id)
 
     async def set_active(self, player_id: ObjectId, active: bool):
-        player = await self.get_player(player_id)
-        player.active = active
-        await motor.update_one(player)
+        async with self._writing(self._locks.players(player_id)):
+            player = await self.get_player(player_id)
+            player.active = active
+            await motor.update_one(player)
+            self._cache_players([player])
 
     async def delete_match(self, match_id: ObjectId):
-        match = await self.get_match(match_id)
-        await motor.delete_one(match)
-        await self.recalculate_rankings()
+        async with self._writing(self._locks.everything()):
+            match = await self.get_match(match_id)
+            await motor.delete_one(match)
+            await self._recalculate_rankings(since=match)
+
+    async def check_match(self, match: Match):
+        """
+        Raises ValueError unless the match is between two different players who exist
+        """
+        if len(match.result) != 2 or match.result[0] == match.result[1]:
+            raise ValueError("We need 2 different people in a match")
+        for player_id in match.result:
+            await self.get_player(player_id)
+
+    async def submit_match(self, match: MatchAPISubmit, wait: bool = True) -> Match:
+        """
+        Check a submitted match and queue it to be committed with whatever else has been submitted. If wait is False,
+        then the match is returned as soon as it is queued; it already has its id, but not its ratings.
+        """
+        db_match = Match.from_api(match)
+        await self.check_match(db_match)
+
+        db_match.id = ObjectId()
+        future = self._ingest.submit(db_match)
+        if not wait:
+            # failures are logged by the writer, nobody is waiting to hear about them
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return db_match
+        return await future
+
+    @property
+    def ingest_stats(self) -> IngestStats:
+        return self._ingest.stats
+
+    async def add_match_batch(self, submissions: list[MatchAPISubmit]) -> list[MatchBatchResult]:
+        """
+        Add many matches at once, e.g. when importing score sheets. Every player is checked with one lookup, and the
+        valid matches are committed together. If any of them are older than the latest match we already have, then the
+        ratings are replayed from the oldest of them. The results are in the same order as the submissions.
+        """
+        results = [MatchBatchResult(index=i) for i in range(len(submissions))]
+
+        matches: dict[int, Match] = {}
+        for i, submission in enumerate(submissions):
+            try:
+                match = Match.from_api(submission)
+            except Exception as ex:
+                results[i].error = f"Invalid match: {ex}"
+                continue
+            if len(match.result) != 2 or match.result[0] == match.result[1]:
+                results[i].error = "We need 2 different people in a match"
+                continue
+            matches[i] = match
+
+        names = await self.get_player_names({player_id for match in matches.values() for player_id in match.result})
+        for i, match in list(matches.items()):
+            missing = [player_id for player_id in match.result if player_id not in names]
+            if missing:
+                results[i].error = f"Could not find {Player} with id {missing[0]}"
+                del matches[i]
+
+        if matches:
+            await self._add_match_batch(list(matches.values()))
+            for i, match in matches.items():
+                results[i].match = match.to_api()
+        return results
+
+    async def _latest_match(self) -> Match | None:
+        latest = await (
+            motor.find(Match, projection=["result", "draw", "date"])
+            .trusted()
+            .sort([("date", -1), ("_id", -1)])
+            .limit(1)
+            .to_list(1)
+        )
+        return latest[0] if latest else None
+
+    async def _add_match_batch(self, matches: list[Match]) -> list[Match]:
+        latest = await self._latest_match()
+        oldest = min(matches, key=lambda match: ensure_timezone_aware(match.date))
+
+        if not latest or ensure_timezone_aware(oldest.date) >= ensure_timezone_aware(latest.date):
+            return await self.add_matches(matches)
+
+        # they go before matches we already have, so those have to be replayed too
+        return await self._insert_and_replay(matches)
+
+    async def simulate(self, submissions: list[MatchAPISubmit]) -> SimulationResult:
+        """
+        Work out how hypothetical matches would change the ratings and the leaderboard, without writing anything.
+        Matches after the latest one are rated on top of the current ratings. Backdated ones are replayed in memory,
+        along with every match after them, from the checkpoint before them. Raises ValueError if a match is invalid.
+        """
+        matches = []
+        for submission in submissions:
+            match = Match.from_api(submission)
+            if len(match.result) != 2 or match.result[0] == match.result[1]:
+                raise ValueError("We need 2 different people in a match")
+            match.id = ObjectId()
+            matches.append(match)
+        if not matches:
+            raise ValueError("There are no matches to simulate")
+        matches.sort(key=match_key)
+
+        players = await self.get_players()
+        missing = [player_id for match in matches for player_id in match.result if player_id not in players]
+        if missing:
+            raise ValueError(f"Could not find {Player} with id {missing[0]}")
+
+        replay_from = self._engine.replay_from(match_key(matches[0]))
+        latest = await self._latest_match()
+        if self._engine.incremental and (latest is None or match_key(latest) < replay_from):
+            state = RatingState(players.values(), reset=False)
+            replayed = []
+        else:
+            checkpoint = self._checkpoint_before(replay_from)
+            state = checkpoint.restore(players.values()) if checkpoint else RatingState(players.values())
+            replayed = await self.get_matches_in_order(after=checkpoint)
+        self._engine.update(state, sorted(replayed + matches, key=match_key))
+
+        simulated = {player_id: player.copy() for player_id, player in players.items()}
+        state.apply_to(simulated)
+        ranks_before = self._ranks(players.values())
+        ranks_after = self._ranks(simulated.values())
+
+        changed = [
+            SimulatedPlayer(
+                id=str(player_id),
+                name=player.name,
+                rating_before=players[player_id].rating,
+                rating_after=player.rating,
+                rating_change=player.rating - players[player_id].rating,
+                rank_before=ranks_before[player_id],
+                rank_after=ranks_after[player_id],
+            )
+            for player_id, player in simulated.items()
+            if player.rating != players[player_id].rating or ranks_before[player_id] != ranks_after[player_id]
+        ]
+        return SimulationResult(
+            matches=[match.to_api() for match in matches],
+            players=sorted(changed, key=lambda player: player.rank_after),
+            replayed_matches=len(replayed),
+        )
+
+    def _ranks(self, players: Iterable[Player]) -> dict[ObjectId, int]:
+        return {player.id: i + 1 for i, player in enumerate(sort_players(players, self._config.sort_by))}  # type: ignore
+
+    async def _insert_and_replay(self, matches: list[Match], insert: bool = True) -> list[Match]:
+        """
+        Commit the matches, then replay the ratings from the oldest of them
+        """
+        oldest = min(matches, key=lambda match: ensure_timezone_aware(match.date))
+        async with self._writing(self._locks.everything()):
+            if insert:
+                await motor.insert_many(matches)  # type: ignore
+            else:
+                await motor.bulk_update(matches)  # type: ignore
+            await self._recalculate_rankings(since=oldest)
+            replayed = {
+                match.id: match for match in await motor.find(Match, id__in=[m.id for m in matches]).to_list(None)
+            }
+        for match in matches:
+            match.winner_rating = replayed[match.id].winner_rating
+            match.loser_rating = replayed[match.id].loser_rating
+            match.probability = replayed[match.id].probability
+        return matches
 
     async def add_match(self, match: MatchAPISubmit | Match, insert: bool = True) -> Match:
         if isinstance(match, MatchAPISubmit):
@@ -104,62 +924,69 @@ class Manager:
         else:
             db_match = match
 
-        await self._apply_points(db_match)
-
-        if insert:
-            await motor.insert_one(db_match)
-        else:
-            await motor.update_one(db_match)
-
+        await self.add_matches([db_match], insert=insert)
         return db_match
 
-    async def _apply_points(self, match: Match):
-        assert len(match.result) == 2, "We need 2 people in a match"
-
-        winner = await motor.get_from_id(Player, match.result[0])
-        loser = await motor.get_from_id(Player, match.result[1])
-
-        # these changes are saved when we call _adjust_player_stats
-        winner.last_match_date = match.date
-        loser.last_match_date = match.date
-
-        expected_result = self.expected_score(winner.rating, loser.rating)
-
-        match.winner_rating = winner.rating
-        match.loser_rating = loser.rating
-        match.probability = expected_result
-
-        await self._adjust_player_stats(
-            winner, expected_result=expected_result, result=EResult.DRAW if match.draw else EResult.WIN
-        )
-        await self._adjust_player_stats(
-            loser, expected_result=expected_result, result=EResult.DRAW if match.draw else EResult.LOSE
-        )
+    async def add_matches(self, matches: list[Match], insert: bool = True) -> list[Match]:
+        """
+        Apply a batch of matches in date order and commit them together, with one write for the matches and one for
+        the players, however many matches there are. The matches are written first, and if writing the players or their
+        history then fails, the ratings are replayed from the matches.
+        """
+        # they are given their ids now, so the rating history can refer to them
+        for match in matches:
+            if match.id is None:
+                match.id = ObjectId()
+
+        if not self._engine.incremental:
+            # the matches can't be rated on their own, so the ones around them are replayed too
+            return await self._insert_and_replay(matches, insert=insert)
+
+        matches = sorted(matches, key=lambda match: ensure_timezone_aware(match.date))
+        player_ids = {player_id for match in matches for player_id in match.result}
+
+        saved = False
+        try:
+            # the players' ratings are read, updated and written back without anything else touching them
+            async with self._writing(self._locks.players(*player_ids)):
+                players = {player_id: await self.get_player(player_id) for player_id in player_ids}
+                before = {player_id: player.copy() for player_id, player in players.items()}
+
+                state = RatingState(players.values(), reset=False)
+                history: list[HistoryPoint] = []
+                self._engine.update(state, matches, history=history)
+                MATCHES_RATED.inc(len(matches), source="live")
+                state.apply_to(players)
+
+                # the matches are written first, so whatever else fails to be written can be rebuilt from them
+                if insert:
+                    await motor.insert_many(matches)  # type: ignore
+                else:
+                    await motor.bulk_update(matches)  # type: ignore
+                saved = True
+                # a match that is being updated is already in the statistics and the history
+                self._matches_changed(added=matches if insert else None)
+                if matches:
+                    self._invalidate_checkpoints(match_key(matches[0]))
+
+                # the database adds the changes on, so nothing is lost even if another process updated the players too
+                increments = [
+                    (player, {key: getattr(player, key) - getattr(before[player_id], key) for key in RATING_FIELDS})
+                    for player_id, player in players.items()
+                ]
+                await motor.bulk_increment(increments, set_fields=["last_match_date"])
+                self._cache_players(list(players.values()))
+                if insert:
+                    await self._record_history(history)
+        except Exception:
+            if not saved:
+                raise
+            logger.exception("Rating {} saved matches failed part way, so they are replayed", len(matches))
+            self.invalidate_player_cache()
+            await self.recalculate_rankings(since=matches[0])
+
+        return matches
 
     @staticmethod
     def expected_score(rating_a: float, rating_b: float) -> float:
-        return 1.0 / (1 + 10 ** ((rating_b - rating_a) / 400.0))
-
-    async def _adjust_player_stats(self, player: Player, expected_result: float, result: EResult):
-        k = max((self._config.initial_k - player.match_count), self._config.standard_k)
-        if result == EResult.DRAW:
-            score_change = 0.5 - expected_result
-        else:
-            score_change = 1 - expected_result
-
-        adjustment = k * score_change
-
-        match result:
-            case EResult.WIN:
-                player.rating += adjustment
-                player.wins += 1
-            case EResult.LOSE:
-                player.rating -= adjustment
-                player.losses += 1
-            case EResult.DRAW:
-                player.rating += adjustment
-                player.draws += 1
-            case _:
-                raise RuntimeError("unknown result")
-
-        await motor.update_one(player)
+        return expected_score(rating_a, rating_b)
@@ -0,0 +1,94 @@
+"""
+matchmaking.py: The chance of every active player beating every other one, and balanced pairings built from it
+"""
+
+import json
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime
+
+from bson import ObjectId
+
+from .data_models import Pairing, Player
+from .engines import RatingEngine
+from .Mongo import ensure_timezone_aware
+from .replay import RatingState
+
+__all__ = ["WinProbabilityMatrix", "suggest_pairings"]
+
+
+@dataclass
+class WinProbabilityMatrix:
+    """
+    Built once per version of the ratings, with every pair of players ranked by how even a match between them would be
+    """
+
+    #: The Manager.leaderboard_version it was built from
+    version: int
+    ids: list[ObjectId]
+    names: list[str]
+    #: probabilities[i][j] is the chance of player i beating player j
+    probabilities: list[list[float]]
+    #: Every pair (i, j) with i < j, the most even first
+    pairs: list[tuple[int, int]]
+    #: The already serialised WinProbabilities response
+    body: bytes
+
+    @classmethod
+    def build(cls, players: list[Player], engine: RatingEngine, version: int) -> "WinProbabilityMatrix":
+        """
+        :param players: The players to include, in the order they should be listed
+        """
+        probabilities = engine.expected_matrix(RatingState(players, reset=False))
+        count = len(players)
+        pairs = sorted(
+            ((i, j) for i in range(count) for j in range(i + 1, count)),
+            key=lambda pair: abs(probabilities[pair[0]][pair[1]] - 0.5),
+        )
+
+        ids: list[ObjectId] = [player.id for player in players]  # type: ignore
+        names = [player.name for player in players]
+        body = json.dumps(
+            {"player_ids": [str(player_id) for player_id in ids], "names": names, "probabilities": probabilities}
+        ).encode()
+        return cls(version=version, ids=ids, names=names, probabilities=probabilities, pairs=pairs, body=body)
+
+
+def suggest_pairings(
+    matrix: WinProbabilityMatrix,
+    last_met: dict[tuple[ObjectId, ObjectId], datetime],
+    *,
+    present: Iterable[ObjectId] | None = None,
+    not_since: datetime | None = None,
+) -> list[Pairing]:
+    """
+    Pair up the players so the matches are as even as possible, greedily taking the most even pair that is left. With
+    an odd number of players, somebody sits out.
+
+    :param last_met: When each pair of players (keyed by their ids in sorted order) last played each other
+    :param present: Only pair these players, defaults to every player in the matrix
+    :param not_since: Don't pair players who have played each other since then
+    """
+    ids = matrix.ids
+    if present is None:
+        available = set(range(len(ids)))
+    else:
+        present = set(present)
+        available = {i for i, player_id in enumerate(ids) if player_id in present}
+
+    pairings = []
+    for i, j in matrix.pairs:
+        if i not in available or j not in available:
+            continue
+        key = (ids[i], ids[j]) if ids[i] < ids[j] else (ids[j], ids[i])
+        met = last_met.get(key)
+        if not_since is not None and met is not None and ensure_timezone_aware(met) >= not_since:
+            continue
+
+        available -= {i, j}
+        pairings.append(
+            Pairing(player_a=str(ids[i]), player_b=str(ids[j]), probability=matrix.probabilities[i][j], last_met=met)
+        )
+        if len(available) < 2:
+            break
+    return pairings
@@ -0,0 +1,301 @@
+"""
+metrics.py: Counters and latency histograms for the API, the database and the rating replays, served at /metrics in the
+Prometheus text format. Recording a value is a dictionary lookup and a few additions, so they are always on.
+"""
+
+import bisect
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+
+import RankingsAPI.Mongo.motor as motor
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "REGISTRY",
+    "MetricsMiddleware",
+    "CONTENT_TYPE",
+    "HTTP_REQUEST_DURATION",
+    "MONGO_OPERATION_DURATION",
+    "MONGO_OPERATION_ERRORS",
+    "RECALCULATION_DURATION",
+    "MATCHES_RATED",
+    "INGEST_BATCH_DURATION",
+    "INGEST_MATCHES",
+    "INGEST_FAILED_BATCHES",
+    "INGEST_QUEUE_DEPTH",
+]
+
+#: The charset is added by the response
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+#: In seconds. Requests and replays range from a cached response to replaying the whole history.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+#: In seconds. A single database round-trip should be well under a millisecond on a local mongod.
+MONGO_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values, strict=True)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", *self.samples()]
+
+
+class Counter(_Metric):
+    """
+    A total that only goes up, e.g. the number of matches rated
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. It can be read from a function when the metrics are rendered, rather than set.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+        self._functions: dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels: str):
+        self._functions[self._key(labels)] = function
+
+    def value(self, **labels: str) -> float:
+        key = self._key(labels)
+        return self._functions[key]() if key in self._functions else self._values.get(key, 0)
+
+    def samples(self) -> Iterator[str]:
+        values = {**self._values, **{key: function() for key, function in self._functions.items()}}
+        for key, value in values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """
+    How values, usually durations in seconds, are distributed between the bucket bounds
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        #: For each set of labels, the count in each bucket (not cumulative, the last is +Inf), then the sum
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self._values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        key = self._key(labels)
+        return sum(self._values[key][0]) if key in self._values else 0
+
+    def total(self, **labels: str) -> float:
+        key = self._key(labels)
+        return self._values[key][1][0] if key in self._values else 0.0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts, strict=True):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total[0])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"There is already a metric called {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))  # type: ignore
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))  # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))  # type: ignore
+
+    def render(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "rankings_http_request_duration_seconds",
+    "How long API requests took, until the last of the response was sent",
+    ("method", "route", "status"),
+)
+MONGO_OPERATION_DURATION = REGISTRY.histogram(
+    "rankings_mongo_operation_duration_seconds",
+    "How long database operations took. The count is the number of operations.",
+    ("operation", "collection"),
+    buckets=MONGO_BUCKETS,
+)
+MONGO_OPERATION_ERRORS = REGISTRY.counter(
+    "rankings_mongo_operation_errors_total", "Database operations that raised", ("operation", "collection")
+)
+RECALCULATION_DURATION = REGISTRY.histogram(
+    "rankings_recalculation_duration_seconds",
+    "How long rating replays took, including reading the matches and writing the changes",
+    ("kind",),
+)
+MATCHES_RATED = REGISTRY.counter(
+    "rankings_matches_rated_total", "Matches run through the rating engine, as they were added or replayed", ("source",)
+)
+INGEST_BATCH_DURATION = REGISTRY.histogram(
+    "rankings_ingest_batch_duration_seconds", "How long the ingest queue took to commit each batch of matches"
+)
+INGEST_MATCHES = REGISTRY.counter("rankings_ingest_matches_total", "Matches committed by the ingest queue")
+INGEST_FAILED_BATCHES = REGISTRY.counter(
+    "rankings_ingest_failed_batches_total", "Batches the ingest queue failed to commit"
+)
+INGEST_QUEUE_DEPTH = REGISTRY.gauge("rankings_ingest_queue_depth", "Matches waiting in the ingest queue")
+
+
+def _observe_mongo_operation(operation: str, collection: str, elapsed: float, failed: bool):
+    MONGO_OPERATION_DURATION.observe(elapsed, operation=operation, collection=collection)
+    if failed:
+        MONGO_OPERATION_ERRORS.inc(operation=operation, collection=collection)
+
+
+motor.add_operation_observer(_observe_mongo_operation)
+
+
+class MetricsMiddleware:
+    """
+    Time every request by the route it matched, e.g. /players/{player_id}, so the labels don't grow with every id.
+    Requests that don't match a route are counted together. Routes in mounted apps, e.g. the other leagues, are labelled
+    with the path they are mounted at, e.g. /leagues/darts/players/{player_id}.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: dict[Callable, str] = {}
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self._routes:
+            # the app whose router matched, and where it is mounted, if it isn't the app the middleware is on
+            router = scope["app"].router
+            root_path = scope.get("root_path", "")
+            mount_path = root_path.removeprefix(scope.get("app_root_path", root_path))
+            self._routes.update(
+                {route.endpoint: mount_path + route.path for route in router.routes if hasattr(route, "endpoint")}
+            )
+        return self._routes.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start, method=scope["method"], route=self._route(scope), status=str(status)
+            )
@@ -0,0 +1,197 @@
+"""
+profiling.py: Opt-in profiling of the manager's expensive operations. Every operation that takes longer than a threshold
+is logged along with the database round-trips it made, and its profile is kept so it can be downloaded and examined
+with pstats, snakeviz, or (as collapsed stacks) a flame graph tool.
+"""
+
+import cProfile
+import functools
+import marshal
+import pstats
+import time
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any
+
+from loguru import logger
+
+import RankingsAPI.Mongo.motor as motor
+
+__all__ = ["OperationProfiler", "OperationProfile", "PROFILED_OPERATIONS", "PROFILE_FORMATS"]
+
+#: The manager methods that are profiled
+PROFILED_OPERATIONS = (
+    "recalculate_rankings",
+    "recalculate_last_matches",
+    "add_match",
+    "add_matches",
+    "add_match_batch",
+    "delete_player",
+    "delete_match",
+    "get_matches",
+    "get_matches_page",
+    "get_matches_resolved",
+    "rescore",
+    "simulate",
+)
+
+PROFILE_FORMATS = ("pstats", "collapsed")
+
+#: How deep the collapsed stacks go
+MAX_STACK_DEPTH = 64
+
+
+@dataclass
+class OperationProfile:
+    name: str
+    started: datetime
+    #: In seconds
+    duration: float = 0.0
+    #: The number of each kind of database operation made, e.g. find or bulk_write
+    round_trips: Counter = field(default_factory=Counter)
+    #: None if another operation was already being profiled, as only one profiler can run at a time
+    stats: pstats.Stats | None = None
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(),
+            "duration": self.duration,
+            "round_trips": sum(self.round_trips.values()),
+            "operations": dict(self.round_trips),
+            "has_profile": self.stats is not None,
+        }
+
+    def dump(self, profile_format: str) -> bytes:
+        """
+        The profile as a pstats file (what cProfile.Profile.dump_stats writes), or as collapsed stacks, one
+        "caller;callee count" line per stack, where the count is microseconds spent in the last function.
+        Raises ValueError for an unknown format, or if the operation wasn't profiled.
+        """
+        if self.stats is None:
+            raise ValueError(f"{self.name} was not profiled, another operation was being profiled at the time")
+        if profile_format == "pstats":
+            return marshal.dumps(self.stats.stats)  # type: ignore
+        if profile_format == "collapsed":
+            return "".join(f"{stack} {count}\n" for stack, count in _collapsed_stacks(self.stats).items()).encode()
+        raise ValueError(f"Unsupported profile format {profile_format}")
+
+
+def _function_name(function: tuple[str, int, str]) -> str:
+    filename, line, name = function
+    return name if filename == "~" else f"{name} ({filename.rsplit('/', 1)[-1]}:{line})"
+
+
+def _collapsed_stacks(stats: pstats.Stats) -> dict[str, int]:
+    """
+    cProfile only records who called what, not whole stacks, so the stacks are rebuilt from the root functions down,
+    sharing each function's time between its callers in proportion to the time each caller spent in it
+    """
+    entries = stats.stats  # type: ignore
+    callees: dict[tuple, list[tuple]] = {}
+    for function, (_, _, _, _, callers) in entries.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+
+    stacks: Counter = Counter()
+
+    def walk(function: tuple, stack: tuple[str, ...], share: float):
+        _, _, own_time, total_time, _ = entries[function]
+        stack = (*stack, _function_name(function))
+        stacks[";".join(stack)] += round(own_time * share * 1_000_000)
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee in callees.get(function, []):
+            if _function_name(callee) in stack:
+                continue
+            callee_total = entries[callee][3]
+            from_here = entries[callee][4][function][3]
+            if callee_total > 0 and from_here > 0:
+                walk(callee, stack, share * from_here / callee_total)
+
+    for function, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(function, (), 1.0)
+    return {stack: count for stack, count in stacks.items() if count > 0}
+
+
+_current: ContextVar[OperationProfile | None] = ContextVar("current_operation_profile", default=None)
+
+
+def _count_round_trip(operation: str, collection: str, elapsed: float, failed: bool):
+    profile = _current.get()
+    if profile is not None:
+        profile.round_trips[operation] += 1
+
+
+# registered once however many profilers there are (e.g. one per league), it does nothing outside a profiled operation
+motor.add_operation_observer(_count_round_trip)
+
+
+class OperationProfiler:
+    """
+    Wraps coroutines so each call is timed, its database round-trips counted, and it is run under cProfile. Operations
+    called from inside another (e.g. add_matches from add_match) are counted as part of the outer one. As the event
+    loop keeps running other tasks while an operation waits on the database, the profile also includes their work.
+    """
+
+    #: Shared by every profiler (e.g. one per league), as only one cProfile profiler can run at a time
+    _running = False
+
+    def __init__(self, *, slow_threshold: float, keep: int):
+        """
+        :param slow_threshold: Operations that take at least this many seconds are logged, and their profiles kept
+        :param keep: How many of the latest profiles are kept
+        """
+        self.slow_threshold = slow_threshold
+        self.profiles: deque[OperationProfile] = deque(maxlen=keep)
+
+    def instrument(self, target: Any, names: tuple[str, ...] = PROFILED_OPERATIONS):
+        """
+        Replace the named coroutine methods of the target with profiled ones
+        """
+        for name in names:
+            setattr(target, name, self.wrap(name, getattr(target, name)))
+
+    def wrap(self, name: str, operation: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        @functools.wraps(operation)
+        async def profiled(*args, **kwargs):
+            if _current.get() is not None:
+                return await operation(*args, **kwargs)
+
+            profile = OperationProfile(name=name, started=datetime.now(timezone.utc))
+            profiler = None
+            if not OperationProfiler._running:
+                OperationProfiler._running = True
+                profiler = cProfile.Profile()
+            token = _current.set(profile)
+            start = time.perf_counter()
+            try:
+                if profiler:
+                    profiler.enable()
+                return await operation(*args, **kwargs)
+            finally:
+                if profiler:
+                    profiler.disable()
+                    OperationProfiler._running = False
+                profile.duration = time.perf_counter() - start
+                _current.reset(token)
+                if profile.duration >= self.slow_threshold:
+                    if profiler:
+                        profile.stats = pstats.Stats(profiler)
+                    self._slow(profile)
+
+        return profiled
+
+    def _slow(self, profile: OperationProfile):
+        logger.warning(
+            "Slow {} took {:.3f}s with {} database round-trips {}",
+            profile.name,
+            profile.duration,
+            sum(profile.round_trips.values()),
+            dict(profile.round_trips),
+        )
+        self.profiles.append(profile)
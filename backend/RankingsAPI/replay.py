@@ -0,0 +1,164 @@
+"""
+replay.py: Replay the match history in memory to rebuild the rankings without a database round-trip per match
+"""
+
+from array import array
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime
+
+from bson import ObjectId
+
+from .data_models import Match, Player
+from .Mongo import ensure_timezone_aware
+
+__all__ = ["expected_score", "k_factor", "match_key", "RatingState", "RatingCheckpoint"]
+
+
+def expected_score(rating_a: float, rating_b: float) -> float:
+    """
+    The probability of player a beating player b
+    """
+    return 1.0 / (1 + 10 ** ((rating_b - rating_a) / 400.0))
+
+
+def k_factor(match_count: int, initial_k: float, standard_k: float) -> float:
+    """
+    The K factor for a player, new players move faster until they settle at the standard K
+    """
+    return max((initial_k - match_count), standard_k)
+
+
+def match_key(match: Match) -> tuple[datetime, ObjectId]:
+    """
+    The position of a match in the replay order. Matches are replayed by date, with the id breaking any ties.
+    """
+    return ensure_timezone_aware(match.date), match.id  # type: ignore
+
+
+class RatingState:
+    """
+    Compact, array backed rating state for every player. A rating engine replays matches against this with pure python
+    arithmetic, so the whole history can be replayed with a single read and a single write per collection.
+    """
+
+    def __init__(self, players: Iterable[Player], *, reset: bool = True):
+        if reset:
+            players = [player.copy() for player in players]
+            for player in players:
+                player.reset()
+        else:
+            players = list(players)
+
+        self.ids: list[ObjectId] = [player.id for player in players]  # type: ignore
+        self.index: dict[ObjectId, int] = {player_id: i for i, player_id in enumerate(self.ids)}
+        self.rating = array("d", (player.rating for player in players))
+        self.deviation = array("d", (player.rating_deviation for player in players))
+        self.volatility = array("d", (player.volatility for player in players))
+        self.wins = array("l", (player.wins for player in players))
+        self.losses = array("l", (player.losses for player in players))
+        self.draws = array("l", (player.draws for player in players))
+        self.match_count = array("l", (player.match_count for player in players))
+        self.last_match_date: list[datetime | None] = [player.last_match_date for player in players]
+        #: The last rating period that was rated, for engines that rate the matches in periods
+        self.period: int | None = None
+
+    def copy(self) -> "RatingState":
+        """
+        An independent copy of the state, cheap enough to take every few thousand matches
+        """
+        state = RatingState.__new__(RatingState)
+        state.ids = list(self.ids)
+        state.index = dict(self.index)
+        state.rating = array("d", self.rating)
+        state.deviation = array("d", self.deviation)
+        state.volatility = array("d", self.volatility)
+        state.wins = array("l", self.wins)
+        state.losses = array("l", self.losses)
+        state.draws = array("l", self.draws)
+        state.match_count = array("l", self.match_count)
+        state.last_match_date = list(self.last_match_date)
+        state.period = self.period
+        return state
+
+    def record_result(self, winner: int, loser: int, match: Match):
+        """
+        Count a match towards the two players' wins, losses and draws. Every rating engine does the same here.
+        """
+        if match.draw:
+            self.draws[winner] += 1
+            self.draws[loser] += 1
+        else:
+            self.wins[winner] += 1
+            self.losses[loser] += 1
+        self.last_match_date[winner] = match.date
+        self.last_match_date[loser] = match.date
+
+    def apply_to(self, players: dict[ObjectId, Player]) -> list[Player]:
+        """
+        Copy the rating state back onto the player documents, returning the players that changed
+        """
+        changed = []
+        for i, player_id in enumerate(self.ids):
+            player = players[player_id]
+            values = {
+                "rating": self.rating[i],
+                "rating_deviation": self.deviation[i],
+                "volatility": self.volatility[i],
+                "wins": self.wins[i],
+                "losses": self.losses[i],
+                "draws": self.draws[i],
+                "match_count": self.match_count[i],
+                "last_match_date": self.last_match_date[i],
+            }
+            if any(getattr(player, key) != value for key, value in values.items()):
+                for key, value in values.items():
+                    setattr(player, key, value)
+                changed.append(player)
+        return changed
+
+
+@dataclass
+class RatingCheckpoint:
+    """
+    A snapshot of every player's rating state, taken straight after a match was replayed
+    """
+
+    #: The date of the last match included in the snapshot
+    date: datetime
+    #: The id of the last match included in the snapshot
+    match_id: ObjectId
+    #: How many matches had been replayed when the snapshot was taken
+    match_index: int
+    state: RatingState
+
+    @property
+    def key(self) -> tuple[datetime, ObjectId]:
+        return self.date, self.match_id
+
+    @classmethod
+    def take(cls, state: RatingState, match: Match, match_index: int) -> "RatingCheckpoint":
+        date, match_id = match_key(match)
+        return cls(date=date, match_id=match_id, match_index=match_index, state=state.copy())
+
+    def restore(self, players: Iterable[Player]) -> RatingState:
+        """
+        Rebuild the rating state for the current players. Players that were added after the snapshot start from their
+        reset values, and players that have since been deleted are dropped.
+        """
+        state = RatingState(players)
+        snapshot = self.state
+        state.period = snapshot.period
+        for i, player_id in enumerate(state.ids):
+            j = snapshot.index.get(player_id)
+            if j is None:
+                continue
+            state.rating[i] = snapshot.rating[j]
+            state.deviation[i] = snapshot.deviation[j]
+            state.volatility[i] = snapshot.volatility[j]
+            state.wins[i] = snapshot.wins[j]
+            state.losses[i] = snapshot.losses[j]
+            state.draws[i] = snapshot.draws[j]
+            state.match_count[i] = snapshot.match_count[j]
+            state.last_match_date[i] = snapshot.last_match_date[j]
+        return state
@@ -1,3 +1,5 @@
+from typing import Any
+
 from pydantic import BaseSettings
 
 from MongoBase import MongoConfig, MongoConfigStandard
@@ -14,9 +16,38 @@ class Settings(BaseSettings):
     show_rating: bool = True
     support_draws: bool = False
 
+    #: The rating system, one of the engines in RankingsAPI.engines.ENGINES
+    rating_engine: str = "elo"
     initial_k: float = 30
     standard_k: float = 16
+    #: How long each glicko2 rating period lasts, and its system constant, which limits how fast volatility changes
+    glicko2_rating_period_days: float = 7
+    glicko2_tau: float = 0.5
     sort_by: str = "nrating"
+    #: How many matches to replay between rating checkpoints. Corrections only replay from the checkpoint before them.
+    checkpoint_interval: int = 1000
+
+    #: The number of matches returned by GET /matches when no limit is given, and the most that can be asked for
+    default_page_size: int = 100
+    max_page_size: int = 1000
+    #: The number of documents fetched from the database per round-trip when streaming an export
+    export_batch_size: int = 500
+    #: The most submitted matches that are committed together, and how long (in seconds) to wait for a batch to fill
+    ingest_batch_size: int = 100
+    ingest_batch_wait: float = 0.005
+
+    #: Profile the manager's expensive operations, logging those that take at least slow_operation_threshold seconds
+    #: and keeping the profiles of the latest profiles_kept of them to download from /debug/profiles
+    profiling: bool = False
+    slow_operation_threshold: float = 0.5
+    profiles_kept: int = 20
+
+    #: Set when several worker processes share the database. Rating updates then hold a lease in the database, and
+    #: the caches are checked against the shared versions at most every coordination_poll_interval seconds.
+    coordinate_workers: bool = False
+    coordination_poll_interval: float = 1
+    #: In seconds, how long a rating lease lasts if its holder stops renewing it, e.g. because it crashed
+    coordination_lease_duration: float = 30
 
     host: str = "0.0.0.0"
     port: int = 8080
@@ -24,3 +55,26 @@ class Settings(BaseSettings):
     backend_cors_origins: list[str] = ["*"]
 
     mongo: MongoConfig = MongoConfigStandard(username="pool", password="PoolLeague", database="pool_league")
+    #: The database this league is kept in, on the mongo connection. None for the database in the mongo config.
+    database: str | None = None
+    #: Other leagues to serve alongside this one, at /leagues/{name}, with the settings that they override, e.g.
+    #: {"darts": {"sport": "Darts", "initial_k": 40}}. Each is kept in its own database, named after the league unless
+    #: it sets database, and they all share the one connection pool, so can't set mongo or the mongo_ settings.
+    leagues: dict[str, dict[str, Any]] = {}
+    #: The connection pool. mongo_min_pool_size connections are opened at startup and kept open, the rest are closed
+    #: once they have been idle for mongo_max_idle_time seconds.
+    mongo_min_pool_size: int = 10
+    mongo_max_pool_size: int = 100
+    mongo_max_idle_time: float = 300
+    #: In seconds, how long to wait to find a server, to connect to it, and for it to reply (None waits forever)
+    mongo_server_selection_timeout: float = 10
+    mongo_connect_timeout: float = 5
+    mongo_socket_timeout: float | None = None
+    #: Wire compression, in order of preference, from zstd, snappy and zlib. zstd and snappy need extra packages.
+    mongo_compressors: list[str] = []
+
+    def for_league(self, name: str) -> "Settings":
+        """
+        The settings for one of the other leagues. Raises KeyError for an unknown league.
+        """
+        return self.copy(update={"database": name, **self.leagues[name], "leagues": {}})
@@ -0,0 +1,132 @@
+"""
+stats.py: Per-player totals, streaks and head-to-head records, kept up to date as matches are played
+"""
+
+from collections.abc import Iterable
+from dataclasses import dataclass
+from datetime import datetime
+
+from bson import ObjectId
+
+from .data_models import HeadToHead, Match, PlayerStats
+from .replay import match_key
+
+__all__ = ["PlayerTotals", "MatchStatistics"]
+
+
+@dataclass
+class PlayerTotals:
+    wins: int = 0
+    losses: int = 0
+    draws: int = 0
+    #: Positive for wins in a row, negative for losses in a row
+    current_streak: int = 0
+    longest_win_streak: int = 0
+    longest_loss_streak: int = 0
+    last_match_date: datetime | None = None
+
+    def add_win(self):
+        self.wins += 1
+        self.current_streak = self.current_streak + 1 if self.current_streak > 0 else 1
+        self.longest_win_streak = max(self.longest_win_streak, self.current_streak)
+
+    def add_loss(self):
+        self.losses += 1
+        self.current_streak = self.current_streak - 1 if self.current_streak < 0 else -1
+        self.longest_loss_streak = max(self.longest_loss_streak, -self.current_streak)
+
+    def add_draw(self):
+        self.draws += 1
+        self.current_streak = 0
+
+
+class MatchStatistics:
+    """
+    Statistics derived from the whole match history, so that a player's record or a head-to-head can be looked up
+    without reading every match they played. Matches must be added in the order they were played, as streaks depend on
+    it.
+    """
+
+    def __init__(self):
+        self.players: dict[ObjectId, PlayerTotals] = {}
+        #: Keyed by the two player ids in sorted order, holding the wins of the first, the wins of the second, and draws
+        self.records: dict[tuple[ObjectId, ObjectId], list[int]] = {}
+        #: When each pair of players, keyed the same way, last played each other
+        self.last_met: dict[tuple[ObjectId, ObjectId], datetime] = {}
+        #: The position of the latest match added
+        self.last_key: tuple[datetime, ObjectId] | None = None
+
+    @classmethod
+    def build(cls, matches: Iterable[Match]) -> "MatchStatistics":
+        """
+        Build the statistics from every match, oldest first
+        """
+        stats = cls()
+        for match in matches:
+            stats._add(match)
+        return stats
+
+    def add(self, matches: Iterable[Match]) -> bool:
+        """
+        Add newly played matches. If any of them is older than a match that has already been added, then nothing is
+        added and False is returned; the statistics have to be rebuilt from the whole history.
+        """
+        matches = sorted(matches, key=match_key)
+        if matches and self.last_key is not None and match_key(matches[0]) < self.last_key:
+            return False
+
+        for match in matches:
+            self._add(match)
+        return True
+
+    def _add(self, match: Match):
+        winner_id, loser_id = match.result
+        winner = self.players.setdefault(winner_id, PlayerTotals())
+        loser = self.players.setdefault(loser_id, PlayerTotals())
+
+        pair = (winner_id, loser_id) if winner_id < loser_id else (loser_id, winner_id)
+        record = self.records.setdefault(pair, [0, 0, 0])
+
+        if match.draw:
+            winner.add_draw()
+            loser.add_draw()
+            record[2] += 1
+        else:
+            winner.add_win()
+            loser.add_loss()
+            record[0 if pair[0] == winner_id else 1] += 1
+
+        winner.last_match_date = match.date
+        loser.last_match_date = match.date
+        self.last_met[pair] = match.date
+        self.last_key = match_key(match)
+
+    def player_stats(self, player_id: ObjectId) -> PlayerStats:
+        totals = self.players.get(player_id, PlayerTotals())
+        matches = totals.wins + totals.losses + totals.draws
+        return PlayerStats(
+            player_id=str(player_id),
+            matches=matches,
+            wins=totals.wins,
+            losses=totals.losses,
+            draws=totals.draws,
+            win_percentage=100 * totals.wins / matches if matches else 0,
+            current_streak=totals.current_streak,
+            longest_win_streak=totals.longest_win_streak,
+            longest_loss_streak=totals.longest_loss_streak,
+            last_match_date=totals.last_match_date,
+        )
+
+    def head_to_head(self, player_a: ObjectId, player_b: ObjectId) -> HeadToHead:
+        if player_a < player_b:
+            a_wins, b_wins, draws = self.records.get((player_a, player_b), (0, 0, 0))
+        else:
+            b_wins, a_wins, draws = self.records.get((player_b, player_a), (0, 0, 0))
+        return HeadToHead(
+            player_a=str(player_a),
+            player_b=str(player_b),
+            matches=a_wins + b_wins + draws,
+            player_a_wins=a_wins,
+            player_b_wins=b_wins,
+            draws=draws,
+        )
@@ -0,0 +1,171 @@
+import json
+import unittest
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+from MongoBase import MongoConfigMock
+from RankingsAPI.api import build_api
+from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
+from RankingsAPI.manager import Manager, mongo_client_kwargs
+from RankingsAPI.settings import Settings
+
+from .test_metrics import get
+
+
+class TestLifespan(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.settings = Settings(mongo=MongoConfigMock())
+        self.manager = Manager(config=self.settings)
+        self.api = build_api(manager=self.manager, settings=self.settings)
+
+    async def test_lifespan(self):
+        status, _, _ = await get(self.api, "/healthz")
+        self.assertEqual(503, status)
+
+        async with self.api.router.lifespan_context(self.api):
+            # the caches were filled before the first request
+            self.assertTrue(self.manager.ready)
+            self.assertEqual(1, self.manager.player_cache_misses)
+            self.assertIsNotNone(self.manager._stats)
+
+            status, _, body = await get(self.api, "/healthz")
+            self.assertEqual(200, status)
+            self.assertEqual('{"status":"ready"}', body)
+
+            await self.manager.add_player(PlayerAPI(name="Alice"))
+            status, _, _ = await get(self.api, "/players")
+            self.assertEqual(200, status)
+            self.assertEqual(1, self.manager.player_cache_misses)
+
+        self.assertFalse(self.manager.ready)
+        self.assertIsNone(self.manager._motor_client)
+        status, _, _ = await get(self.api, "/healthz")
+        self.assertEqual(503, status)
+
+    def test_client_kwargs(self):
+        settings = Settings(mongo=MongoConfigMock(), mongo_max_pool_size=50, mongo_compressors=["zstd", "zlib"])
+        kwargs = mongo_client_kwargs(settings)
+        self.assertEqual(50, kwargs["maxPoolSize"])
+        self.assertEqual(5000, kwargs["connectTimeoutMS"])
+        self.assertIsNone(kwargs["socketTimeoutMS"])
+        self.assertEqual("zstd,zlib", kwargs["compressors"])
+
+
+class TestPlayersAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.settings = Settings(mongo=MongoConfigMock())
+        self.manager = Manager(config=self.settings)
+        self.manager.connect()
+        self.alice = await self.manager.add_player(PlayerAPI(name="Alice"))
+
+    async def get_json(self, api, path: str):
+        status, _, body = await get(api, path)
+        self.assertEqual(200, status)
+        return json.loads(body)
+
+    async def test_engine_fields(self):
+        # elo has no rating deviation or volatility
+        api = build_api(manager=self.manager, settings=self.settings)
+        player = await self.get_json(api, f"/players/{self.alice.id}")
+        self.assertEqual("Alice", player["name"])
+        self.assertNotIn("rating_deviation", player)
+        self.assertNotIn("volatility", player)
+        self.assertNotIn("volatility", (await self.get_json(api, "/players"))[0])
+        self.assertNotIn("volatility", json.loads((await get(api, "/players/export"))[2]))
+        # unless the players were rated with glicko2
+        self.assertIn("volatility", (await self.get_json(api, "/players/rescore?engine=glicko2"))[0])
+
+        settings = Settings(mongo=MongoConfigMock(), rating_engine="glicko2")
+        api = build_api(manager=Manager(config=settings), settings=settings)
+        player = await self.get_json(api, f"/players/{self.alice.id}")
+        self.assertEqual(350, player["rating_deviation"])
+        self.assertIn("volatility", (await self.get_json(api, "/players"))[0])
+        self.assertNotIn("volatility", (await self.get_json(api, "/players/rescore?engine=elo"))[0])
+
+
+class TestMatchesAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        settings = Settings(mongo=MongoConfigMock())
+        self.manager = Manager(config=settings)
+        self.manager.connect()
+        self.api = build_api(manager=self.manager, settings=settings)
+        alice = str((await self.manager.add_player(PlayerAPI(name="Alice"))).id)
+        bob = str((await self.manager.add_player(PlayerAPI(name="Bob"))).id)
+        self.charlie = str((await self.manager.add_player(PlayerAPI(name="Charlie"))).id)
+        # one a day, from the 1st to the 5th, with Charlie in every other one
+        self.matches = [
+            await self.manager.add_match(
+                MatchAPISubmit(
+                    result=[alice, self.charlie if day % 2 else bob],
+                    draw=False,
+                    date=datetime(2023, 1, day, tzinfo=timezone.utc),
+                )
+            )
+            for day in range(1, 6)
+        ]
+
+    async def get_matches(self, query: str) -> list[str]:
+        status, _, body = await get(self.api, f"/matches?{query}")
+        self.assertEqual(200, status)
+        return [match["id"] for match in json.loads(body)["matches"]]
+
+    async def test_pages(self):
+        ids = []
+        cursor = None
+        while True:
+            status, _, body = await get(self.api, "/matches?limit=2" + (f"&cursor={cursor}" if cursor else ""))
+            self.assertEqual(200, status)
+            page = json.loads(body)
+            self.assertLessEqual(len(page["matches"]), 2)
+            ids += [match["id"] for match in page["matches"]]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        # newest first, each match once
+        self.assertEqual([str(match.id) for match in reversed(self.matches)], ids)
+
+    async def test_filters(self):
+        ids = [str(match.id) for match in self.matches]
+        self.assertEqual(
+            [ids[2], ids[1]], await self.get_matches("since=2023-01-02T00:00:00Z&until=2023-01-04T00:00:00Z")
+        )
+        self.assertEqual([ids[4], ids[2], ids[0]], await self.get_matches(f"player_id={self.charlie}"))
+        self.assertEqual(
+            [ids[4]], await self.get_matches(f"player_id={self.charlie}&since=2023-01-02T00:00:00Z&limit=1")
+        )
+
+    async def test_bad_queries(self):
+        for query in ("player_id=nope", "cursor=nope"):
+            status, _, _ = await get(self.api, f"/matches?{query}")
+            self.assertEqual(400, status, query)
+        status, _, _ = await get(self.api, "/matches?limit=0")
+        self.assertEqual(422, status)
+
+    async def test_bad_player_ids(self):
+        for player_id in ("nope", ObjectId()):
+            for path in (f"/players/{player_id}/stats", f"/players/{player_id}/vs/{self.charlie}"):
+                status, _, _ = await get(self.api, path)
+                self.assertEqual(400, status, path)
+
+        status, _, _ = await get(self.api, f"/players/pairings?player_id={self.charlie}&player_id=nope")
+        self.assertEqual(400, status)
+        status, _, _ = await get(self.api, f"/players/pairings?player_id={self.charlie}")
+        self.assertEqual(200, status)
+
+    async def test_export(self):
+        status, headers, body = await get(self.api, "/matches/export")
+        self.assertEqual(200, status)
+        self.assertTrue(headers["content-type"].startswith("application/x-ndjson"))
+        # one document per line, oldest first
+        lines = body.splitlines()
+        self.assertEqual([str(match.id) for match in self.matches], [json.loads(line)["id"] for line in lines])
+        self.assertTrue(body.endswith("\n"))
+
+        status, _, body = await get(self.api, "/players/export?format=ndjson")
+        self.assertEqual(200, status)
+        self.assertEqual(["Alice", "Bob", "Charlie"], sorted(json.loads(line)["name"] for line in body.splitlines()))
+
+        for path in ("/matches/export", "/players/export"):
+            status, _, _ = await get(self.api, f"{path}?format=csv")
+            self.assertEqual(400, status, path)
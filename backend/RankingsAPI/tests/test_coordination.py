@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta, timezone
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.coordination import COORDINATION_COLLECTION, LEASE_ID, Coordinator
+from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+
+class TestCoordination(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        settings = Settings(mongo=MongoConfigMock(), coordinate_workers=True, coordination_poll_interval=0)
+        # two workers sharing the one database
+        self.worker = Manager(config=settings)
+        self.worker.connect()
+        self.other_worker = Manager(config=settings)
+
+        self.alice = await self.worker.add_player(PlayerAPI(name="Alice"))
+        self.bob = await self.worker.add_player(PlayerAPI(name="Bob"))
+
+    async def add_match(self, manager: Manager):
+        await manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+
+    async def test_caches_follow_other_workers(self):
+        await self.other_worker.get_leaderboard()
+        players = await self.other_worker.get_players()
+        self.assertEqual(0, players[self.alice.id].wins)
+        self.assertEqual(0, (await self.other_worker.get_player_stats(self.alice.id)).wins)
+
+        await self.add_match(self.worker)
+
+        players = await self.other_worker.get_players()
+        self.assertEqual(1, players[self.alice.id].wins)
+        self.assertEqual(1, (await self.other_worker.get_player_stats(self.alice.id)).wins)
+        # the version is shared, so it is the same whichever worker answers
+        leaderboard = await self.worker.get_leaderboard()
+        other_leaderboard = await self.other_worker.get_leaderboard()
+        self.assertEqual(leaderboard.version, other_leaderboard.version)
+        self.assertEqual(leaderboard.etag, other_leaderboard.etag)
+
+        # a rating update starts from what the other worker wrote
+        await self.add_match(self.other_worker)
+        await self.add_match(self.worker)
+        players = await self.worker.get_players()
+        self.assertEqual(3, players[self.alice.id].wins)
+        await self.worker.recalculate_rankings()
+        self.assertEqual(players[self.alice.id].rating, (await self.worker.get_players())[self.alice.id].rating)
+
+    async def test_checkpoints_are_dropped(self):
+        for _ in range(3):
+            await self.add_match(self.other_worker)
+        self.other_worker._checkpoints = [object()]  # type: ignore
+
+        await self.add_match(self.worker)
+        await self.other_worker.get_players()
+        self.assertEqual([], self.other_worker._checkpoints)
+
+    async def test_lease_serialises_writes(self):
+        coordinator = Coordinator(lease_duration=30, poll_interval=0)
+        async with coordinator.lease():
+            adding = asyncio.create_task(self.add_match(self.other_worker))
+            await asyncio.sleep(0.05)
+            self.assertFalse(adding.done())
+        await adding
+        self.assertEqual(1, (await self.worker.get_player(self.alice.id)).wins)
+
+    async def test_expired_lease_is_taken(self):
+        # a worker that died while holding the lease
+        expired = datetime.now(timezone.utc) - timedelta(seconds=1)
+        await motor.get_collection(COORDINATION_COLLECTION).insert_one(
+            {"_id": LEASE_ID, "owner": "x", "expires": expired}
+        )
+        await asyncio.wait_for(self.add_match(self.worker), timeout=1)
@@ -0,0 +1,159 @@
+import math
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from bson import ObjectId
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.data_models import Match, MatchAPISubmit, Player, PlayerAPI
+from RankingsAPI.engines import GLICKO2_MAX_DEVIATION, GLICKO2_SCALE, Glicko2Engine
+from RankingsAPI.manager import Manager
+from RankingsAPI.replay import RatingState
+from RankingsAPI.settings import Settings
+
+
+def with_id(doc):
+    doc.id = ObjectId()
+    return doc
+
+
+class TestGlicko2(unittest.TestCase):
+    def test_glickman_example(self):
+        # the worked example from Glickman's paper (without its rounding), moved down by 500 as players start on 1000
+        player = with_id(Player(name="player", rating=1000, rating_deviation=200, volatility=0.06))
+        opponents = [
+            with_id(Player(name=f"opponent_{rating}", rating=rating, rating_deviation=deviation))
+            for rating, deviation in [(900, 30), (1050, 100), (1200, 300)]
+        ]
+        date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        matches = [
+            with_id(Match(result=[player.id, opponents[0].id], draw=False, date=date)),
+            with_id(Match(result=[opponents[1].id, player.id], draw=False, date=date + timedelta(hours=1))),
+            with_id(Match(result=[opponents[2].id, player.id], draw=False, date=date + timedelta(hours=2))),
+        ]
+
+        state = RatingState([player, *opponents], reset=False)
+        Glicko2Engine(rating_period=timedelta(days=7), tau=0.5).update(state, matches)
+
+        self.assertAlmostEqual(964.05, state.rating[0], places=2)
+        self.assertAlmostEqual(151.52, state.deviation[0], places=2)
+        self.assertAlmostEqual(0.059996, state.volatility[0], places=6)
+        # every match was rated against the ratings from the start of the period
+        self.assertEqual([1000, 1000, 1000], [match.loser_rating for match in matches[1:]] + [matches[0].winner_rating])
+
+    def play(self, state: RatingState, date: datetime, *pairs: tuple[int, int]):
+        matches = [
+            with_id(Match(result=[state.ids[winner], state.ids[loser]], draw=False, date=date))
+            for winner, loser in pairs
+        ]
+        Glicko2Engine(rating_period=timedelta(days=7), tau=0.5).update(state, matches)
+
+    def test_deviation_grows_through_empty_periods(self):
+        state = RatingState([with_id(Player(name=name)) for name in ("a", "b", "c")])
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.play(state, start, (0, 2), (1, 2))
+        deviation, volatility = state.deviation[2], state.volatility[2]
+
+        # c sits out week 1 but nobody plays at all in weeks 2 to 19, which still count
+        self.play(state, start + timedelta(weeks=1), (0, 1))
+        self.play(state, start + timedelta(weeks=20), (0, 1))
+        expected = math.sqrt(deviation**2 + 20 * (volatility * GLICKO2_SCALE) ** 2)
+        self.assertAlmostEqual(expected, state.deviation[2])
+        self.assertLess(expected, GLICKO2_MAX_DEVIATION)
+
+    def test_deviation_is_capped(self):
+        state = RatingState([with_id(Player(name=name)) for name in ("a", "b", "c")])
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.play(state, start, (0, 2))
+        self.play(state, start + timedelta(weeks=2000), (0, 1))
+        self.assertEqual(GLICKO2_MAX_DEVIATION, state.deviation[2])
+
+        # and while playing after that long
+        self.play(state, start + timedelta(weeks=4000), (2, 0))
+        self.assertLessEqual(state.deviation[0], GLICKO2_MAX_DEVIATION)
+
+    def test_deviation_only_grows_after_the_first_match(self):
+        state = RatingState([with_id(Player(name=name)) for name in ("a", "b", "c", "d")])
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.play(state, start, (0, 1))
+        self.play(state, start + timedelta(weeks=50), (0, 1))
+        self.assertEqual([GLICKO2_MAX_DEVIATION] * 2, list(state.deviation[2:]))
+
+        # so their first match, however late, is rated as if they had just joined
+        self.play(state, start + timedelta(weeks=51), (2, 3))
+        fresh = RatingState([with_id(Player(name=name)) for name in ("c", "d")])
+        self.play(fresh, start, (0, 1))
+        self.assertEqual(list(fresh.rating), list(state.rating[2:]))
+        self.assertEqual(list(fresh.deviation), list(state.deviation[2:]))
+
+
+class TestGlicko2Manager(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.manager = Manager(config=Settings(mongo=MongoConfigMock(), rating_engine="glicko2", checkpoint_interval=5))
+        self.manager.connect()
+        self.players = [await self.manager.add_player(PlayerAPI(name=f"player_{i}")) for i in range(4)]
+
+        rng = random.Random(2)
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for i in range(30):
+            winner, loser = rng.sample(self.players, 2)
+            await self.manager.add_match(
+                MatchAPISubmit(result=[str(winner.id), str(loser.id)], draw=False, date=start + timedelta(days=i))
+            )
+
+    async def test_live_matches_match_recalculation(self):
+        live = await self.manager.get_players()
+        self.assertEqual(30, sum(player.wins for player in live.values()))
+        self.assertTrue(all(player.rating_deviation < 350 for player in live.values()))
+
+        self.manager._checkpoints = []
+        with mock.patch.object(motor, "bulk_update", wraps=motor.bulk_update) as bulk_update:
+            await self.manager.recalculate_rankings()
+        self.assertEqual([[], []], [call.args[0] for call in bulk_update.call_args_list])
+
+    async def test_checkpoints_are_taken_at_startup(self):
+        # as if the server had been restarted, the checkpoints are only kept in memory
+        self.manager._checkpoints = []
+        await self.manager.start()
+        self.assertTrue(self.manager._checkpoints)
+
+        # so a new match only replays from the checkpoint before its rating period
+        winner, loser = self.players[:2]
+        with mock.patch.object(
+            self.manager, "get_matches_in_order", wraps=self.manager.get_matches_in_order
+        ) as in_order:
+            await self.manager.add_match(
+                MatchAPISubmit(
+                    result=[str(winner.id), str(loser.id)], draw=False, date=datetime(2024, 2, 1, tzinfo=timezone.utc)
+                )
+            )
+        self.assertIsNotNone(in_order.call_args.kwargs["after"])
+        self.assertEqual(31, sum(player.wins for player in (await self.manager.get_players()).values()))
+
+    async def test_update_player_keeps_the_rating(self):
+        player = (await self.manager.get_players())[self.players[0].id]
+        self.assertLess(player.rating_deviation, 350)
+
+        # as sent by a client that doesn't know about the glicko2 fields
+        await self.manager.update_player(PlayerAPI(id=str(player.id), name="renamed", rating=player.rating))
+        updated = await self.manager.get_player(player.id)
+        self.assertEqual("renamed", updated.name)
+        self.assertEqual(player.rating_deviation, updated.rating_deviation)
+        self.assertEqual(player.volatility, updated.volatility)
+
+    async def test_rescore(self):
+        stored = await self.manager.get_players()
+        elo = await self.manager.rescore("elo")
+
+        self.assertEqual(stored, await self.manager.get_players())
+        self.assertNotEqual(
+            {player.id: player.rating for player in elo}, {player.id: player.rating for player in stored.values()}
+        )
+        for player in elo:
+            self.assertEqual(stored[player.id].wins, player.wins)
+
+        with self.assertRaises(ValueError):
+            await self.manager.rescore("trueskill")
@@ -0,0 +1,124 @@
+import json
+import unittest
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.api import build_api
+from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
+from RankingsAPI.leagues import Leagues
+from RankingsAPI.manager import Manager
+from RankingsAPI.metrics import HTTP_REQUEST_DURATION, INGEST_QUEUE_DEPTH
+from RankingsAPI.settings import Settings
+
+from .test_metrics import get, request
+
+
+class TestLeagues(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.settings = Settings(
+            mongo=MongoConfigMock(), leagues={"darts": {"sport": "Darts", "initial_k": 40}, "chess": {}}
+        )
+        self.manager = Manager(config=self.settings)
+        self.leagues = Leagues(self.settings)
+        self.api = build_api(manager=self.manager, settings=self.settings, leagues=self.leagues)
+
+    def test_settings(self):
+        darts = self.leagues["darts"].settings
+        self.assertEqual("darts", darts.database)
+        self.assertEqual(40, darts.initial_k)
+        self.assertEqual({}, darts.leagues)
+        self.assertEqual(self.settings.initial_k, self.leagues["chess"].settings.initial_k)
+
+        with self.assertRaises(ValueError):
+            Leagues(Settings(mongo=MongoConfigMock(), leagues={"darts/pool": {}}))
+        with self.assertRaises(ValueError):
+            Leagues(Settings(mongo=MongoConfigMock(), leagues={"darts": {"mongo_max_pool_size": 5}}))
+
+    async def test_isolation(self):
+        async with self.api.router.lifespan_context(self.api):
+            darts = self.leagues["darts"]
+            # one pool for every league
+            self.assertIsNotNone(self.manager._motor_client)
+            self.assertIsNone(darts.manager._motor_client)
+
+            await self.manager.add_player(PlayerAPI(name="Alice"))
+            with darts.database():
+                alice = await darts.manager.add_player(PlayerAPI(name="Alice"))
+                bob = await darts.manager.add_player(PlayerAPI(name="Bob"))
+                await darts.manager.add_match(MatchAPISubmit(result=[str(alice.id), str(bob.id)], draw=False))
+                self.assertEqual(2, await motor.get_collection("players").count_documents({}))
+
+            self.assertEqual(1, await motor.get_collection("players").count_documents({}))
+            self.assertEqual(1, len(await self.manager.get_players()))
+            self.assertEqual(0, len(await self.manager.get_matches()))
+
+            status, _, body = await get(self.api, "/leagues/darts/players")
+            self.assertEqual(200, status)
+            self.assertEqual(["Alice", "Bob"], sorted(player["name"] for player in json.loads(body)))
+            status, _, body = await get(self.api, "/leagues/chess/players")
+            self.assertEqual("[]", body)
+            status, _, body = await get(self.api, f"/leagues/darts/players/{alice.id}")
+            self.assertEqual(1, json.loads(body)["wins"])
+
+            status, _, body = await get(self.api, "/leagues")
+            self.assertEqual(
+                [
+                    {"name": None, "sport": "Pool", "path": "/"},
+                    {"name": "darts", "sport": "Darts", "path": "/leagues/darts"},
+                    {"name": "chess", "sport": "Pool", "path": "/leagues/chess"},
+                ],
+                json.loads(body),
+            )
+
+        self.assertFalse(self.leagues.ready)
+        self.assertFalse(motor.is_connected())
+
+    async def test_health_and_metrics(self):
+        async with self.api.router.lifespan_context(self.api):
+            status, _, _ = await get(self.api, "/healthz")
+            self.assertEqual(200, status)
+
+            # labelled with the league, so they aren't counted with the same route in other leagues
+            requests = HTTP_REQUEST_DURATION.count(method="GET", route="/leagues/darts/players", status="200")
+            root_requests = HTTP_REQUEST_DURATION.count(method="GET", route="/players", status="200")
+            await get(self.api, "/leagues/darts/players")
+            self.assertEqual(
+                requests + 1, HTTP_REQUEST_DURATION.count(method="GET", route="/leagues/darts/players", status="200")
+            )
+            self.assertEqual(root_requests, HTTP_REQUEST_DURATION.count(method="GET", route="/players", status="200"))
+
+            # the matches waiting in every league's queue
+            for manager, waiting in ((self.manager, 1), (self.leagues["darts"].manager, 2)):
+                for _ in range(waiting):
+                    manager._ingest._queue.put_nowait(None)
+            self.assertEqual(3, INGEST_QUEUE_DEPTH.value())
+
+            self.leagues["chess"].manager.ready = False
+            status, _, _ = await get(self.api, "/healthz")
+            self.assertEqual(503, status)
+
+
+class TestRootDatabase(unittest.IsolatedAsyncioTestCase):
+    async def test_root_league_in_its_own_database(self):
+        settings = Settings(mongo=MongoConfigMock(), database="pool")
+        manager = Manager(config=settings)
+        api = build_api(manager=manager, settings=settings)
+
+        async with api.router.lifespan_context(api):
+            ids = []
+            for name in ("Alice", "Bob"):
+                status, _, body = await request(api, "POST", "/players", json.dumps({"name": name}).encode())
+                self.assertEqual(200, status)
+                ids.append(json.loads(body)["id"])
+            # committed by the ingest writer
+            status, _, _ = await request(api, "POST", "/matches", json.dumps({"result": ids, "draw": False}).encode())
+            self.assertEqual(200, status)
+
+            self.assertEqual(0, await motor.get_collection("players").count_documents({}))
+            self.assertEqual(0, await motor.get_collection("matches").count_documents({}))
+            with motor.use_database("pool"):
+                self.assertEqual(2, await motor.get_collection("players").count_documents({}))
+                self.assertEqual(1, await motor.get_collection("matches").count_documents({}))
+
+            status, _, body = await get(api, "/players")
+            self.assertEqual([1, 0], [player["wins"] for player in json.loads(body)])
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from bson import ObjectId
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.data_models import Match, MatchAPISubmit, Player, PlayerAPI
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+
+class TestManager(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.manager = Manager(config=Settings(mongo=MongoConfigMock()))
+        self.manager.connect()
+        self.alice = await self.manager.add_player(PlayerAPI(name="Alice"))
+        self.bob = await self.manager.add_player(PlayerAPI(name="Bob"))
+
+    async def test_player_cache(self):
+        await self.manager.get_players()
+        self.assertEqual(1, self.manager.player_cache_misses)
+
+        with mock.patch.object(motor, "get_from_id", wraps=motor.get_from_id) as get_from_id:
+            await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+        get_from_id.assert_not_called()
+        self.assertEqual(1, self.manager.player_cache_misses)
+
+        # the cache was updated by the match, and matches what is in the database
+        alice = await self.manager.get_player(self.alice.id)
+        self.assertEqual(1, alice.wins)
+        stored = await motor.get_from_id(Player, self.alice.id)
+        self.assertEqual((alice.rating, alice.wins), (stored.rating, stored.wins))
+
+        # players written behind the manager's back are found once the cache is invalidated
+        charlie = Player(name="Charlie")
+        await motor.insert_one(charlie)
+        self.assertNotIn(charlie.id, await self.manager.get_players())
+        self.manager.invalidate_player_cache()
+        self.assertIn(charlie.id, await self.manager.get_players())
+        self.assertEqual(2, self.manager.player_cache_misses)
+
+    async def test_cached_players_are_copies(self):
+        alice = await self.manager.get_player(self.alice.id)
+        alice.rating = 0
+        self.assertEqual(1000, (await self.manager.get_player(self.alice.id)).rating)
+
+    async def test_leaderboard(self):
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.bob.id), str(self.alice.id)], draw=False))
+
+        leaderboard = await self.manager.get_leaderboard()
+        self.assertEqual(["Bob", "Alice"], [player["name"] for player in json.loads(leaderboard.body)])
+        self.assertIs(leaderboard, await self.manager.get_leaderboard())
+
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+        updated = await self.manager.get_leaderboard()
+        self.assertGreater(updated.version, leaderboard.version)
+        self.assertNotEqual(updated.etag, leaderboard.etag)
+
+    async def test_resolved_matches(self):
+        alice, bob = str(self.alice.id), str(self.bob.id)
+        for result in ([alice, bob], [bob, alice]):
+            await self.manager.add_match(MatchAPISubmit(result=result, draw=False))
+        # a player and their matches written behind the manager's back, so not in its cache
+        charlie = Player(name="Charlie")
+        await motor.insert_one(charlie)
+        for result in ([str(charlie.id), alice], [bob, str(charlie.id)]):
+            await motor.insert_one(Match.from_api(MatchAPISubmit(result=result, draw=False)))
+
+        # one query for the matches, and one for the players that weren't cached, however many matches there are
+        with mock.patch.object(motor, "find", wraps=motor.find) as find:
+            matches = await self.manager.get_matches_resolved()
+        self.assertEqual(2, find.call_count)
+        self.assertEqual(
+            [("Alice", "Bob"), ("Bob", "Alice"), ("Charlie", "Alice"), ("Bob", "Charlie")],
+            [(match["winner_name"], match["loser_name"]) for match in matches],
+        )
+
+        # now they are all cached
+        with mock.patch.object(motor, "find", wraps=motor.find) as find:
+            matches = await self.manager.get_matches_resolved(charlie.id)
+        self.assertEqual(1, find.call_count)
+        self.assertEqual(2, len(matches))
+
+        # a match whose player has been deleted can't be resolved
+        await motor.delete_one(charlie)
+        self.manager.invalidate_player_cache()
+        with self.assertRaises(ValueError):
+            await self.manager.get_matches_resolved()
+
+    async def test_concurrent_matches(self):
+        charlie = await self.manager.add_player(PlayerAPI(name="Charlie"))
+        players = [self.alice, self.bob, charlie]
+        submissions = [
+            MatchAPISubmit(result=[str(players[i % 3].id), str(players[(i + 1) % 3].id)], draw=False) for i in range(30)
+        ]
+
+        await asyncio.gather(
+            *(self.manager.add_match(submission) for submission in submissions), self.manager.recalculate_rankings()
+        )
+
+        cached = await self.manager.get_players()
+        stored = {player.id: player for player in await motor.find(Player).to_list(None)}
+        self.assertEqual(30, sum(player.wins for player in stored.values()))
+        for player_id, player in stored.items():
+            self.assertEqual((player.wins, player.losses), (cached[player_id].wins, cached[player_id].losses))
+            self.assertAlmostEqual(player.rating, cached[player_id].rating)
+
+    async def test_failed_writes(self):
+        submission = MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False)
+        bulk_append = motor.bulk_append
+
+        async def fail_once(*args, **kwargs):
+            if fail_once.failed:
+                return await bulk_append(*args, **kwargs)
+            fail_once.failed = True
+            raise RuntimeError("The history could not be written")
+
+        fail_once.failed = False
+        # the match was saved, so its ratings and history are replayed from it
+        with mock.patch.object(motor, "bulk_append", side_effect=fail_once):
+            await self.manager.add_match(submission)
+        self.assertEqual(1, (await self.manager.get_player(self.alice.id)).wins)
+        self.assertEqual(1, (await motor.get_from_id(Player, self.alice.id)).wins)
+        history = await self.manager.get_rating_history(self.alice.id)
+        self.assertEqual(1, len(history.points))
+
+        # the match wasn't saved, so nothing else was
+        with mock.patch.object(motor, "insert_many", side_effect=RuntimeError("The match could not be written")):
+            with self.assertRaises(RuntimeError):
+                await self.manager.add_match(submission)
+        self.assertEqual(1, (await motor.get_from_id(Player, self.alice.id)).wins)
+        self.assertEqual(1, len(await self.manager.get_matches()))
+
+    async def test_submitted_matches_are_committed_in_batches(self):
+        submissions = [
+            MatchAPISubmit(
+                result=[str(self.alice.id), str(self.bob.id)],
+                draw=False,
+                date=datetime(2023, 1, 1 + i, tzinfo=timezone.utc),
+            )
+            for i in range(20)
+        ]
+        pending = await self.manager.submit_match(submissions[0], wait=False)
+        self.assertIsNotNone(pending.id)
+        self.assertIsNone(pending.winner_rating)
+
+        matches = await asyncio.gather(*(self.manager.submit_match(submission) for submission in submissions[1:]))
+        self.assertTrue(all(match.winner_rating is not None for match in matches))
+
+        stats = self.manager.ingest_stats
+        self.assertEqual(20, stats.matches_committed)
+        self.assertLess(stats.batches_committed, 20)
+        self.assertEqual(0, stats.queue_depth)
+
+        # applying them in batches gives the same ratings as replaying them one by one
+        alice = await self.manager.get_player(self.alice.id)
+        await self.manager.recalculate_rankings()
+        self.assertAlmostEqual(alice.rating, (await self.manager.get_player(self.alice.id)).rating)
+
+    async def test_bad_match_in_a_batch(self):
+        alice, bob = str(self.alice.id), str(self.bob.id)
+        submissions = [MatchAPISubmit(result=[alice, bob], draw=False) for _ in range(5)]
+        pending = [asyncio.ensure_future(self.manager.submit_match(submission)) for submission in submissions]
+        # a player deleted after the match was checked, but before it was committed
+        bad = Match.from_api(MatchAPISubmit(result=[alice, str(ObjectId())], draw=False))
+        pending.insert(2, asyncio.ensure_future(self.manager._ingest.submit(bad)))
+
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        self.assertIsInstance(results[2], Exception)
+        self.assertTrue(all(isinstance(result, Match) for i, result in enumerate(results) if i != 2))
+        self.assertEqual(5, (await self.manager.get_player(self.alice.id)).wins)
+        stats = self.manager.ingest_stats
+        self.assertEqual(5, stats.matches_committed)
+        self.assertEqual(0, stats.failed_batches)
+
+    async def test_failed_batch(self):
+        submissions = [MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False) for _ in range(3)]
+        history_written = motor.bulk_append
+
+        async def fail_once(*args, **kwargs):
+            if fail_once.failed:
+                return await history_written(*args, **kwargs)
+            fail_once.failed = True
+            raise RuntimeError("The history could not be written")
+
+        # the matches were saved before the history failed, so they are committed, once
+        fail_once.failed = False
+        with mock.patch.object(motor, "bulk_append", side_effect=fail_once):
+            await asyncio.gather(*(self.manager.submit_match(submission) for submission in submissions))
+        self.assertEqual(3, (await self.manager.get_player(self.alice.id)).wins)
+        self.assertEqual(3, (await motor.get_from_id(Player, self.alice.id)).wins)
+        self.assertEqual(
+            (3, 0), (self.manager.ingest_stats.matches_committed, self.manager.ingest_stats.failed_batches)
+        )
+
+        # nothing was saved, so every submitter is told, and nothing is tried again
+        with mock.patch.object(motor, "insert_many", side_effect=RuntimeError("The matches could not be written")):
+            results = await asyncio.gather(
+                *(self.manager.submit_match(submission) for submission in submissions), return_exceptions=True
+            )
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(3, (await motor.get_from_id(Player, self.alice.id)).wins)
+        self.assertEqual(3, len(await self.manager.get_matches()))
+        self.assertEqual(
+            (3, 1), (self.manager.ingest_stats.matches_committed, self.manager.ingest_stats.failed_batches)
+        )
+
+    async def test_submitted_match_needs_two_players(self):
+        alice = str(self.alice.id)
+        with self.assertRaises(ValueError):
+            await self.manager.submit_match(MatchAPISubmit(result=[alice, alice], draw=False))
+        self.assertEqual(0, self.manager.ingest_stats.matches_committed)
+        self.assertEqual(0, (await self.manager.get_player(self.alice.id)).wins)
+
+    async def test_match_batch(self):
+        alice, bob = str(self.alice.id), str(self.bob.id)
+        await self.manager.add_match(
+            MatchAPISubmit(result=[alice, bob], draw=False, date=datetime(2023, 6, 1, tzinfo=timezone.utc))
+        )
+
+        results = await self.manager.add_match_batch(
+            [
+                MatchAPISubmit(result=[bob, alice], draw=False, date=datetime(2023, 7, 1, tzinfo=timezone.utc)),
+                MatchAPISubmit(result=[alice, str(ObjectId())], draw=False),
+                MatchAPISubmit(result=[alice, "not an id"], draw=False),
+                MatchAPISubmit(result=[bob, alice], draw=False, date=datetime(2023, 5, 1, tzinfo=timezone.utc)),
+            ]
+        )
+        self.assertEqual([0, 1, 2, 3], [result.index for result in results])
+        self.assertEqual([False, True, True, False], [result.error is not None for result in results])
+
+        # the backdated match was played first, so it was rated before the existing match
+        self.assertEqual(1000, results[3].match.winner_rating)
+        matches = await self.manager.get_matches_in_order()
+        self.assertEqual(3, len(matches))
+        self.assertNotEqual(1000, matches[1].winner_rating)
+
+        with mock.patch.object(motor, "bulk_update", wraps=motor.bulk_update) as bulk_update:
+            await self.manager.recalculate_rankings()
+        self.assertEqual([[], []], [call.args[0] for call in bulk_update.call_args_list])
+
+    async def test_matches_page_matches_pydantic_serialisation(self):
+        for i in range(5):
+            await self.manager.add_match(
+                MatchAPISubmit(
+                    result=[str(self.alice.id), str(self.bob.id)],
+                    draw=False,
+                    date=datetime(2023, 1, 1 + i, tzinfo=timezone.utc),
+                )
+            )
+
+        page, next_cursor = await self.manager.get_matches_page(limit=3)
+        rest, last_cursor = await self.manager.get_matches_page(limit=3, cursor=next_cursor)
+        self.assertIsNone(last_cursor)
+
+        expected = [json.loads(match.to_api().json()) for match in reversed(await self.manager.get_matches_in_order())]
+        self.assertEqual(expected, page + rest)
+
+    async def test_match_statistics(self):
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        alice, bob = str(self.alice.id), str(self.bob.id)
+        for i, (result, draw) in enumerate(
+            [([alice, bob], False), ([alice, bob], False), ([bob, alice], True), ([bob, alice], False)]
+        ):
+            await self.manager.add_match(MatchAPISubmit(result=result, draw=draw, date=start + timedelta(days=i)))
+
+        stats = await self.manager.get_player_stats(self.alice.id)
+        self.assertEqual((4, 2, 1, 1), (stats.matches, stats.wins, stats.losses, stats.draws))
+        self.assertEqual((-1, 2, 1), (stats.current_streak, stats.longest_win_streak, stats.longest_loss_streak))
+        self.assertEqual(50, stats.win_percentage)
+
+        head_to_head = await self.manager.get_head_to_head(self.bob.id, self.alice.id)
+        self.assertEqual(
+            (4, 1, 2, 1),
+            (head_to_head.matches, head_to_head.player_a_wins, head_to_head.player_b_wins, head_to_head.draws),
+        )
+        with self.assertRaises(ValueError):
+            await self.manager.get_head_to_head(self.bob.id, self.bob.id)
+
+        # a match played between the others breaks up the winning streak, so they are rebuilt from the history
+        await self.manager.add_match_batch(
+            [MatchAPISubmit(result=[bob, alice], draw=False, date=start + timedelta(hours=12))]
+        )
+        rebuilt = await self.manager.get_player_stats(self.alice.id)
+        self.assertEqual((5, 1), (rebuilt.matches, rebuilt.longest_win_streak))
+
+        self.manager._stats = None
+        self.assertEqual(rebuilt, await self.manager.get_player_stats(self.alice.id))
+
+    async def test_win_probabilities_and_pairings(self):
+        charlie = await self.manager.add_player(PlayerAPI(name="Charlie"))
+        dave = await self.manager.add_player(PlayerAPI(name="Dave"))
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        for i in range(3):
+            await self.manager.add_match(
+                MatchAPISubmit(result=[str(self.alice.id), str(dave.id)], draw=False, date=start + timedelta(days=i))
+            )
+        await self.manager.add_match(
+            MatchAPISubmit(result=[str(self.bob.id), str(charlie.id)], draw=False, date=start + timedelta(days=3))
+        )
+
+        matrix = await self.manager.get_win_probabilities()
+        self.assertIs(matrix, await self.manager.get_win_probabilities())
+        self.assertEqual(["Alice", "Bob", "Charlie", "Dave"], matrix.names)
+        for i in range(4):
+            for j in range(4):
+                self.assertAlmostEqual(1, matrix.probabilities[i][j] + matrix.probabilities[j][i])
+                self.assertAlmostEqual(
+                    Manager.expected_score(
+                        (await self.manager.get_player(matrix.ids[i])).rating,
+                        (await self.manager.get_player(matrix.ids[j])).rating,
+                    ),
+                    matrix.probabilities[i][j],
+                )
+
+        # the closest ratings are played together
+        pairings = await self.manager.suggest_pairings()
+        self.assertCountEqual(
+            [{self.alice.id, self.bob.id}, {charlie.id, dave.id}],
+            [{ObjectId(pairing.player_a), ObjectId(pairing.player_b)} for pairing in pairings],
+        )
+        # unless they played each other recently
+        self.assertEqual(1, len(await self.manager.suggest_pairings([self.bob.id, charlie.id])))
+        self.assertEqual([], await self.manager.suggest_pairings([self.bob.id, charlie.id], not_since=start))
+
+        # changing the ratings rebuilds the matrix
+        await self.manager.set_active(dave.id, False)
+        self.assertEqual(["Alice", "Bob", "Charlie"], (await self.manager.get_win_probabilities()).names)
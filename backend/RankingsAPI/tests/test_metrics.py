@@ -0,0 +1,134 @@
+import asyncio
+import unittest
+
+from MongoBase import MongoConfigMock
+from RankingsAPI.api import build_api
+from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
+from RankingsAPI.manager import Manager
+from RankingsAPI.metrics import (
+    HTTP_REQUEST_DURATION,
+    MATCHES_RATED,
+    MONGO_OPERATION_DURATION,
+    RECALCULATION_DURATION,
+    REGISTRY,
+    MetricsRegistry,
+)
+from RankingsAPI.settings import Settings
+
+
+async def get(app, path: str) -> tuple[int, dict[str, str], str]:
+    return await request(app, "GET", path)
+
+
+async def request(app, method: str, path: str, body: bytes = b"") -> tuple[int, dict[str, str], str]:
+    messages = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            # the client stays connected until the response is over, e.g. while a streamed response is sent
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    headers = {key.decode(): value.decode() for key, value in messages[0]["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return messages[0]["status"], headers, body.decode()
+
+
+class TestMetricTypes(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("things_total", "Things", ("kind",))
+        histogram = registry.histogram("took_seconds", "How long", buckets=(0.1, 1))
+
+        counter.inc(kind='say "hi"')
+        counter.inc(2, kind='say "hi"')
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        self.assertEqual(
+            [
+                "# HELP things_total Things",
+                "# TYPE things_total counter",
+                'things_total{kind="say \\"hi\\""} 3.0',
+                "# HELP took_seconds How long",
+                "# TYPE took_seconds histogram",
+                'took_seconds_bucket{le="0.1"} 2',
+                'took_seconds_bucket{le="1.0"} 3',
+                'took_seconds_bucket{le="+Inf"} 4',
+                "took_seconds_sum 3.65",
+                "took_seconds_count 4",
+            ],
+            registry.render().splitlines(),
+        )
+
+        with self.assertRaises(ValueError):
+            registry.counter("things_total", "Again")
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        settings = Settings(mongo=MongoConfigMock())
+        self.manager = Manager(config=settings)
+        self.manager.connect()
+        self.api = build_api(manager=self.manager, settings=settings)
+        self.alice = await self.manager.add_player(PlayerAPI(name="Alice"))
+        self.bob = await self.manager.add_player(PlayerAPI(name="Bob"))
+
+    async def test_database_operations(self):
+        inserts = MONGO_OPERATION_DURATION.count(operation="insert_many", collection="matches")
+        rated = MATCHES_RATED.value(source="live")
+
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+        self.assertEqual(inserts + 1, MONGO_OPERATION_DURATION.count(operation="insert_many", collection="matches"))
+        self.assertEqual(rated + 1, MATCHES_RATED.value(source="live"))
+
+        # iterating over a cursor is one operation, however many documents it returns
+        finds = MONGO_OPERATION_DURATION.count(operation="find", collection="matches")
+        self.assertEqual(1, len([match async for match in self.manager.iter_matches()]))
+        self.assertEqual(finds + 1, MONGO_OPERATION_DURATION.count(operation="find", collection="matches"))
+
+    async def test_recalculation(self):
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+        recalculations = RECALCULATION_DURATION.count(kind="full")
+        replayed = MATCHES_RATED.value(source="replay")
+
+        await self.manager.recalculate_rankings()
+        self.assertEqual(recalculations + 1, RECALCULATION_DURATION.count(kind="full"))
+        self.assertEqual(replayed + 1, MATCHES_RATED.value(source="replay"))
+
+    async def test_endpoint(self):
+        requests = HTTP_REQUEST_DURATION.count(method="GET", route="/players/{player_id}", status="200")
+        status, _, _ = await get(self.api, f"/players/{self.alice.id}")
+        self.assertEqual(200, status)
+        # requests are labelled by their route, not their path
+        self.assertEqual(
+            requests + 1, HTTP_REQUEST_DURATION.count(method="GET", route="/players/{player_id}", status="200")
+        )
+
+        status, headers, body = await get(self.api, "/metrics")
+        self.assertEqual(200, status)
+        self.assertTrue(headers["content-type"].startswith("text/plain; version=0.0.4"))
+        self.assertEqual(REGISTRY.render().splitlines()[:2], body.splitlines()[:2])
+        self.assertIn('rankings_http_request_duration_seconds_count{method="GET",route="/players/{player_id}"', body)
+        self.assertIn("rankings_ingest_queue_depth 0.0", body)
@@ -0,0 +1,50 @@
+import pstats
+import tempfile
+import unittest
+
+from MongoBase import MongoConfigMock
+from RankingsAPI.data_models import MatchAPISubmit, PlayerAPI
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+
+class TestProfiling(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.manager = Manager(config=Settings(mongo=MongoConfigMock(), profiling=True, slow_operation_threshold=0))
+        self.manager.connect()
+        self.profiler = self.manager.profiler
+        assert self.profiler is not None
+        self.alice = await self.manager.add_player(PlayerAPI(name="Alice"))
+        self.bob = await self.manager.add_player(PlayerAPI(name="Bob"))
+
+    async def test_slow_operations(self):
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+
+        # add_matches is part of add_match, rather than profiled on its own
+        self.assertEqual(["add_match"], [profile.name for profile in self.profiler.profiles])
+        profile = self.profiler.profiles[0]
+        self.assertGreater(profile.duration, 0)
+        self.assertEqual(1, profile.round_trips["insert_many"])
+        # the players' ratings, and their rating history
+        self.assertEqual(2, profile.round_trips["bulk_write"])
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(profile.dump("pstats"))
+            f.flush()
+            stats = pstats.Stats(f.name)
+        self.assertTrue(any(name == "add_matches" for _, _, name in stats.stats))  # type: ignore
+
+        lines = profile.dump("collapsed").decode().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            self.assertGreater(int(line.rsplit(" ", 1)[1]), 0)
+        self.assertTrue(any("add_matches" in line for line in lines))
+
+        with self.assertRaises(ValueError):
+            profile.dump("svg")
+
+    async def test_threshold(self):
+        self.profiler.slow_threshold = 60
+        await self.manager.add_match(MatchAPISubmit(result=[str(self.alice.id), str(self.bob.id)], draw=False))
+        await self.manager.recalculate_rankings()
+        self.assertEqual(0, len(self.profiler.profiles))
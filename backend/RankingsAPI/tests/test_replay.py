@@ -0,0 +1,159 @@
+import random
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from bson import ObjectId
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.data_models import Match, MatchAPISubmit, PlayerAPI
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.manager = Manager(config=Settings(mongo=MongoConfigMock()))
+        self.manager.connect()
+        self.players = [await self.manager.add_player(PlayerAPI(name=f"player_{i}")) for i in range(6)]
+
+        rng = random.Random(1)
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        for i in range(60):
+            winner, loser = rng.sample(self.players, 2)
+            await self.manager.add_match(
+                MatchAPISubmit(
+                    result=[str(winner.id), str(loser.id)], draw=rng.random() < 0.2, date=start + timedelta(hours=i)
+                )
+            )
+
+    async def test_recalculate_matches_live_ratings(self):
+        before = await self.manager.get_players()
+        matches_before = {match.id: match for match in await self.manager.get_matches()}
+
+        await self.manager.recalculate_rankings()
+
+        after = await self.manager.get_players()
+        for player_id, player in before.items():
+            self.assertAlmostEqual(player.rating, after[player_id].rating)
+            self.assertEqual(player.wins, after[player_id].wins)
+            self.assertEqual(player.losses, after[player_id].losses)
+            self.assertEqual(player.draws, after[player_id].draws)
+
+        for match in await self.manager.get_matches():
+            self.assertAlmostEqual(match.winner_rating, matches_before[match.id].winner_rating)
+            self.assertAlmostEqual(match.probability, matches_before[match.id].probability)
+
+    async def test_delete_match_replays_history(self):
+        matches = await self.manager.get_matches_in_order()
+        await self.manager.delete_match(matches[0].id)
+
+        players = await self.manager.get_players()
+        self.assertEqual(59, sum(player.wins + player.draws / 2 for player in players.values()))
+
+        # a second recalculation has nothing left to write
+        with mock.patch.object(motor, "bulk_update", wraps=motor.bulk_update) as bulk_update:
+            await self.manager.recalculate_rankings()
+        self.assertEqual([[], []], [call.args[0] for call in bulk_update.call_args_list])
+
+    async def test_delete_match_replays_from_checkpoint(self):
+        self.manager._config.checkpoint_interval = 7
+        await self.manager.recalculate_rankings()
+        self.assertEqual(8, len(self.manager._checkpoints))
+
+        matches = await self.manager.get_matches_in_order()
+        with mock.patch.object(motor, "find", wraps=motor.find) as find:
+            await self.manager.delete_match(matches[45].id)
+        match_finds = [call for call in find.call_args_list if call.args[0] is Match]
+        self.assertEqual({"date": {"$gte": matches[41].date}}, match_finds[-1].args[1])
+        self.assertEqual([7, 14, 21, 28, 35, 42, 49, 56], [x.match_index for x in self.manager._checkpoints])
+
+        # replaying everything from scratch agrees with the partial replay
+        self.manager._checkpoints = []
+        with mock.patch.object(motor, "bulk_update", wraps=motor.bulk_update) as bulk_update:
+            await self.manager.recalculate_rankings()
+        self.assertEqual([[], []], [call.args[0] for call in bulk_update.call_args_list])
+
+    async def test_delete_player_replays_from_first_match(self):
+        await self.manager.delete_player(self.players[0].id)
+
+        players = await self.manager.get_players()
+        self.assertNotIn(self.players[0].id, players)
+        for match in await self.manager.get_matches():
+            self.assertNotIn(self.players[0].id, match.result)
+
+        with mock.patch.object(motor, "bulk_update", wraps=motor.bulk_update) as bulk_update:
+            await self.manager.recalculate_rankings()
+        self.assertEqual([[], []], [call.args[0] for call in bulk_update.call_args_list])
+
+    async def test_rating_history(self):
+        async def histories():
+            return {
+                player.id: [(point.date, round(point.rating, 9)) for point in history.points]
+                for player in self.players
+                for history in [await self.manager.get_rating_history(player.id)]
+            }
+
+        live = await histories()
+        self.assertEqual(120, sum(len(points) for points in live.values()))
+        players = await self.manager.get_players()
+        for player_id, points in live.items():
+            self.assertAlmostEqual(players[player_id].rating, points[-1][1])
+
+        # the replay rebuilds the same history, from scratch and from a checkpoint
+        self.manager._config.checkpoint_interval = 7
+        await self.manager.recalculate_rankings()
+        self.assertEqual(live, await histories())
+
+        matches = await self.manager.get_matches_in_order()
+        await self.manager.delete_match(matches[45].id)
+        partial = await histories()
+        self.assertEqual(118, sum(len(points) for points in partial.values()))
+
+        self.manager._checkpoints = []
+        await self.manager.recalculate_rankings()
+        self.assertEqual(partial, await histories())
+
+        daily = await self.manager.get_rating_history(self.players[0].id, since=matches[24].date, resolution="day")
+        self.assertEqual([2, 3], [point.date.day for point in daily.points])
+        self.assertAlmostEqual(partial[self.players[0].id][-1][1], daily.points[-1].rating)
+        with self.assertRaises(ValueError):
+            await self.manager.get_rating_history(self.players[0].id, resolution="fortnight")
+
+    async def test_simulate(self):
+        self.manager._config.checkpoint_interval = 7
+        await self.manager.recalculate_rankings()
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        submissions = [
+            # one after every match, and one that goes before the last 29 of them
+            MatchAPISubmit(
+                result=[str(self.players[0].id), str(self.players[1].id)], draw=False, date=start + timedelta(days=5)
+            ),
+            MatchAPISubmit(
+                result=[str(self.players[2].id), str(self.players[3].id)], draw=True, date=start + timedelta(hours=30.5)
+            ),
+        ]
+
+        before = await self.manager.get_players()
+        with mock.patch.object(motor, "_bulk_write") as bulk_write, mock.patch.object(motor, "insert_many") as insert:
+            appended = await self.manager.simulate(submissions[:1])
+            backdated = await self.manager.simulate(submissions)
+        bulk_write.assert_not_called()
+        insert.assert_not_called()
+        self.assertEqual(before, await self.manager.get_players())
+
+        self.assertEqual(0, appended.replayed_matches)
+        self.assertEqual(
+            {str(self.players[0].id), str(self.players[1].id)}, {p.id for p in appended.players if p.rating_change}
+        )
+        # replayed from the checkpoint after the 28th match
+        self.assertEqual(32, backdated.replayed_matches)
+
+        await self.manager.add_match_batch(submissions)
+        after = await self.manager.get_players()
+        for player in backdated.players:
+            self.assertAlmostEqual(after[ObjectId(player.id)].rating, player.rating_after)
+        for player_id, player in after.items():
+            if str(player_id) not in {p.id for p in backdated.players}:
+                self.assertAlmostEqual(before[player_id].rating, player.rating)
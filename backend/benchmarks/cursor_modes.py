@@ -0,0 +1,50 @@
+"""
+cursor_modes.py: Time turning raw mongo documents into python objects with each of the cursor modes, validated pydantic
+documents (the default), trusted pydantic documents, and plain dictionaries. Only the conversion is timed, the documents
+are built in memory so the database doesn't muddy the numbers.
+
+    python -m benchmarks.cursor_modes --documents 100000
+"""
+
+import time
+
+import click
+
+from RankingsAPI.data_models import Match
+from RankingsAPI.Mongo.motor import PydanticAsyncIOMotorCursor
+
+from .match_serialisation import make_documents
+
+REPLAY_FIELDS = ["_id", "result", "draw", "date", "winner_rating", "loser_rating", "probability"]
+
+
+def cursor_modes() -> dict[str, PydanticAsyncIOMotorCursor]:
+    return {
+        "validated": PydanticAsyncIOMotorCursor(None, Match),
+        "trusted": PydanticAsyncIOMotorCursor(None, Match).trusted(),
+        "raw": PydanticAsyncIOMotorCursor(None, Match).raw(),
+    }
+
+
+@click.command()
+@click.option("--documents", default=100_000)
+@click.option("--projected", is_flag=True, help="Only convert the fields the rankings replay reads")
+def main(documents: int, projected: bool):
+    docs = make_documents(documents)
+    if projected:
+        docs = [{key: doc[key] for key in REPLAY_FIELDS} for doc in docs]
+
+    timings = {}
+    for name, cursor in cursor_modes().items():
+        start = time.perf_counter()
+        for doc in docs:
+            cursor._convert(doc)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>16}: {timings[name]:8.3f}s")
+
+    for name in ("trusted", "raw"):
+        print(f"{name + ' speedup':>16}: {timings['validated'] / timings[name]:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+league.py: Generate synthetic leagues of any size to benchmark against. Every player has a hidden strength, so the
+results (and so the ratings) look like a real league rather than coin tosses.
+"""
+
+import math
+import random
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+import RankingsAPI.Mongo.motor as motor
+from RankingsAPI.data_models import Match, Player
+from RankingsAPI.manager import DOCUMENT_TYPES
+
+__all__ = ["LeagueSpec", "generate_league", "seed_league", "clear_league"]
+
+#: How many documents are inserted per round-trip when seeding
+SEED_BATCH_SIZE = 10_000
+
+
+@dataclass
+class LeagueSpec:
+    players: int = 100
+    matches: int = 10_000
+    #: The matches are spread over this many days, up to now
+    days: float = 365
+    #: The fraction of matches that are draws
+    draw_rate: float = 0.1
+    seed: int = 1
+
+
+def generate_league(spec: LeagueSpec) -> tuple[list[Player], list[Match]]:
+    """
+    The players, and the matches they played in date order. Nothing has been rated, the ratings come from replaying.
+    """
+    rng = random.Random(spec.seed)
+    players = [Player(name=f"Player {i}") for i in range(spec.players)]
+    for player in players:
+        player.id = ObjectId()
+    strength = {player.id: rng.gauss(0, 1) for player in players}
+
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=spec.days)
+    dates = sorted(start + timedelta(seconds=rng.uniform(0, spec.days * 86400)) for _ in range(spec.matches))
+
+    matches = []
+    for date in dates:
+        a, b = rng.sample(players, 2)
+        draw = rng.random() < spec.draw_rate
+        a_wins = rng.random() < 1 / (1 + math.exp(strength[b.id] - strength[a.id]))
+        winner, loser = (a, b) if a_wins else (b, a)
+        matches.append(Match(result=[winner.id, loser.id], draw=draw, date=date))
+    return players, matches
+
+
+async def clear_league():
+    """
+    Empty every collection the manager uses
+    """
+    for doc_type in DOCUMENT_TYPES:
+        await motor.delete_many(doc_type)
+
+
+async def seed_league(spec: LeagueSpec) -> tuple[list[Player], list[Match]]:
+    """
+    Generate a league and insert it into the connected database
+    """
+    players, matches = generate_league(spec)
+    for docs in (players, matches):
+        for start in range(0, len(docs), SEED_BATCH_SIZE):
+            await motor.insert_many(docs[start : start + SEED_BATCH_SIZE])  # type: ignore
+    return players, matches
@@ -0,0 +1,70 @@
+"""
+match_serialisation.py: Time turning raw mongo match documents into the /matches response body, the way it used to be
+done (pydantic Match, deepcopy, to_api, response model validation) against building the api dictionaries directly.
+
+    python -m benchmarks.match_serialisation --matches 100000
+"""
+
+import copy
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import click
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from RankingsAPI.data_models import Match, MatchAPIReturn
+
+
+def make_documents(count: int) -> list[dict]:
+    players = [ObjectId() for _ in range(50)]
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    return [
+        {
+            "_id": ObjectId(),
+            "result": random.sample(players, 2),
+            "draw": False,
+            "date": start + timedelta(minutes=i),
+            "winner_rating": 1000 + random.random() * 200,
+            "loser_rating": 1000 + random.random() * 200,
+            "probability": random.random(),
+            "_date_created": start,
+            "_date_modified": start,
+            "_created_by": "",
+            "_modified_by": "",
+        }
+        for i in range(count)
+    ]
+
+
+def pydantic_chain(docs: list[dict]) -> str:
+    matches = copy.deepcopy([Match(**doc) for doc in docs])
+    returned = [x.to_api() for x in matches]
+    # what FastAPI does with the response_model
+    validated = [MatchAPIReturn(**x.dict()) for x in returned]
+    return json.dumps(jsonable_encoder(validated))
+
+
+def direct(docs: list[dict]) -> str:
+    return json.dumps([Match.mongo_to_api(doc) for doc in docs])
+
+
+@click.command()
+@click.option("--matches", default=100_000)
+def main(matches: int):
+    docs = make_documents(matches)
+
+    timings = {}
+    for name, serialise in (("pydantic chain", pydantic_chain), ("direct", direct)):
+        start = time.perf_counter()
+        serialise(docs)
+        timings[name] = time.perf_counter() - start
+        print(f"{name:>15}: {timings[name]:8.3f}s")
+
+    print(f"{'speedup':>15}: {timings['pydantic chain'] / timings['direct']:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+recalculate_rankings.py: Compare the number of database round-trips (and the time) needed to recalculate the rankings
+with the in-memory replay against pushing every match back through add_match.
+
+    python -m benchmarks.recalculate_rankings --players 50 --matches 5000
+"""
+
+import asyncio
+import random
+import time
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import click
+
+import RankingsAPI.Mongo.motor as motor
+from MongoBase import MongoConfigMock
+from RankingsAPI.data_models import Match, Player
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+
+class CountingCollection:
+    """
+    Wrap a motor collection and count every call that goes to the database
+    """
+
+    def __init__(self, collection, counter: Counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, attr):
+        value = getattr(self._collection, attr)
+        if not callable(value):
+            return value
+
+        def wrapper(*args, **kwargs):
+            self._counter[attr] += 1
+            return value(*args, **kwargs)
+
+        return wrapper
+
+
+@contextmanager
+def count_round_trips() -> Iterator[Counter]:
+    """
+    Count the database calls made inside, by collection and method
+    """
+    counter: Counter = Counter()
+    get_collection = motor._get_collection
+    motor._get_collection = lambda doc: CountingCollection(get_collection(doc), counter)  # type: ignore
+    try:
+        yield counter
+    finally:
+        motor._get_collection = get_collection  # type: ignore
+
+
+async def seed(player_count: int, match_count: int) -> None:
+    players = [Player(name=f"Player {i}") for i in range(player_count)]
+    player_ids = await motor.insert_many(players)  # type: ignore
+
+    start = datetime.now(timezone.utc) - timedelta(days=365)
+    matches = []
+    for i in range(match_count):
+        matches.append(Match(result=random.sample(player_ids, 2), draw=False, date=start + timedelta(minutes=i)))
+    await motor.insert_many(matches)  # type: ignore
+
+
+async def legacy_recalculate_rankings(manager: Manager) -> None:
+    players = await manager.get_players()
+    for player in players.values():
+        player.reset()
+        await motor.update_one(player)
+
+    for match in await manager.get_matches_in_order():
+        await manager.add_match(match, insert=False)
+
+
+async def run(player_count: int, match_count: int) -> None:
+    manager = Manager(config=Settings(mongo=MongoConfigMock()))
+    manager.connect()
+    await seed(player_count, match_count)
+
+    for name, recalculate in (
+        ("in-memory replay", manager.recalculate_rankings),
+        ("add_match replay", lambda: legacy_recalculate_rankings(manager)),
+    ):
+        with count_round_trips() as counter:
+            start = time.perf_counter()
+            await recalculate()
+            elapsed = time.perf_counter() - start
+        print(f"{name:>20}: {sum(counter.values()):>8} round-trips {elapsed:8.3f}s {dict(counter)}")
+
+
+@click.command()
+@click.option("--players", default=50)
+@click.option("--matches", default=5000)
+def main(players: int, matches: int):
+    asyncio.run(run(players, matches))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+suite.py: Time the expensive operations against a synthetic league and write the results as JSON, so runs on
+different sizes (or commits) can be compared.
+
+    python -m benchmarks.suite --players 100 --matches 10000 --output results.json
+    python -m benchmarks.suite --matches 100000 --mongo-url mongodb://localhost:27017
+
+Every operation is run --repeat times. The API endpoints are called straight through the ASGI app, without a server.
+"""
+
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import click
+
+from MongoBase import MongoConfigMock, MongoConfigUrl
+from RankingsAPI.api import build_api
+from RankingsAPI.manager import Manager
+from RankingsAPI.settings import Settings
+
+from .league import LeagueSpec, clear_league, seed_league
+from .recalculate_rankings import count_round_trips
+
+
+async def asgi_get(app, path: str) -> int:
+    """
+    Send a GET request straight to the ASGI app, returning the size of the response body
+    """
+    status = 0
+    body = bytearray()
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            body.extend(message.get("body", b""))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    if status != 200:
+        raise RuntimeError(f"GET {path} returned {status}")
+    return len(body)
+
+
+async def time_operation(
+    operation: Callable[[int], Awaitable], repeat: int, before: Callable[[], None] | None = None
+) -> dict:
+    """
+    Run the operation repeat times, being passed the run number, and summarise how long it took
+    """
+    runs = []
+    round_trips = []
+    for i in range(repeat):
+        if before:
+            before()
+        with count_round_trips() as counter:
+            start = time.perf_counter()
+            await operation(i)
+            runs.append(time.perf_counter() - start)
+        round_trips.append(sum(counter.values()))
+    return {
+        "runs": runs,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "max": max(runs),
+        "round_trips": max(round_trips),
+    }
+
+
+async def run(spec: LeagueSpec, repeat: int, mongo_url: str | None, database: str) -> dict:
+    mongo = MongoConfigUrl(connection_url=mongo_url, database=database) if mongo_url else MongoConfigMock()
+    settings = Settings(mongo=mongo)
+    manager = Manager(config=settings)
+    manager.connect()
+    api = build_api(manager=manager, settings=settings)
+
+    await clear_league()
+    start = time.perf_counter()
+    players, _ = await seed_league(spec)
+    seed_time = time.perf_counter() - start
+    await manager.ensure_indexes()
+    # the matches have never been rated, so the first replay writes every match
+    await manager.recalculate_rankings()
+
+    def forget_checkpoints():
+        manager._checkpoints = []
+
+    results = {
+        "recalculate_rankings": await time_operation(
+            lambda _: manager.recalculate_rankings(), repeat, before=forget_checkpoints
+        ),
+        "recalculate_last_matches": await time_operation(lambda _: manager.recalculate_last_matches(), repeat),
+        "GET /players (cold)": await time_operation(
+            lambda _: asgi_get(api, "/players"), repeat, before=manager.invalidate_player_cache
+        ),
+        "GET /players": await time_operation(lambda _: asgi_get(api, "/players"), repeat),
+        "GET /matches/resolved": await time_operation(lambda _: asgi_get(api, "/matches/resolved"), repeat),
+        # last, as it changes the league. Each run deletes a different player.
+        "delete_player": await time_operation(lambda i: manager.delete_player(players[i].id), repeat),
+    }
+
+    if mongo_url:
+        await clear_league()
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "backend": "mongod" if mongo_url else "mock",
+        "league": asdict(spec),
+        "seed_time": seed_time,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+@click.command()
+@click.option("--players", default=100)
+@click.option("--matches", default=10_000)
+@click.option("--days", default=365.0, help="The matches are spread over this many days")
+@click.option("--draw-rate", default=0.1)
+@click.option("--seed", default=1)
+@click.option("--repeat", default=3)
+@click.option("--mongo-url", default=None, help="Run against this mongod rather than the in-memory mock")
+@click.option("--database", default="rankings_benchmark", help="The database to use, it is emptied before and after")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), default=None, help="Defaults to stdout")
+def main(
+    players: int,
+    matches: int,
+    days: float,
+    draw_rate: float,
+    seed: int,
+    repeat: int,
+    mongo_url: str | None,
+    database: str,
+    output: str | None,
+):
+    spec = LeagueSpec(players=players, matches=matches, days=days, draw_rate=draw_rate, seed=seed)
+    if repeat > players:
+        raise click.BadParameter("Each delete_player run needs its own player", param_hint="--repeat")
+
+    results = json.dumps(asyncio.run(run(spec, repeat, mongo_url, database)), indent=2)
+    if output:
+        Path(output).write_text(results + "\n")
+    else:
+        click.echo(results)
+
+
+if __name__ == "__main__":
+    main()